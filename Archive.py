@@ -0,0 +1,114 @@
+import time
+import zlib
+import sqlite3
+import logging
+import threading
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+from DB import VOTE_PARTICIPATE, VOTE_MAYBE
+
+logger = logging.getLogger(__name__)
+
+class RosterArchive:
+    """Архив составов прошедших встреч в отдельном файле SQLite.
+
+    Одна строка - одна встреча мероприятия. Таблица кластеризована по
+    (message_id, occurred_at), поэтому выборка «все встречи события за полгода»
+    читает соседние страницы. Состав хранится по столбцам: id участников и их
+    статусы - отдельные сжатые массивы. Запись идёт в фоновом потоке и не
+    задерживает отправку запланированного сообщения."""
+
+    def __init__(self, db_name='mtg_archive.db'):
+        self.db_name = db_name
+        # Один поток-писатель: записи добавляются строго по порядку
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="roster-archive")
+        self.pending = 0  # составы в очереди на запись
+        # pending увеличивается в цикле событий, а уменьшается в потоке-писателе
+        self.pending_lock = threading.Lock()
+        self.writer.submit(self._open_writer).result()
+
+    def _open_writer(self):
+        self.write_conn = sqlite3.connect(self.db_name)
+        self.write_conn.execute('''
+        CREATE TABLE IF NOT EXISTS occurrences (
+            message_id INTEGER NOT NULL,
+            occurred_at INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            participate_count INTEGER NOT NULL,
+            maybe_count INTEGER NOT NULL,
+            user_ids BLOB NOT NULL,
+            statuses BLOB NOT NULL,
+            PRIMARY KEY(message_id, occurred_at)
+        ) WITHOUT ROWID
+        ''')
+        self.write_conn.commit()
+
+    @staticmethod
+    def encode(message):
+        """Переводит состав в два сжатых столбца: id участников и статусы"""
+        user_ids = array('q', [u['id'] for u in message.participants] +
+                              [u['id'] for u in message.maybe_participants])
+        statuses = bytes([VOTE_PARTICIPATE] * len(message.participants) +
+                         [VOTE_MAYBE] * len(message.maybe_participants))
+        return zlib.compress(user_ids.tobytes()), zlib.compress(statuses)
+
+    @staticmethod
+    def decode(user_ids: bytes, statuses: bytes):
+        ids = array('q')
+        ids.frombytes(zlib.decompress(user_ids))
+        return list(zip(ids, zlib.decompress(statuses)))
+
+    def submit(self, message, occurred_at: int = None):
+        """Ставит состав встречи в очередь на запись. Не блокирует вызывающего"""
+        # Кодируем сразу: после возврата состав сообщения будет очищен
+        row = (
+            message.db_id, occurred_at or int(time.time()), message.chat_id,
+            len(message.participants), len(message.maybe_participants),
+            *self.encode(message)
+        )
+        with self.pending_lock:
+            self.pending += 1
+        future = self.writer.submit(self._write, row)
+        future.add_done_callback(self._log_failure)
+        return future
+
+    def _write(self, row):
+        with self.write_conn:
+            self.write_conn.execute('''
+            INSERT OR IGNORE INTO occurrences
+                (message_id, occurred_at, chat_id, participate_count, maybe_count, user_ids, statuses)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', row)
+
+    def _log_failure(self, future):
+        with self.pending_lock:
+            self.pending -= 1
+        if future.exception():
+            logger.error(f"[ARCHIVE] Не удалось сохранить состав в архив: {future.exception()}")
+
+    def scan(self, message_id: int, since: int, until: int = None, with_roster: bool = True, db_name: str = None):
+        """Перебирает встречи мероприятия за период по возрастанию времени.
+        Без with_roster сжатые столбцы не распаковываются. db_name - архив
+        другого процесса (шарда, которому принадлежит мероприятие)"""
+        conn = sqlite3.connect(db_name or self.db_name)
+        try:
+            columns = 'occurred_at, participate_count, maybe_count'
+            if with_roster:
+                columns += ', user_ids, statuses'
+            cursor = conn.execute(f'''
+            SELECT {columns} FROM occurrences
+            WHERE message_id = ? AND occurred_at >= ? AND occurred_at <= ?
+            ORDER BY occurred_at
+            ''', (message_id, since, until if until is not None else int(time.time())))
+            for row in cursor:
+                if with_roster:
+                    yield row[:3] + (self.decode(row[3], row[4]),)
+                else:
+                    yield row
+        finally:
+            conn.close()
+
+    def close(self):
+        """Дожидается записи всех составов из очереди"""
+        self.writer.submit(self.write_conn.close)
+        self.writer.shutdown(wait=True)
@@ -0,0 +1,102 @@
+import time
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+AUTH_TTL = 600             # секунд, сколько живёт запись кэша без событий Telegram
+AUTH_MAX_ENTRIES = 10000   # ограничение на каждый из словарей кэша
+
+TELEGRAM_ADMIN_STATUSES = ('administrator', 'creator')
+
+class AdminAuth:
+    """Проверки прав администраторов с кэшем в памяти.
+
+    Хранит три вида записей: чаты, которыми управляет админ бота (chat_admins),
+    чат мероприятия и статус пользователя в чате по данным Telegram. Проверки
+    в обработчиках - поиск в словаре без запросов к Bot API. Записи живут
+    AUTH_TTL секунд и сбрасываются раньше по событиям: /set_admin, изменение
+    прав участника, удаление бота из чата и миграция группы."""
+
+    def __init__(self, db, ttl: float = AUTH_TTL, max_entries: int = AUTH_MAX_ENTRIES):
+        self.db = db
+        self.ttl = ttl
+        self.max_entries = max_entries
+        # Порядок в OrderedDict - порядок использования: в начале самые давно нужные записи
+        self.admin_chats = OrderedDict()   # admin_id -> (истекает, frozenset(chat_id))
+        self.event_chats = OrderedDict()   # db_id -> (истекает, chat_id)
+        self.members = OrderedDict()       # (chat_id, user_id) -> (истекает, админ ли в Telegram)
+
+    def _get(self, cache: OrderedDict, key):
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        if entry[0] <= time.monotonic():
+            # Истёкшие записи удаляются при обращении, отдельного обхода словаря нет
+            del cache[key]
+            return None
+        cache.move_to_end(key)
+        return entry[1]
+
+    def _put(self, cache: OrderedDict, key, value):
+        cache[key] = (time.monotonic() + self.ttl, value)
+        cache.move_to_end(key)
+        if len(cache) > self.max_entries:
+            # Вытесняем запись, к которой дольше всех не обращались
+            cache.popitem(last=False)
+        return value
+
+    # Проверки
+
+    def chats_of(self, admin_id: int) -> frozenset:
+        """Чаты, которыми админ управляет через бота"""
+        chats = self._get(self.admin_chats, admin_id)
+        if chats is None:
+            chats = self._put(self.admin_chats, admin_id, frozenset(self.db.get_admin_chats(admin_id)))
+        return chats
+
+    def is_admin(self, admin_id: int) -> bool:
+        return bool(self.chats_of(admin_id))
+
+    def is_chat_admin(self, admin_id: int, chat_id: int) -> bool:
+        return chat_id in self.chats_of(admin_id)
+
+    def owns_event(self, admin_id: int, db_id: int) -> bool:
+        """Мероприятие принадлежит одному из чатов админа"""
+        chat_id = self._get(self.event_chats, db_id)
+        if chat_id is None:
+            chat_id = self.db.get_event_chat(db_id)
+            if chat_id is None:
+                return False
+            self._put(self.event_chats, db_id, chat_id)
+        return self.is_chat_admin(admin_id, chat_id)
+
+    async def is_telegram_admin(self, bot, chat_id: int, user_id: int) -> bool:
+        """Является ли пользователь администратором чата в Telegram. Bot API - только при промахе кэша"""
+        status = self._get(self.members, (chat_id, user_id))
+        if status is None:
+            member = await bot.get_chat_member(chat_id, user_id)
+            status = self._put(self.members, (chat_id, user_id), member.status in TELEGRAM_ADMIN_STATUSES)
+        return status
+
+    # Инвалидация
+
+    def member_updated(self, chat_id: int, user_id: int, status: str) -> None:
+        """Telegram сообщил о новом статусе участника - записываем его без запроса к API"""
+        self._put(self.members, (chat_id, user_id), status in TELEGRAM_ADMIN_STATUSES)
+        self.admin_chats.pop(user_id, None)
+
+    def invalidate_admin(self, admin_id: int) -> None:
+        self.admin_chats.pop(admin_id, None)
+
+    def invalidate_chat(self, chat_id: int) -> None:
+        """Сбрасывает всё, что относится к чату: бот удалён из него или чат мигрировал"""
+        for admin_id in [a for a, (_, chats) in self.admin_chats.items() if chat_id in chats]:
+            del self.admin_chats[admin_id]
+        for db_id in [e for e, (_, chat) in self.event_chats.items() if chat == chat_id]:
+            del self.event_chats[db_id]
+        for key in [k for k in self.members if k[0] == chat_id]:
+            del self.members[key]
+
+    def invalidate_event(self, db_id: int) -> None:
+        self.event_chats.pop(db_id, None)
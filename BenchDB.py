@@ -0,0 +1,324 @@
+import os
+import sys
+import json
+import time
+import pickle
+import random
+import shutil
+import sqlite3
+import logging
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime
+import pytz
+from apscheduler.triggers.cron import CronTrigger
+from DB import Database, VOTE_PARTICIPATE, VOTE_MAYBE, VOTE_NONE
+
+# Админ с несколькими чатами: на нём меряются запросы админ-панели
+BIG_ADMIN_ID = 1
+BIG_ADMIN_CHATS = 20
+
+# Методы без замера: служебные, статические или покрытые Transfer.py
+NOT_BENCHMARKED = {
+    'seed_shard_ids', 'pack_roster', 'unpack_roster', 'build_match_query', 'export_fields',
+    'iter_export', 'import_batch', 'try_acquire_lock', 'heartbeat_lock', 'release_lock', 'create_tables',
+}
+
+def chat_id_of(index: int) -> int:
+    return -100_000_000_000 - index
+
+def admin_id_of(index: int) -> int:
+    return 1000 + index
+
+class Dataset:
+    """Параметры синтетической базы и выбор целей для повторов замера"""
+
+    def __init__(self, events: int, participants: int, chat_events: int, users: int, seed: int):
+        self.events = events
+        self.participants = participants
+        self.chat_events = chat_events
+        self.users = max(users, participants * 2)
+        self.seed = seed
+        self.chats = max(1, events // chat_events)
+
+    @property
+    def label(self) -> str:
+        return f"{self.events}x{self.participants}"
+
+    def event(self, i: int) -> int:
+        # Шаг - простое число: повторы читают разные страницы базы
+        return 1 + (i * 7919) % self.events
+
+    def chat(self, i: int) -> int:
+        return chat_id_of((i * 31) % self.chats)
+
+    def build(self, path: str) -> None:
+        """Заполняет базу напрямую пачками INSERT: методы Database для миллионов строк слишком медленные"""
+        started = time.perf_counter()
+        db = Database(path)
+        rnd = random.Random(self.seed)
+        trigger = pickle.dumps(CronTrigger(day_of_week='fri', hour=19, minute=0,
+                                           timezone=pytz.timezone("Europe/Moscow")))
+        now = int(time.time())
+
+        def events():
+            for db_id in range(1, self.events + 1):
+                title = "Турнир по драфту" if db_id % 3 else "Вечерний коммандер"
+                yield (db_id, chat_id_of((db_id - 1) % self.chats), f"{title} #{db_id}\nСтол {db_id % 12}",
+                       'fri', '19:00', '', trigger)
+
+        def rosters():
+            for db_id in range(1, self.events + 1):
+                for user_id in rnd.sample(range(1, self.users + 1), self.participants):
+                    yield db_id, user_id, 'participate' if rnd.random() < 0.8 else 'maybe'
+
+        with db.conn:
+            cursor = db.conn.cursor()
+            cursor.executemany('INSERT INTO users (id, username, full_name) VALUES (?, ?, ?)',
+                               ((user_id, f"player{user_id}", f"Игрок {user_id}") for user_id in range(1, self.users + 1)))
+            cursor.executemany('INSERT INTO chat_admins (chat_id, admin_id) VALUES (?, ?)',
+                               ((chat_id_of(index), admin_id_of(index)) for index in range(self.chats)))
+            cursor.executemany('INSERT INTO chat_admins (chat_id, admin_id) VALUES (?, ?)',
+                               ((chat_id_of(index), BIG_ADMIN_ID) for index in range(min(BIG_ADMIN_CHATS, self.chats))))
+            cursor.executemany('''
+            INSERT INTO messages (id, chat_id, text, day_of_week, time, links, trigger) VALUES (?, ?, ?, ?, ?, ?, ?)
+            ''', events())
+            cursor.executemany('INSERT INTO participants (message_id, user_id, status) VALUES (?, ?, ?)', rosters())
+            cursor.execute('''
+            INSERT INTO vote_journal (message_id, user_id, action, ts)
+            SELECT message_id, user_id, CASE status WHEN 'participate' THEN ? ELSE ? END, ?
+            FROM participants ORDER BY message_id, user_id
+            ''', (VOTE_PARTICIPATE, VOTE_MAYBE, now))
+            cursor.execute('''
+            INSERT INTO user_stats (chat_id, user_id, attended, maybe, best_streak, last_seen)
+            SELECT m.chat_id, p.user_id, SUM(p.status = 'participate'), SUM(p.status = 'maybe'), 1, ?
+            FROM participants p JOIN messages m ON m.id = p.message_id
+            GROUP BY m.chat_id, p.user_id
+            ''', (now,))
+            cursor.execute('INSERT INTO event_health (message_id, last_activity) SELECT id, ? FROM messages', (now,))
+        db.check_counters(repair=True)
+        if db.fts_enabled:
+            db.rebuild_search_index()
+        db.conn.close()
+        print(f"База {self.label}: {self.events} мероприятий, {self.events * self.participants} участников, "
+              f"{self.chats} чатов за {time.perf_counter() - started:.1f} с")
+
+class Benchmarks:
+    """Замеры методов Database. Порядок: чтение, запись, затем удаление данных"""
+
+    def __init__(self, db: Database, data: Dataset, repeat: int):
+        self.db = db
+        self.data = data
+        self.repeat = repeat
+        self.results = {}
+
+    def time(self, name: str, call, repeat: int = None) -> None:
+        repeat = repeat or self.repeat
+        samples = []
+        for i in range(repeat):
+            started = time.perf_counter()
+            call(i)
+            samples.append((time.perf_counter() - started) * 1000)
+        samples.sort()
+        self.results[name] = {
+            'runs': repeat,
+            'min_ms': samples[0],
+            'median_ms': statistics.median(samples),
+            'p95_ms': samples[min(repeat - 1, int(0.95 * repeat))],
+        }
+        print(f"  {name:32} {self.results[name]['median_ms']:10.3f} мс (min {samples[0]:.3f}, {repeat} повторов)")
+
+    def run(self) -> dict:
+        db, data = self.db, self.data
+        heavy = max(1, min(3, self.repeat))
+        voter = type('User', (), {'id': 5, 'username': 'player5', 'full_name': 'Игрок 5'})
+        now = int(time.time())
+
+        # Чтение
+        self.time('load_message', lambda i: db.load_message(data.event(i)))
+        self.time('load_messages', lambda i: db.load_messages(BIG_ADMIN_ID))
+        self.time('init_load_all', lambda i: db.init_load_all(), heavy)
+        self.time('load_message_counts', lambda i: db.load_message(data.event(i), with_roster=False))
+        self.time('get_roster_page', lambda i: db.get_roster_page(data.event(i), 0, 30))
+        self.time('get_message_posts', lambda i: db.get_message_posts(data.event(i)))
+        self.time('get_event_chat', lambda i: db.get_event_chat(data.event(i)))
+        self.time('user_has_chats', lambda i: db.user_has_chats(BIG_ADMIN_ID))
+        self.time('get_admin_chat', lambda i: db.get_admin_chat(BIG_ADMIN_ID))
+        self.time('get_admin_chats', lambda i: db.get_admin_chats(BIG_ADMIN_ID))
+        self.time('get_admin_chats_with_threads', lambda i: db.get_admin_chats_with_threads(BIG_ADMIN_ID))
+        self.time('get_chat_admins', lambda i: db.get_chat_admins(data.chat(i)))
+        self.time('search_messages', lambda i: db.search_messages(BIG_ADMIN_ID, 'турнир'))
+        self.time('get_event_stats', lambda i: db.get_event_stats(data.event(i)))
+        self.time('get_user_stats', lambda i: db.get_user_stats(data.chat(i), 5))
+        self.time('get_top_attendees', lambda i: db.get_top_attendees(data.chat(i)))
+        self.time('replay_roster', lambda i: db.replay_roster(data.event(i)))
+        self.time('roster_at', lambda i: db.roster_at(data.event(i), now))
+        self.time('check_counters', lambda i: db.check_counters(), heavy)
+        self.time('find_dormant_events', lambda i: db.find_dormant_events(3, now - 8 * 7 * 24 * 3600))
+        self.time('get_state', lambda i: db.get_state('last_update_id'))
+        self.time('load_session', lambda i: db.load_session(admin_id_of(i)))
+        media_id = db.get_or_create_media('url:bench', 'bench-file')
+        self.time('get_media', lambda i: db.get_media(media_id))
+
+        # Запись
+        message = db.load_message(data.event(0))
+        self.time('save_message', lambda i: db.save_message(message))
+        self.time('save_message_new', lambda i: db.save_message(self.new_message(i)))
+        self.time('upsert_user', lambda i: db.upsert_user(voter))
+        self.time('record_vote', lambda i: db.record_vote(data.event(i), 10 + i, VOTE_PARTICIPATE))
+        self.time('record_vote_toggle', lambda i: db.record_vote(data.event(i), 10 + i, VOTE_PARTICIPATE, toggle=True))
+        self.time('record_vote_cancel', lambda i: db.record_vote(data.event(i), 10 + i, VOTE_NONE))
+        self.time('record_send_result', lambda i: db.record_send_result(data.event(i), False))
+        self.time('reset_roster', lambda i: db.reset_roster(data.event(i + self.repeat)))
+        self.time('add_message_post', lambda i: db.add_message_post(data.event(i), chat_id_of(-1 - i)))
+        self.time('save_post_pins', lambda i: db.save_post_pins(data.event(i), [(chat_id_of(-1 - i), 100 + i, False)]))
+        self.time('remove_message_post', lambda i: db.remove_message_post(data.event(i), chat_id_of(-1 - i)))
+        self.time('get_or_create_media', lambda i: db.get_or_create_media(f'url:bench{i}', f'bench{i}'))
+        self.time('attach_media', lambda i: db.attach_media(data.event(i), f'photo{i}', f'file{i}'))
+        self.time('update_media_file_id', lambda i: db.update_media_file_id(media_id, f'bench-file{i}'))
+        self.time('set_chat_admin', lambda i: db.set_chat_admin(data.chat(i), admin_id_of(10 ** 6 + i)))
+        self.time('add_chat_admin', lambda i: db.add_chat_admin(data.chat(i), admin_id_of(2 * 10 ** 6 + i)))
+        self.time('remove_chat_admin', lambda i: db.remove_chat_admin(data.chat(i), admin_id_of(2 * 10 ** 6 + i)))
+        self.time('update_chat_thread', lambda i: db.update_chat_thread(data.chat(i), admin_id_of(10 ** 6 + i), i))
+        self.time('set_states', lambda i: db.set_states({'last_update_id': i, 'pending_refresh': ''}))
+        self.time('save_sessions', lambda i: db.save_sessions(
+            [(admin_id_of(i), 'DEFAULT', None, None, None, None, None, None, time.time() + 60)], expired_before=time.time()))
+        self.time('shift_chat_events', lambda i: db.shift_chat_events(data.chat(i), 1))
+        self.time('move_events_to_day', lambda i: db.move_events_to_day([data.event(i)], 'sat'))
+        self.time('compact_journal', lambda i: db.compact_journal(now + 1), 1)
+        if db.fts_enabled:
+            self.time('rebuild_search_index', lambda i: db.rebuild_search_index(), heavy)
+
+        # Удаление: у каждого повтора свой чат или мероприятие с конца диапазона
+        last_chat = data.chats - 1
+        spare = max(1, min(self.repeat, data.chats // 4))
+        self.time('delete_message', lambda i: db.delete_message(data.events - i), spare)
+        self.time('remove_chats_data', lambda i: db.remove_chats_data(chat_id_of(last_chat - i)), spare)
+        self.time('delete_thread_events', lambda i: db.delete_thread_events(chat_id_of(last_chat - spare - i)), spare)
+        self.time('update_chat_id', lambda i: db.update_chat_id(
+            chat_id_of(last_chat - 2 * spare - i), chat_id_of(10 ** 6 + i)), spare)
+
+        # Архив: мероприятия из начала диапазона уходят в архив и возвращаются обратно
+        self.time('archive_events', lambda i: db.archive_events([(1 + i, 'idle')]), spare)
+        self.time('get_archived_chat', lambda i: db.get_archived_chat(1 + i % spare))
+        self.time('get_archived_events', lambda i: db.get_archived_events([chat_id_of(0)]))
+        self.time('restore_event', lambda i: db.restore_event(1 + i), spare)
+        return self.results
+
+    def new_message(self, i: int):
+        message = self.db.load_message(self.data.event(i))
+        message.db_id = None
+        return message
+
+def untimed_methods(results: dict) -> list:
+    public = {name for name in dir(Database) if not name.startswith('_') and callable(getattr(Database, name))}
+    return sorted(public - set(results) - NOT_BENCHMARKED)
+
+def metadata() -> dict:
+    try:
+        revision = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        revision = None
+    return {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'revision': revision,
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'machine': platform.machine(),
+    }
+
+def run(args) -> dict:
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix='mtg-bench-')
+    os.makedirs(data_dir, exist_ok=True)
+    report = {'meta': metadata(), 'results': {}}
+    for events in args.events:
+        data = Dataset(events, args.participants, args.chat_events, args.users, args.seed)
+        # Шаблон базы переиспользуется между запусками, замеры идут на копии
+        template = os.path.join(data_dir, f"bench-{data.label}-{data.chat_events}-{data.users}-{data.seed}.db")
+        if not os.path.exists(template):
+            data.build(template)
+        work = os.path.join(data_dir, f"work-{data.label}.db")
+        shutil.copyfile(template, work)
+
+        print(f"Замеры на базе {data.label}:")
+        db = Database(work)
+        report['results'][data.label] = Benchmarks(db, data, args.repeat).run()
+        db.conn.close()
+        os.remove(work)
+
+    missing = untimed_methods(next(iter(report['results'].values()), {}))
+    if missing:
+        print(f"Без замера: {', '.join(missing)}")
+    return report
+
+def compare(baseline: dict, current: dict, threshold: float, floor_ms: float) -> list:
+    """Сравнивает медианы с базовыми. Регрессия - медленнее на threshold и не меньше чем на floor_ms"""
+    regressions = []
+    for label, results in current['results'].items():
+        base_results = baseline['results'].get(label)
+        if not base_results:
+            print(f"В базовых результатах нет базы {label}")
+            continue
+        print(f"Сравнение {label} с {baseline['meta'].get('revision') or baseline['meta'].get('date')}:")
+        for name, stats in results.items():
+            base = base_results.get(name)
+            if not base:
+                continue
+            before, after = base['median_ms'], stats['median_ms']
+            change = (after - before) / before if before else 0.0
+            regressed = change > threshold and after - before > floor_ms
+            mark = "РЕГРЕССИЯ" if regressed else ("быстрее" if change < -threshold else "")
+            print(f"  {name:32} {before:10.3f} -> {after:10.3f} мс {change:+7.1%} {mark}")
+            if regressed:
+                regressions.append((label, name, before, after))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры методов Database на синтетических базах")
+    subparsers = parser.add_subparsers(dest='action', required=True)
+
+    run_parser = subparsers.add_parser('run', help="заполнить базы и замерить методы")
+    run_parser.add_argument('--events', type=int, nargs='+', default=[1000, 10000],
+                            help="размеры баз по числу мероприятий, например 1000 10000 100000")
+    run_parser.add_argument('--participants', type=int, default=20, help="участников в каждом мероприятии")
+    run_parser.add_argument('--chat-events', type=int, default=10, help="мероприятий в одном чате")
+    run_parser.add_argument('--users', type=int, default=50000, help="пользователей в базе")
+    run_parser.add_argument('--repeat', type=int, default=20)
+    run_parser.add_argument('--seed', type=int, default=1)
+    run_parser.add_argument('--data-dir', help="каталог для шаблонов баз, по умолчанию временный")
+    run_parser.add_argument('--output', default='bench.json')
+    run_parser.add_argument('--baseline', help="сразу сравнить с базовыми результатами")
+
+    compare_parser = subparsers.add_parser('compare', help="сравнить два файла результатов")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+
+    for sub in (run_parser, compare_parser):
+        sub.add_argument('--threshold', type=float, default=0.25, help="допустимое замедление медианы")
+        sub.add_argument('--floor-ms', type=float, default=0.05, help="меньшие абсолютные изменения - шум")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.action == 'run':
+        current = run(args)
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.output}")
+        baseline_path = args.baseline
+    else:
+        with open(args.current, encoding='utf-8') as f:
+            current = json.load(f)
+        baseline_path = args.baseline
+
+    if baseline_path:
+        with open(baseline_path, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, current, args.threshold, args.floor_ms)
+        if regressions:
+            sys.exit(f"Регрессий: {len(regressions)}")
+
+if __name__ == '__main__':
+    main()
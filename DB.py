@@ -1,15 +1,76 @@
 import sqlite3
 import pickle
+import time
 import logging
+from array import array
 from Message import Message
 from typing import Union
 
 logger = logging.getLogger(__name__)
 
+# Действия в журнале голосов: итоговое состояние голоса пользователя
+VOTE_NONE = 0
+VOTE_PARTICIPATE = 1
+VOTE_MAYBE = 2
+VOTE_RESET = 3  # еженедельный сброс состава, user_id = 0
+
+STATUS_BY_VOTE = {VOTE_PARTICIPATE: 'participate', VOTE_MAYBE: 'maybe'}
+
+WEEK_DAYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+# Старшие биты id мероприятия хранят номер шарда (см. Sharding.py)
+SHARD_ID_BITS = 40
+
 class Database:
-    def __init__(self, db_name='mtg_bot.db'):
+    MESSAGE_COLUMNS = 'id, chat_id, text, date, day_of_week, time, links, image, pin_id, trigger, message_thread_id, media_id, pin_media'
+
+    # Состав мероприятия в порядке голосования, имена берутся из users
+    ROSTER_QUERY = '''
+    SELECT p.user_id, u.username, u.full_name, p.status
+    FROM participants p
+    LEFT JOIN users u ON u.id = p.user_id
+    WHERE p.message_id = ?
+    ORDER BY p.rowid
+    '''
+
+    def __init__(self, db_name='mtg_bot.db', shard: int = None):
+        self.db_name = db_name
         self.conn = sqlite3.connect(db_name)
+        # Составы, копии и состояние мероприятия удаляются вместе с ним (ON DELETE CASCADE)
+        self.conn.execute('PRAGMA foreign_keys = ON')
+        # Действует только для новой пустой базы, существующие переводит create_migration.py
+        self.conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        self.fts_enabled = False
         self.create_tables()
+        self.check_cascades()
+        if shard:
+            self.seed_shard_ids(shard)
+
+    # Таблицы, строки которых удаляются вместе с мероприятием по внешнему ключу
+    CASCADE_TABLES = ('participants', 'message_posts', 'event_health', 'event_stats', 'event_user_stats')
+
+    def check_cascades(self) -> None:
+        """CREATE TABLE IF NOT EXISTS не меняет существующие таблицы: в базе без шага 8
+        create_migration.py удаление мероприятия оставляло бы составы навсегда"""
+        cursor = self.conn.cursor()
+        for table in self.CASCADE_TABLES:
+            cursor.execute(f'PRAGMA foreign_key_list({table})')
+            if not any(row[2] == 'messages' and row[6] == 'CASCADE' for row in cursor.fetchall()):
+                raise RuntimeError(f"У таблицы {table} нет ON DELETE CASCADE: запустите create_migration.py")
+
+    def seed_shard_ids(self, shard: int) -> None:
+        """Сдвигает AUTOINCREMENT, чтобы id мероприятий разных шардов не пересекались"""
+        with self.conn:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'messages'")
+            row = cursor.fetchone()
+            if row is None:
+                cursor.execute(
+                    "INSERT INTO sqlite_sequence (name, seq) VALUES ('messages', ?)",
+                    (shard << SHARD_ID_BITS,)
+                )
+            elif row[0] >> SHARD_ID_BITS != shard:
+                raise ValueError(f"База данных не принадлежит шарду {shard}")
 
     def create_tables(self):
         cursor = self.conn.cursor()
@@ -24,6 +85,17 @@ class Database:
         )
         ''')
         
+        # Картинки мероприятий: хранится только file_id, полученный от Telegram.
+        # content_key - file_unique_id загруженного фото или 'url:<ссылка>', одинаковое содержимое - одна строка
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS media (
+            id INTEGER PRIMARY KEY,
+            content_key TEXT NOT NULL UNIQUE,
+            file_id TEXT NOT NULL,
+            kind TEXT NOT NULL DEFAULT 'photo'
+        )
+        ''')
+        
         # Таблица для сообщений с поддержкой топиков
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS messages (
@@ -37,7 +109,38 @@ class Database:
             links TEXT,
             image BLOB,
             pin_id INTEGER,
-            trigger BLOB
+            trigger BLOB,
+            media_id INTEGER REFERENCES media(id),
+            pin_media INTEGER NOT NULL DEFAULT 0,
+            participate_count INTEGER NOT NULL DEFAULT 0,
+            maybe_count INTEGER NOT NULL DEFAULT 0
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages(chat_id)')
+        
+        # Копии мероприятия в других чатах: состав общий, у каждой копии своё закреплённое сообщение.
+        # Основная копия по-прежнему описывается полями chat_id/message_thread_id/pin_id в messages
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS message_posts (
+            message_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_thread_id INTEGER,
+            pin_id INTEGER,
+            pin_media INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(message_id) REFERENCES messages(id) ON DELETE CASCADE,
+            PRIMARY KEY(message_id, chat_id)
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_message_posts_chat ON message_posts(chat_id)')
+        
+        # Пользователи хранятся один раз, составы мероприятий ссылаются на них по id.
+        # Внешнего ключа на users у participants нет: при шардировании пользователи
+        # живут на домашнем шарде, а составы - на шарде мероприятия
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            full_name TEXT
         )
         ''')
         
@@ -45,17 +148,190 @@ class Database:
         CREATE TABLE IF NOT EXISTS participants (
             message_id INTEGER,
             user_id INTEGER,
-            username TEXT,
-            full_name TEXT,
             status TEXT, 
-            FOREIGN KEY(message_id) REFERENCES messages(id),
+            FOREIGN KEY(message_id) REFERENCES messages(id) ON DELETE CASCADE,
+            PRIMARY KEY(message_id, user_id)
+        )
+        ''')
+        # Страница состава читается по индексу: внутри статуса записи упорядочены по rowid
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_participants_status ON participants(message_id, status)')
+
+        # Журнал голосов: только добавление, старые записи сворачиваются в roster_snapshots
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS vote_journal (
+            id INTEGER PRIMARY KEY,
+            message_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            action INTEGER NOT NULL,
+            ts INTEGER NOT NULL
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_vote_journal_message ON vote_journal(message_id, id)')
+        
+        # Состав мероприятия на момент последнего сворачивания журнала
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS roster_snapshots (
+            message_id INTEGER PRIMARY KEY,
+            journal_id INTEGER NOT NULL,
+            ts INTEGER NOT NULL,
+            roster BLOB NOT NULL
+        )
+        ''')
+
+        # Агрегаты посещаемости, обновляются при закрытии каждой встречи (reset_roster)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS event_stats (
+            message_id INTEGER PRIMARY KEY REFERENCES messages(id) ON DELETE CASCADE,
+            occurrences INTEGER NOT NULL DEFAULT 0,
+            attended_total INTEGER NOT NULL DEFAULT 0,
+            maybe_total INTEGER NOT NULL DEFAULT 0,
+            last_occurrence INTEGER
+        )
+        ''')
+        
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS event_user_stats (
+            message_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            attended INTEGER NOT NULL DEFAULT 0,
+            maybe INTEGER NOT NULL DEFAULT 0,
+            streak INTEGER NOT NULL DEFAULT 0,
+            best_streak INTEGER NOT NULL DEFAULT 0,
+            last_seen INTEGER,
+            FOREIGN KEY(message_id) REFERENCES messages(id) ON DELETE CASCADE,
             PRIMARY KEY(message_id, user_id)
         )
         ''')
         
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS user_stats (
+            chat_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            attended INTEGER NOT NULL DEFAULT 0,
+            maybe INTEGER NOT NULL DEFAULT 0,
+            streak INTEGER NOT NULL DEFAULT 0,
+            best_streak INTEGER NOT NULL DEFAULT 0,
+            last_seen INTEGER,
+            PRIMARY KEY(chat_id, user_id)
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_user_stats_top ON user_stats(chat_id, attended DESC)')
+
+        # Полнотекстовый индекс по тексту и ссылкам мероприятий (rowid = messages.id)
+        try:
+            cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                text, links, tokenize = 'unicode61 remove_diacritics 2'
+            )
+            ''')
+            self.fts_enabled = True
+        except sqlite3.OperationalError as e:
+            logger.warning(f"[DATABASE] FTS5 недоступен, поиск будет работать через LIKE: {e}")
+
+        # Доставка и активность мероприятия: неудачные отправки подряд и последняя встреча с участниками
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS event_health (
+            message_id INTEGER PRIMARY KEY REFERENCES messages(id) ON DELETE CASCADE,
+            send_failures INTEGER NOT NULL DEFAULT 0,
+            last_failure INTEGER,
+            last_activity INTEGER NOT NULL
+        )
+        ''')
+
+        # Холодный архив: мероприятия, которые не отправляются или заброшены.
+        # Не загружаются при старте и не занимают планировщик, возвращаются командой /restore
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archived_messages (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            message_thread_id INTEGER,
+            text TEXT NOT NULL,
+            date TEXT,
+            day_of_week TEXT,
+            time TEXT,
+            links TEXT,
+            image BLOB,
+            pin_id INTEGER,
+            trigger BLOB,
+            media_id INTEGER,
+            pin_media INTEGER NOT NULL DEFAULT 0,
+            archived_at INTEGER NOT NULL,
+            reason TEXT NOT NULL
+        )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_archived_messages_chat ON archived_messages(chat_id)')
+        
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archived_participants (
+            message_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            status TEXT,
+            PRIMARY KEY(message_id, user_id)
+        )
+        ''')
+        
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS archived_message_posts (
+            message_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_thread_id INTEGER,
+            pin_id INTEGER,
+            pin_media INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(message_id, chat_id)
+        )
+        ''')
+
+        # Служебное состояние процесса (offset обновлений, отметка планировщика и т.п.)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bot_state (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        )
+        ''')
+
+        # Сессии админ-панели: незаконченные мастера переживают перезапуск
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS admin_sessions (
+            admin_id INTEGER PRIMARY KEY,
+            state TEXT NOT NULL,
+            db_id INTEGER,
+            edit_id INTEGER,
+            draft_day TEXT,
+            draft_time TEXT,
+            search_query TEXT,
+            topic_chat INTEGER,
+            expires REAL NOT NULL
+        )
+        ''')
+
+        # Блокировка экземпляра бота: одновременно работает только один процесс
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS instance_lock (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            owner TEXT,
+            heartbeat REAL,
+            handoff_to TEXT
+        )
+        ''')
+
         self.conn.commit()
+        
+        if self.fts_enabled:
+            self.rebuild_search_index(only_if_empty=True)
+
+    def rebuild_search_index(self, only_if_empty: bool = False) -> None:
+        """Заполняет полнотекстовый индекс по всем мероприятиям"""
+        with self.conn:
+            cursor = self.conn.cursor()
+            if only_if_empty:
+                cursor.execute('SELECT EXISTS (SELECT 1 FROM messages_fts)')
+                if cursor.fetchone()[0]:
+                    return
+            cursor.execute('DELETE FROM messages_fts')
+            cursor.execute('INSERT INTO messages_fts (rowid, text, links) SELECT id, text, links FROM messages')
 
     def save_message(self, message):
+        """Сохраняет поля мероприятия (без состава участников)"""
         cursor = self.conn.cursor()
         
         # Сериализуем триггер
@@ -66,46 +342,41 @@ class Database:
             cursor.execute('''
             UPDATE messages SET
                 chat_id=?, text=?, date=?, day_of_week=?,
-                time=?, links=?, image=?, pin_id=?, trigger=?, message_thread_id=?
+                time=?, links=?, image=?, pin_id=?, trigger=?, message_thread_id=?,
+                media_id=?, pin_media=?
             WHERE id=?
             ''', (
                 message.chat_id, message.text, message.date,
                 message.day_of_week, message.time, message.links, message.image,
-                message.pin_id, trigger_data, message.message_thread_id, message.db_id
+                message.pin_id, trigger_data, message.message_thread_id,
+                message.media_id, int(message.pin_media), message.db_id
             ))
         else:
             # Добавляем новое сообщение - ВАЖНО: message_thread_id теперь последний
             cursor.execute('''
-            INSERT INTO messages (chat_id, text, date, day_of_week, time, links, image, pin_id, trigger, message_thread_id)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            INSERT INTO messages (chat_id, text, date, day_of_week, time, links, image, pin_id, trigger, message_thread_id,
+                                  media_id, pin_media)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (
                 message.chat_id, message.text, message.date,
                 message.day_of_week, message.time, message.links, message.image,
-                message.pin_id, trigger_data, message.message_thread_id
+                message.pin_id, trigger_data, message.message_thread_id,
+                message.media_id, int(message.pin_media)
             ))
             message.db_id = cursor.lastrowid
         
-        # ВАЖНО: Удаляем всех старых участников перед добавлением новых
-        cursor.execute('DELETE FROM participants WHERE message_id=?', (message.db_id,))
-        
-        for user in message.participants:
-            cursor.execute('''
-            INSERT INTO participants (message_id, user_id, username, full_name, status)
-            VALUES (?, ?, ?, ?, ?)
-            ''', (
-                message.db_id, user['id'], user.get('username'), user.get('full_name'),
-                'participate'
-            ))
-        
-        for user in message.maybe_participants:
-            cursor.execute('''
-            INSERT INTO participants (message_id, user_id, username, full_name, status)
-            VALUES (?, ?, ?, ?, ?)
-            ''', (
-                message.db_id, user['id'], user.get('username'), user.get('full_name'),
-                'maybe'
-            ))
+        if self.fts_enabled:
+            # Индекс переписываем, только если текст или ссылки действительно изменились
+            cursor.execute('SELECT text, links FROM messages_fts WHERE rowid=?', (message.db_id,))
+            if cursor.fetchone() != (message.text, message.links):
+                cursor.execute('DELETE FROM messages_fts WHERE rowid=?', (message.db_id,))
+                cursor.execute('''
+                INSERT INTO messages_fts (rowid, text, links) VALUES (?, ?, ?)
+                ''', (message.db_id, message.text, message.links))
         
+        # Состав здесь не перезаписывается: он меняется только через журнал
+        # голосов (record_vote / reset_roster), иначе устаревший объект Message
+        # из админ-панели затёр бы голоса, поданные после его загрузки
         self.conn.commit()
         return message
 
@@ -122,7 +393,7 @@ class Database:
             admin_chats = cursor.fetchall()
             
             if not admin_chats:
-                logger.info(f"[DATABASE] Admin {admin_id} has no chats")
+                logger.debug("[DATABASE] Admin %s has no chats", admin_id)
                 return []
             
             # Формируем список chat_id для запроса
@@ -132,7 +403,7 @@ class Database:
             placeholders = ','.join('?' * len(chat_ids))
             query = f'''
                 SELECT id, chat_id, message_thread_id, text, date, day_of_week, 
-                    time, links, image, pin_id, trigger
+                    time, links, image, pin_id, trigger, participate_count, maybe_count
                 FROM messages 
                 WHERE chat_id IN ({placeholders})
                 ORDER BY id DESC
@@ -144,16 +415,9 @@ class Database:
             messages = []
             for row in rows:
                 try:
-                    # Распаковываем 11 полей
+                    # Распаковываем 13 полей. Состав не читается: хватает счётчиков
                     message_id, chat_id, message_thread_id, text, date, day_of_week, \
-                    time, links, image, pin_id, trigger_data = row
-                    
-                    # Загружаем участников для этого мероприятия
-                    cursor.execute('''
-                        SELECT user_id FROM participants WHERE message_id = ?
-                    ''', (message_id,))
-                    
-                    participants = [row[0] for row in cursor.fetchall()]
+                    time, links, image, pin_id, trigger_data, participate_count, maybe_count = row
                     
                     # Обрабатываем триггер (с защитой от ошибок)
                     trigger = None
@@ -176,8 +440,9 @@ class Database:
                         'links': links,
                         'image': image,
                         'pin_id': pin_id,
-                        'participants': participants,
-                        'participants_count': len(participants),
+                        'participate_count': participate_count,
+                        'maybe_count': maybe_count,
+                        'participants_count': participate_count + maybe_count,
                         'trigger': trigger
                     })
                     
@@ -185,13 +450,25 @@ class Database:
                     logger.error(f"Error processing row: {e}")
                     continue
             
-            logger.info(f"[DATABASE] Loaded {len(messages)} messages for admin {admin_id}")
+            logger.debug("[DATABASE] Loaded %s messages for admin %s", len(messages), admin_id)
             return messages
             
         except Exception as e:
             logger.error(f"[DATABASE] Error in load_messages: {e}")
             return []
 
+    def upsert_user(self, user) -> None:
+        """Сохраняет имя пользователя Telegram. Строка перезаписывается только при переименовании"""
+        with self.conn:
+            self.conn.execute('''
+            INSERT INTO users (id, username, full_name) VALUES (?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                username = excluded.username,
+                full_name = excluded.full_name
+            WHERE users.username IS NOT excluded.username
+               OR users.full_name IS NOT excluded.full_name
+            ''', (user.id, user.username, user.full_name))
+
     def user_has_chats(self, admin_id):
         """Проверяет, есть ли у пользователя привязанные чаты"""
         try:
@@ -204,30 +481,30 @@ class Database:
             return False
 
     def delete_message(self, db_id):
+        """Удаляет мероприятие. Состав, копии, состояние и статистика удаляются каскадом"""
         cursor = self.conn.cursor()
         cursor.execute('DELETE FROM messages WHERE id=?', (db_id,))
-        cursor.execute('DELETE FROM participants WHERE message_id=?', (db_id,))
+        if self.fts_enabled:
+            cursor.execute('DELETE FROM messages_fts WHERE rowid=?', (db_id,))
         self.conn.commit()
 
-    def load_message(self, db_id):
-        """Загружает сообщение по id или вызывает исключение, если не найдено"""
+    def load_message(self, db_id, with_roster: bool = True):
+        """Загружает сообщение по id или вызывает исключение, если не найдено.
+        Без with_roster состав не читается, вместо него - счётчики message.counts"""
         cursor = self.conn.cursor()
         
-        # Ищем сообщение в базе - все 11 полей
-        cursor.execute('SELECT * FROM messages WHERE id=?', (db_id,))
+        # Ищем сообщение в базе - все 11 полей.
+        # Столбцы перечислены явно: в новых базах message_thread_id идёт третьим, в мигрированных - последним
+        cursor.execute(f'SELECT {self.MESSAGE_COLUMNS}, participate_count, maybe_count FROM messages WHERE id=?', (db_id,))
         
         message_data = cursor.fetchone()
         
         if not message_data:
             raise ValueError(f"Сообщение с ID {db_id} не найдено")
         
-        # Распаковываем данные сообщения - 11 значений
-        if len(message_data) == 11:
-            db_id, chat_id, text, date, day_of_week, time, links, image, pin_id, trigger_data, message_thread_id = message_data
-        else:
-            # Для обратной совместимости
-            db_id, chat_id, text, date, day_of_week, time, links, image, pin_id, trigger_data = message_data
-            message_thread_id = None
+        # Распаковываем данные сообщения - 13 значений и счётчики
+        db_id, chat_id, text, date, day_of_week, time, links, image, pin_id, trigger_data, message_thread_id, \
+            media_id, pin_media, participate_count, maybe_count = message_data
         
         # Создаем объект Message
         message = Message()
@@ -240,15 +517,17 @@ class Database:
         message.time = time
         message.links = links
         message.image = image
+        message.media_id = media_id
         message.pin_id = pin_id
+        message.pin_media = bool(pin_media)
         message.trigger = pickle.loads(trigger_data) if trigger_data else None
         
+        if not with_roster:
+            message.counts = (participate_count, maybe_count)
+            return message
+        
         # Загружаем участников
-        cursor.execute('''
-        SELECT user_id, username, full_name, status 
-        FROM participants 
-        WHERE message_id=?
-        ''', (db_id,))
+        cursor.execute(self.ROSTER_QUERY, (db_id,))
         
         for user_id, username, full_name, status in cursor.fetchall():
             user = {
@@ -264,6 +543,97 @@ class Database:
         
         return message
 
+    def get_roster_page(self, db_id: int, offset: int, limit: int) -> tuple:
+        """Страница состава: ([(user_id, username, full_name, status), ...], всего участников).
+        Сначала участвующие, затем «возможно», внутри - в порядке голосования.
+        Каждый статус читается по idx_participants_status без сортировки всего состава"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT participate_count, maybe_count FROM messages WHERE id = ?', (db_id,))
+        participate, maybe = cursor.fetchone() or (0, 0)
+        rows = []
+        for status, skip in (('participate', offset), ('maybe', max(0, offset - participate))):
+            if len(rows) == limit:
+                break
+            cursor.execute('''
+            SELECT p.user_id, u.username, u.full_name, p.status
+            FROM participants p INDEXED BY idx_participants_status
+            LEFT JOIN users u ON u.id = p.user_id
+            WHERE p.message_id = ? AND p.status = ?
+            ORDER BY p.rowid
+            LIMIT ? OFFSET ?
+            ''', (db_id, status, limit - len(rows), skip))
+            rows.extend(cursor.fetchall())
+        return rows, participate + maybe
+
+    # Копии мероприятия в других чатах
+
+    def get_message_posts(self, db_id: int) -> list:
+        """Копии мероприятия: [(chat_id, message_thread_id, pin_id, pin_media), ...]"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        SELECT chat_id, message_thread_id, pin_id, pin_media FROM message_posts
+        WHERE message_id = ? ORDER BY chat_id
+        ''', (db_id,))
+        return [(chat_id, thread_id, pin_id, bool(pin_media)) for chat_id, thread_id, pin_id, pin_media in cursor.fetchall()]
+
+    def add_message_post(self, db_id: int, chat_id: int, thread_id: int = None) -> bool:
+        """Добавляет копию мероприятия в чат. False - копия в этом чате уже есть"""
+        with self.conn:
+            cursor = self.conn.cursor()
+            cursor.execute('''
+            INSERT OR IGNORE INTO message_posts (message_id, chat_id, message_thread_id) VALUES (?, ?, ?)
+            ''', (db_id, chat_id, thread_id))
+            return cursor.rowcount > 0
+
+    def remove_message_post(self, db_id: int, chat_id: int) -> Union[int, None]:
+        """Убирает копию мероприятия из чата. Возвращает id её закреплённого сообщения"""
+        with self.conn:
+            cursor = self.conn.cursor()
+            cursor.execute('SELECT pin_id FROM message_posts WHERE message_id=? AND chat_id=?', (db_id, chat_id))
+            row = cursor.fetchone()
+            cursor.execute('DELETE FROM message_posts WHERE message_id=? AND chat_id=?', (db_id, chat_id))
+            return row[0] if row else None
+
+    def save_post_pins(self, db_id: int, pins: list) -> None:
+        """Запоминает закреплённые сообщения копий: [(chat_id, pin_id, pin_media), ...]"""
+        with self.conn:
+            self.conn.executemany('''
+            UPDATE message_posts SET pin_id = ?, pin_media = ? WHERE message_id = ? AND chat_id = ?
+            ''', [(pin_id, int(pin_media), db_id, chat_id) for chat_id, pin_id, pin_media in pins])
+
+    # Картинки мероприятий
+
+    def _ensure_media(self, cursor, content_key: str, file_id: str, kind: str) -> int:
+        cursor.execute('''
+        INSERT OR IGNORE INTO media (content_key, file_id, kind) VALUES (?, ?, ?)
+        ''', (content_key, file_id, kind))
+        cursor.execute('SELECT id FROM media WHERE content_key=?', (content_key,))
+        return cursor.fetchone()[0]
+
+    def get_or_create_media(self, content_key: str, file_id: str, kind: str = 'photo') -> int:
+        """Возвращает id картинки по ключу содержимого, создавая запись при первом обращении"""
+        with self.conn:
+            return self._ensure_media(self.conn.cursor(), content_key, file_id, kind)
+
+    def attach_media(self, db_id: int, content_key: str, file_id: str, kind: str = 'photo') -> int:
+        """Привязывает картинку к мероприятию. Повторная загрузка того же фото новую строку не создаёт"""
+        with self.conn:
+            cursor = self.conn.cursor()
+            media_id = self._ensure_media(cursor, content_key, file_id, kind)
+            cursor.execute('UPDATE messages SET media_id=? WHERE id=?', (media_id, db_id))
+            return media_id
+
+    def get_media(self, media_id: int) -> Union[tuple, None]:
+        """(file_id, kind) картинки или None"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT file_id, kind FROM media WHERE id=?', (media_id,))
+        return cursor.fetchone()
+
+    def update_media_file_id(self, media_id: int, file_id: str) -> None:
+        """Заменяет ссылку на file_id, который Telegram вернул после первой отправки"""
+        with self.conn:
+            self.conn.execute('UPDATE media SET file_id=? WHERE id=?', (file_id, media_id))
+
     # Обработка админов
 
     def set_chat_admin(self, chat_id: int, admin_id: int, default_thread_id: int = None) -> bool:
@@ -303,6 +673,20 @@ class Database:
             ''', (chat_id, admin_id))
             return True
 
+    def remove_chat_admin(self, chat_id: int, admin_id: int) -> bool:
+        """Отзывает права админа бота в чате. True - запись была"""
+        with self.conn:
+            cursor = self.conn.cursor()
+            cursor.execute('DELETE FROM chat_admins WHERE chat_id=? AND admin_id=?', (chat_id, admin_id))
+            return cursor.rowcount > 0
+
+    def get_event_chat(self, db_id: int) -> Union[int, None]:
+        """Чат мероприятия или None, если мероприятия нет"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT chat_id FROM messages WHERE id=?', (db_id,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
     def get_admin_chat(self, admin_id: int) -> Union[str , None]:
         """Возвращает chat_id для админа или None"""
         cursor = self.conn.cursor()
@@ -317,17 +701,15 @@ class Database:
         return [row[0] for row in cursor.fetchall()]
     
     def init_load_all(self):
+        """Все мероприятия для планировщика. Составы не читаются, только счётчики"""
         cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM messages')
+        cursor.execute(f'SELECT {self.MESSAGE_COLUMNS}, participate_count, maybe_count FROM messages')
         messages = []
         
         for row in cursor.fetchall():
-            # Теперь 11 полей, message_thread_id - последний
-            if len(row) == 11:
-                db_id, chat_id, text, date, day_of_week, time, links, image, pin_id, trigger_data, message_thread_id = row
-            else:
-                db_id, chat_id, text, date, day_of_week, time, links, image, pin_id, trigger_data = row
-                message_thread_id = None
+            # 13 полей, message_thread_id - одиннадцатый, затем счётчики
+            db_id, chat_id, text, date, day_of_week, time, links, image, pin_id, trigger_data, message_thread_id, \
+                media_id, pin_media, participate_count, maybe_count = row
             
             # Десериализуем триггер
             trigger = pickle.loads(trigger_data) if trigger_data else None
@@ -342,75 +724,96 @@ class Database:
             message.time = time
             message.links = links
             message.image = image
+            message.media_id = media_id
             message.pin_id = pin_id
+            message.pin_media = bool(pin_media)
             message.trigger = trigger
-            
-            # Загружаем участников
-            cursor.execute('''
-            SELECT user_id, username, full_name, status FROM participants
-            WHERE message_id=?
-            ''', (db_id,))
-            
-            for user_id, username, full_name, status in cursor.fetchall():
-                user = {
-                    'id': user_id,
-                    'username': username,
-                    'full_name': full_name
-                }
-                
-                if status == 'participate':
-                    message.participants.append(user)
-                else:
-                    message.maybe_participants.append(user)
+            message.counts = (participate_count, maybe_count)
             
             messages.append(message)
         
         return messages
 
-    def update_chat_id(self, prev_id, next_id):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            UPDATE messages SET chat_id=? WHERE chat_id=?
-            ''', (next_id, prev_id))
-        
-        cursor.execute('UPDATE chat_admins SET chat_id=? WHERE chat_id=?', 
-                  (next_id, prev_id))
-    
-        # Обновление в таблице participants (через связанные message_id)
-        cursor.execute('''
-        UPDATE participants 
-        SET message_id = (
-            SELECT m.id 
-            FROM messages m 
-            WHERE m.chat_id = ? AND m.id = participants.message_id
-        )
-        WHERE EXISTS (
-            SELECT 1 
-            FROM messages m 
-            WHERE m.chat_id = ? AND m.id = participants.message_id
-        )
-        ''', (next_id, next_id))
-        self.conn.commit()
+    def update_chat_id(self, prev_id, next_id) -> bool:
+        """Переносит данные чата на новый id после превращения группы в супергруппу.
+        Одна транзакция, по одному запросу на таблицу. Составы ссылаются на мероприятия
+        по id и не меняются. Возвращает False, если перенести не удалось"""
+        try:
+            with self.conn:
+                cursor = self.conn.cursor()
+                for table in ('messages', 'archived_messages'):
+                    cursor.execute(f'UPDATE {table} SET chat_id=? WHERE chat_id=?', (next_id, prev_id))
+                
+                # Если в новом чате уже есть такая же запись (например, /set_admin успели выполнить
+                # до миграции), она остаётся, а запись старого чата удаляется
+                for table in ('chat_admins', 'message_posts', 'archived_message_posts'):
+                    cursor.execute(f'UPDATE OR IGNORE {table} SET chat_id=? WHERE chat_id=?', (next_id, prev_id))
+                    cursor.execute(f'DELETE FROM {table} WHERE chat_id=?', (prev_id,))
+                
+                # Статистика посещаемости чата складывается со статистикой нового id
+                cursor.execute('''
+                INSERT INTO user_stats (chat_id, user_id, attended, maybe, streak, best_streak, last_seen)
+                SELECT ?, user_id, attended, maybe, streak, best_streak, last_seen FROM user_stats WHERE chat_id = ?
+                ON CONFLICT(chat_id, user_id) DO UPDATE SET
+                    attended = attended + excluded.attended,
+                    maybe = maybe + excluded.maybe,
+                    streak = MAX(streak, excluded.streak),
+                    best_streak = MAX(best_streak, excluded.best_streak),
+                    last_seen = MAX(COALESCE(last_seen, excluded.last_seen), COALESCE(excluded.last_seen, last_seen))
+                ''', (next_id, prev_id))
+                cursor.execute('DELETE FROM user_stats WHERE chat_id=?', (prev_id,))
+            return True
+        except sqlite3.Error as e:
+            logger.error(f"[DATABASE] Не удалось перенести чат {prev_id} -> {next_id}: {e}")
+            return False
 
-    def remove_chats_data(self, chat_id: int) -> None:
-        """Удаляет все данные, связанные с указанным чатом"""
-        cursor = self.conn.cursor()
-        
-        # Получаем все сообщения чата, чтобы удалить связанных участников
-        cursor.execute('SELECT id FROM messages WHERE chat_id=?', (chat_id,))
-        message_ids = [row[0] for row in cursor.fetchall()]
-        
-        # Удаляем участников всех сообщений чата
-        for message_id in message_ids:
-            cursor.execute('DELETE FROM participants WHERE message_id=?', (message_id,))
-        
-        # Удаляем сами сообщения чата
-        cursor.execute('DELETE FROM messages WHERE chat_id=?', (chat_id,))
-        
-        # Удаляем админов чата
-        cursor.execute('DELETE FROM chat_admins WHERE chat_id=?', (chat_id,))
-        
-        self.conn.commit()
+    def remove_chats_data(self, chat_id: int) -> list:
+        """Удаляет все данные, связанные с указанным чатом, одной транзакцией.
+        Мероприятие с копиями в других чатах не удаляется: основным становится
+        самая ранняя копия, состав остаётся общим. Копии, состояние и статистика
+        удаляемых мероприятий удаляются каскадом. Возвращает id удалённых мероприятий"""
+        with self.conn:
+            cursor = self.conn.cursor()
+            # Копия переносится в messages вместе с закреплённым сообщением и топиком
+            cursor.execute('''
+            UPDATE messages SET chat_id = post.chat_id, message_thread_id = post.message_thread_id,
+                                pin_id = post.pin_id, pin_media = post.pin_media
+            FROM (
+                SELECT message_id, chat_id, message_thread_id, pin_id, pin_media, MIN(rowid)
+                FROM message_posts
+                WHERE message_id IN (SELECT id FROM messages WHERE chat_id = ?) AND chat_id != ?
+                GROUP BY message_id
+            ) AS post
+            WHERE messages.id = post.message_id
+            RETURNING messages.id, messages.chat_id
+            ''', (chat_id, chat_id))
+            cursor.executemany('DELETE FROM message_posts WHERE message_id=? AND chat_id=?', cursor.fetchall())
+            
+            # id нужны вызывающему: задачи планировщика и кэши в памяти
+            cursor.execute('SELECT id FROM messages WHERE chat_id=?', (chat_id,))
+            message_ids = [row[0] for row in cursor.fetchall()]
+            
+            # Составы одним запросом: каскад удалял бы их отдельно на каждое мероприятие
+            cursor.execute('DELETE FROM participants WHERE message_id IN (SELECT id FROM messages WHERE chat_id=?)', (chat_id,))
+            if self.fts_enabled:
+                cursor.execute('DELETE FROM messages_fts WHERE rowid IN (SELECT id FROM messages WHERE chat_id=?)', (chat_id,))
+            cursor.execute('DELETE FROM messages WHERE chat_id=?', (chat_id,))
+            
+            # Копии мероприятий других чатов, опубликованные в этом чате
+            cursor.execute('DELETE FROM message_posts WHERE chat_id=?', (chat_id,))
+            
+            # Архивные мероприятия чата: вернуть их в чат, откуда бот удалён, уже нельзя
+            cursor.execute('''
+            DELETE FROM archived_participants WHERE message_id IN (SELECT id FROM archived_messages WHERE chat_id=?)
+            ''', (chat_id,))
+            cursor.execute('''
+            DELETE FROM archived_message_posts WHERE message_id IN (SELECT id FROM archived_messages WHERE chat_id=?)
+            ''', (chat_id,))
+            cursor.execute('DELETE FROM archived_messages WHERE chat_id=?', (chat_id,))
+            cursor.execute('DELETE FROM archived_message_posts WHERE chat_id=?', (chat_id,))
+            
+            cursor.execute('DELETE FROM chat_admins WHERE chat_id=?', (chat_id,))
+        return message_ids
 
     def get_admin_chats(self, admin_id: int) -> list:
         """Возвращает список чатов, где пользователь является админом"""
@@ -437,4 +840,667 @@ class Database:
             SET default_thread_id = ?
             WHERE chat_id = ? AND admin_id = ?
             ''', (thread_id, chat_id, admin_id))
-            return cursor.rowcount > 0
\ No newline at end of file
+            return cursor.rowcount > 0
+
+    # Состояние процесса и передача работы между экземплярами
+
+    def get_state(self, key: str, default=None):
+        """Возвращает значение служебного ключа или default"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT value FROM bot_state WHERE key=?', (key,))
+        row = cursor.fetchone()
+        return row[0] if row else default
+
+    def set_states(self, values: dict) -> None:
+        """Сохраняет несколько служебных ключей одной транзакцией"""
+        with self.conn:
+            self.conn.executemany('''
+            INSERT INTO bot_state (key, value) VALUES (?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value
+            ''', [(key, str(value)) for key, value in values.items()])
+
+    def load_session(self, admin_id: int) -> Union[tuple, None]:
+        """Строка сессии админа в порядке AdminSession.FIELDS или None"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        SELECT admin_id, state, db_id, edit_id, draft_day, draft_time, search_query, topic_chat, expires
+        FROM admin_sessions WHERE admin_id=?
+        ''', (admin_id,))
+        return cursor.fetchone()
+
+    def save_sessions(self, rows: list, expired_before: float = None) -> None:
+        """Сохраняет сессии одной транзакцией, заодно удаляя истёкшие"""
+        with self.conn:
+            self.conn.executemany('''
+            INSERT OR REPLACE INTO admin_sessions
+                (admin_id, state, db_id, edit_id, draft_day, draft_time, search_query, topic_chat, expires)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            if expired_before is not None:
+                self.conn.execute('DELETE FROM admin_sessions WHERE expires <= ?', (expired_before,))
+
+    def try_acquire_lock(self, owner: str, now: float, stale_after: float) -> bool:
+        """Пытается захватить блокировку экземпляра.
+        Если она занята живым процессом - просит его передать работу и возвращает False"""
+        cursor = self.conn.cursor()
+        # BEGIN IMMEDIATE, чтобы два новых экземпляра не захватили блокировку одновременно
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            cursor.execute('SELECT owner, heartbeat FROM instance_lock WHERE id = 1')
+            row = cursor.fetchone()
+            
+            if row and row[0] and row[0] != owner and now - (row[1] or 0) < stale_after:
+                cursor.execute('UPDATE instance_lock SET handoff_to = ? WHERE id = 1', (owner,))
+                acquired = False
+            else:
+                cursor.execute('''
+                INSERT INTO instance_lock (id, owner, heartbeat, handoff_to) VALUES (1, ?, ?, NULL)
+                ON CONFLICT(id) DO UPDATE SET owner = excluded.owner,
+                    heartbeat = excluded.heartbeat, handoff_to = NULL
+                ''', (owner, now))
+                acquired = True
+            self.conn.commit()
+            return acquired
+        except Exception:
+            self.conn.rollback()
+            raise
+
+    def heartbeat_lock(self, owner: str, now: float) -> Union[str, None]:
+        """Продлевает блокировку. Возвращает id экземпляра, ожидающего передачи работы,
+        или сам owner, если блокировка уже потеряна"""
+        with self.conn:
+            cursor = self.conn.cursor()
+            cursor.execute('UPDATE instance_lock SET heartbeat = ? WHERE id = 1 AND owner = ?', (now, owner))
+            if cursor.rowcount == 0:
+                return owner
+            cursor.execute('SELECT handoff_to FROM instance_lock WHERE id = 1')
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def release_lock(self, owner: str) -> None:
+        """Освобождает блокировку, если она принадлежит owner"""
+        with self.conn:
+            self.conn.execute('''
+            UPDATE instance_lock SET owner = NULL, heartbeat = NULL
+            WHERE id = 1 AND owner = ?
+            ''', (owner,))
+
+    # Журнал голосов
+
+    def record_vote(self, db_id: int, user_id: int, action: int, toggle: bool = False) -> Union[tuple, None]:
+        """Записывает голос в журнал и применяет его к составу и счётчикам одной транзакцией.
+        С toggle повторный такой же голос снимает его - как повторное нажатие кнопки.
+        Возвращает новые счётчики (участвуют, возможно) или None, если мероприятия нет"""
+        with self.conn:
+            cursor = self.conn.cursor()
+            # Удаляем и вставляем заново: сменивший статус попадает в конец списка
+            cursor.execute('DELETE FROM participants WHERE message_id=? AND user_id=? RETURNING status', (db_id, user_id))
+            previous = cursor.fetchone()
+            status = STATUS_BY_VOTE.get(action)
+            if toggle and previous and previous[0] == status:
+                action, status = VOTE_NONE, None
+            cursor.execute('''
+            INSERT INTO vote_journal (message_id, user_id, action, ts) VALUES (?, ?, ?, ?)
+            ''', (db_id, user_id, action, int(time.time())))
+            if status:
+                cursor.execute('''
+                INSERT INTO participants (message_id, user_id, status) VALUES (?, ?, ?)
+                ''', (db_id, user_id, status))
+            
+            delta = {'participate': 0, 'maybe': 0}
+            if previous:
+                delta[previous[0]] -= 1
+            if status:
+                delta[status] += 1
+            cursor.execute('''
+            UPDATE messages SET participate_count = participate_count + ?, maybe_count = maybe_count + ?
+            WHERE id = ?
+            RETURNING participate_count, maybe_count
+            ''', (delta['participate'], delta['maybe'], db_id))
+            return cursor.fetchone()
+
+    def reset_roster(self, db_id: int) -> None:
+        """Закрывает встречу: учитывает состав в статистике посещаемости и очищает его
+        перед новой неделей. Сброс тоже попадает в журнал"""
+        now = int(time.time())
+        with self.conn:
+            cursor = self.conn.cursor()
+            self._close_occurrence_stats(cursor, db_id, now)
+            # Активность - встреча, на которую кто-то записался. Отсчёт простоя начинается с первой встречи
+            cursor.execute('''
+            INSERT INTO event_health (message_id, last_activity) VALUES (?, ?)
+            ON CONFLICT(message_id) DO UPDATE SET last_activity = excluded.last_activity
+            WHERE EXISTS (SELECT 1 FROM participants WHERE message_id = excluded.message_id)
+            ''', (db_id, now))
+            cursor.execute('''
+            INSERT INTO vote_journal (message_id, user_id, action, ts) VALUES (?, 0, ?, ?)
+            ''', (db_id, VOTE_RESET, now))
+            cursor.execute('DELETE FROM participants WHERE message_id=?', (db_id,))
+            cursor.execute('UPDATE messages SET participate_count = 0, maybe_count = 0 WHERE id=?', (db_id,))
+
+    def _close_occurrence_stats(self, cursor, db_id: int, now: int) -> None:
+        """Добавляет закрытую встречу к агрегатам посещаемости набором запросов по составу"""
+        # Серия прерывается у всех, кто в этот раз не пришёл
+        cursor.execute('''
+        UPDATE event_user_stats SET streak = 0
+        WHERE message_id = ? AND streak > 0 AND user_id NOT IN (
+            SELECT user_id FROM participants WHERE message_id = ? AND status = 'participate'
+        )
+        ''', (db_id, db_id))
+        
+        cursor.execute('''
+        INSERT INTO event_user_stats (message_id, user_id, attended, maybe, streak, best_streak, last_seen)
+        SELECT message_id, user_id, status = 'participate', status = 'maybe',
+               status = 'participate', status = 'participate', CASE WHEN status = 'participate' THEN ? END
+        FROM participants WHERE message_id = ?
+        ON CONFLICT(message_id, user_id) DO UPDATE SET
+            attended = attended + excluded.attended,
+            maybe = maybe + excluded.maybe,
+            streak = CASE WHEN excluded.attended THEN streak + 1 ELSE 0 END,
+            best_streak = MAX(best_streak, CASE WHEN excluded.attended THEN streak + 1 ELSE 0 END),
+            last_seen = COALESCE(excluded.last_seen, last_seen)
+        ''', (now, db_id))
+        
+        # Серия в чате - встречи подряд, на которые пользователь записался и пришёл.
+        # Встречи, где его нет в составе, серию в чате не прерывают: в чате бывают разные мероприятия
+        cursor.execute('''
+        INSERT INTO user_stats (chat_id, user_id, attended, maybe, streak, best_streak, last_seen)
+        SELECT m.chat_id, p.user_id, p.status = 'participate', p.status = 'maybe',
+               p.status = 'participate', e.best_streak, CASE WHEN p.status = 'participate' THEN ? END
+        FROM participants p
+        JOIN messages m ON m.id = p.message_id
+        JOIN event_user_stats e ON e.message_id = p.message_id AND e.user_id = p.user_id
+        WHERE p.message_id = ?
+        ON CONFLICT(chat_id, user_id) DO UPDATE SET
+            attended = attended + excluded.attended,
+            maybe = maybe + excluded.maybe,
+            streak = CASE WHEN excluded.attended THEN streak + 1 ELSE 0 END,
+            best_streak = MAX(best_streak, excluded.best_streak, CASE WHEN excluded.attended THEN streak + 1 ELSE 0 END),
+            last_seen = COALESCE(excluded.last_seen, last_seen)
+        ''', (now, db_id))
+        
+        cursor.execute('''
+        INSERT INTO event_stats (message_id, occurrences, attended_total, maybe_total, last_occurrence)
+        SELECT ?, 1,
+               COALESCE(SUM(status = 'participate'), 0), COALESCE(SUM(status = 'maybe'), 0), ?
+        FROM participants WHERE message_id = ?
+        ON CONFLICT(message_id) DO UPDATE SET
+            occurrences = occurrences + 1,
+            attended_total = attended_total + excluded.attended_total,
+            maybe_total = maybe_total + excluded.maybe_total,
+            last_occurrence = excluded.last_occurrence
+        ''', (db_id, now, db_id))
+
+    @staticmethod
+    def pack_roster(roster: dict) -> bytes:
+        """Кодирует состав {user_id: action} в порядке голосования: по 8 байт на участника"""
+        return array('q', (user_id << 2 | action for user_id, action in roster.items())).tobytes()
+
+    @staticmethod
+    def unpack_roster(data: bytes) -> dict:
+        packed = array('q')
+        packed.frombytes(data)
+        return {value >> 2: value & 3 for value in packed}
+
+    def replay_roster(self, db_id: int, until_ts: int = None) -> dict:
+        """Восстанавливает состав {user_id: action} на момент until_ts (по умолчанию - текущий)"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT journal_id, ts, roster FROM roster_snapshots WHERE message_id=?', (db_id,))
+        snapshot = cursor.fetchone()
+        
+        roster, journal_id = {}, 0
+        if snapshot:
+            journal_id, snapshot_ts, data = snapshot
+            if until_ts is not None and until_ts < snapshot_ts:
+                raise ValueError(f"Журнал мероприятия {db_id} до {snapshot_ts} уже свёрнут")
+            roster = self.unpack_roster(data)
+        
+        cursor.execute('''
+        SELECT user_id, action FROM vote_journal
+        WHERE message_id=? AND id>? AND ts<=?
+        ORDER BY id
+        ''', (db_id, journal_id, until_ts if until_ts is not None else int(time.time())))
+        
+        for user_id, action in cursor.fetchall():
+            if action == VOTE_RESET:
+                roster.clear()
+                continue
+            roster.pop(user_id, None)
+            if action in STATUS_BY_VOTE:
+                roster[user_id] = action
+        return roster
+
+    def roster_at(self, db_id: int, until_ts: int) -> Message:
+        """Состав мероприятия на момент until_ts в виде объекта Message"""
+        message = self.load_message(db_id)
+        roster = self.replay_roster(db_id, until_ts)
+        
+        cursor = self.conn.cursor()
+        names = {}
+        if roster:
+            placeholders = ','.join('?' * len(roster))
+            cursor.execute(f'SELECT id, username, full_name FROM users WHERE id IN ({placeholders})', list(roster))
+            names = {user_id: (username, full_name) for user_id, username, full_name in cursor.fetchall()}
+        
+        message.participants, message.maybe_participants = [], []
+        for user_id, action in roster.items():
+            username, full_name = names.get(user_id, (None, None))
+            user = {'id': user_id, 'username': username, 'full_name': full_name}
+            if action == VOTE_PARTICIPATE:
+                message.participants.append(user)
+            else:
+                message.maybe_participants.append(user)
+        return message
+
+    def compact_journal(self, before_ts: int) -> int:
+        """Сворачивает записи журнала старше before_ts в снимки составов.
+        Возвращает число удалённых записей"""
+        cursor = self.conn.cursor()
+        with self.conn:
+            # Журнал удалённых мероприятий не сворачиваем, а удаляем
+            cursor.execute('''
+            DELETE FROM vote_journal WHERE ts < ? AND message_id NOT IN (SELECT id FROM messages)
+            ''', (before_ts,))
+            compacted = cursor.rowcount
+            cursor.execute('DELETE FROM roster_snapshots WHERE message_id NOT IN (SELECT id FROM messages)')
+        
+        cursor.execute('''
+        SELECT message_id, MAX(id) FROM vote_journal WHERE ts < ? GROUP BY message_id
+        ''', (before_ts,))
+        
+        for db_id, last_id in cursor.fetchall():
+            with self.conn:
+                roster = self.replay_roster(db_id, before_ts - 1)
+                self.conn.execute('''
+                INSERT INTO roster_snapshots (message_id, journal_id, ts, roster) VALUES (?, ?, ?, ?)
+                ON CONFLICT(message_id) DO UPDATE SET journal_id = excluded.journal_id,
+                    ts = excluded.ts, roster = excluded.roster
+                ''', (db_id, last_id, before_ts - 1, self.pack_roster(roster)))
+                deleted = self.conn.execute('''
+                DELETE FROM vote_journal WHERE message_id=? AND id<=?
+                ''', (db_id, last_id))
+                compacted += deleted.rowcount
+        
+        logger.info(f"[DATABASE] Журнал голосов свёрнут: удалено {compacted} записей")
+        return compacted
+
+    # Статистика посещаемости
+
+    def get_event_stats(self, db_id: int) -> Union[tuple, None]:
+        """(встреч, всего пришло, всего «возможно», последняя встреча) или None"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        SELECT occurrences, attended_total, maybe_total, last_occurrence
+        FROM event_stats WHERE message_id = ?
+        ''', (db_id,))
+        return cursor.fetchone()
+
+    def get_user_stats(self, chat_id: int, user_id: int) -> Union[tuple, None]:
+        """(пришёл, «возможно», текущая серия, лучшая серия, последний визит) пользователя в чате или None"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        SELECT attended, maybe, streak, best_streak, last_seen
+        FROM user_stats WHERE chat_id = ? AND user_id = ?
+        ''', (chat_id, user_id))
+        return cursor.fetchone()
+
+    def get_top_attendees(self, chat_id: int, limit: int = 5) -> list:
+        """Самые частые участники чата: [(user_id, username, full_name, attended, streak, best_streak), ...]"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        SELECT s.user_id, u.username, u.full_name, s.attended, s.streak, s.best_streak
+        FROM user_stats s
+        LEFT JOIN users u ON u.id = s.user_id
+        WHERE s.chat_id = ?
+        ORDER BY s.attended DESC
+        LIMIT ?
+        ''', (chat_id, limit))
+        return cursor.fetchall()
+
+    # Поиск мероприятий
+
+    @staticmethod
+    def build_match_query(query: str) -> str:
+        """Превращает ввод пользователя в запрос FTS5: все слова, каждое как префикс"""
+        tokens = [token.replace('"', '""') for token in query.split()]
+        return ' '.join(f'"{token}"*' for token in tokens)
+
+    def search_messages(self, admin_id: int, query: str, limit: int = 10, offset: int = 0) -> list:
+        """Ищет мероприятия в чатах админа.
+        Возвращает [(id, chat_id, text, day_of_week, time), ...], новые первыми, как в message_list.
+        Сортировка по rowid идёт прямо по индексу FTS5 и не требует считать bm25 для всех совпадений"""
+        if not query.split():
+            return []
+        cursor = self.conn.cursor()
+        
+        if self.fts_enabled:
+            cursor.execute('''
+            SELECT m.id, m.chat_id, m.text, m.day_of_week, m.time
+            FROM messages_fts f
+            JOIN messages m ON m.id = f.rowid
+            WHERE messages_fts MATCH ?
+              AND m.chat_id IN (SELECT chat_id FROM chat_admins WHERE admin_id = ?)
+            ORDER BY f.rowid DESC
+            LIMIT ? OFFSET ?
+            ''', (self.build_match_query(query), admin_id, limit, offset))
+        else:
+            pattern = f"%{query.strip()}%"
+            cursor.execute('''
+            SELECT id, chat_id, text, day_of_week, time
+            FROM messages
+            WHERE (text LIKE ? OR links LIKE ?)
+              AND chat_id IN (SELECT chat_id FROM chat_admins WHERE admin_id = ?)
+            ORDER BY id DESC
+            LIMIT ? OFFSET ?
+            ''', (pattern, pattern, admin_id, limit, offset))
+        return cursor.fetchall()
+
+    # Массовые операции: каждая - одна транзакция
+
+    def _reschedule_rows(self, cursor, rows, new_slot) -> list:
+        """Пересчитывает день, время и триггер для строк (id, day_of_week, time).
+        new_slot(day, time) -> (day, time). Возвращает [(id, day, time, trigger), ...]"""
+        changed = []
+        for db_id, day_of_week, time_str in rows:
+            day, time_str = new_slot(day_of_week, time_str)
+            message = Message()
+            message.set_trigger(day, time_str)
+            changed.append((db_id, day, message.time, message.trigger))
+        
+        cursor.executemany('''
+        UPDATE messages SET day_of_week = ?, time = ?, trigger = ? WHERE id = ?
+        ''', [(day, time_str, pickle.dumps(trigger), db_id) for db_id, day, time_str, trigger in changed])
+        return changed
+
+    def shift_chat_events(self, chat_id: int, hours: int) -> list:
+        """Сдвигает все запланированные мероприятия чата на hours часов с переходом через сутки и неделю"""
+        def shifted(day_of_week, time_str):
+            h, m = map(int, time_str.split(':'))
+            total = (WEEK_DAYS.index(day_of_week) * 24 * 60 + h * 60 + m + hours * 60) % (7 * 24 * 60)
+            day, minutes = divmod(total, 24 * 60)
+            return WEEK_DAYS[day], f"{minutes // 60:02d}:{minutes % 60:02d}"
+        
+        with self.conn:
+            cursor = self.conn.cursor()
+            cursor.execute('''
+            SELECT id, day_of_week, time FROM messages
+            WHERE chat_id = ? AND day_of_week IS NOT NULL AND time IS NOT NULL
+            ''', (chat_id,))
+            return self._reschedule_rows(cursor, cursor.fetchall(), shifted)
+
+    def move_events_to_day(self, db_ids: list, day_of_week: str) -> list:
+        """Переносит мероприятия на другой день недели, время не меняется"""
+        if not db_ids:
+            return []
+        with self.conn:
+            cursor = self.conn.cursor()
+            placeholders = ','.join('?' * len(db_ids))
+            cursor.execute(f'''
+            SELECT id, day_of_week, time FROM messages
+            WHERE id IN ({placeholders}) AND time IS NOT NULL
+            ''', list(db_ids))
+            return self._reschedule_rows(cursor, cursor.fetchall(), lambda _, time_str: (day_of_week, time_str))
+
+    def delete_thread_events(self, chat_id: int, thread_id: int = None) -> list:
+        """Удаляет все мероприятия топика (thread_id=None - общий чат).
+        Возвращает [(id, chat_id, pin_id), ...]: строку на каждое удалённое мероприятие
+        и на каждую закреплённую копию в других чатах - их тоже нужно открепить"""
+        with self.conn:
+            cursor = self.conn.cursor()
+            cursor.execute('''
+            SELECT id, chat_id, pin_id FROM messages WHERE chat_id = ? AND message_thread_id IS ?
+            UNION ALL
+            SELECT p.message_id, p.chat_id, p.pin_id
+            FROM message_posts p JOIN messages m ON m.id = p.message_id
+            WHERE m.chat_id = ? AND m.message_thread_id IS ? AND p.pin_id IS NOT NULL
+            ''', (chat_id, thread_id, chat_id, thread_id))
+            deleted = cursor.fetchall()
+            
+            # Составы одним запросом: каскад удалял бы их отдельно на каждое мероприятие.
+            # Копии, состояние и статистика мероприятий удаляются каскадом
+            cursor.execute('''
+            DELETE FROM participants WHERE message_id IN (
+                SELECT id FROM messages WHERE chat_id = ? AND message_thread_id IS ?
+            )
+            ''', (chat_id, thread_id))
+            if self.fts_enabled:
+                cursor.execute('''
+                DELETE FROM messages_fts WHERE rowid IN (
+                    SELECT id FROM messages WHERE chat_id = ? AND message_thread_id IS ?
+                )
+                ''', (chat_id, thread_id))
+            cursor.execute('DELETE FROM messages WHERE chat_id = ? AND message_thread_id IS ?', (chat_id, thread_id))
+            return deleted
+
+    # Счётчики участников
+
+    @staticmethod
+    def _recount(cursor, ids: list) -> None:
+        """Пересчитывает счётчики мероприятий [(id,), ...] по строкам participants"""
+        cursor.executemany('''
+        UPDATE messages SET
+            participate_count = (SELECT COUNT(*) FROM participants WHERE message_id = messages.id AND status = 'participate'),
+            maybe_count = (SELECT COUNT(*) FROM participants WHERE message_id = messages.id AND status = 'maybe')
+        WHERE id = ?
+        ''', ids)
+
+    def check_counters(self, repair: bool = False) -> list:
+        """Сверяет participate_count и maybe_count с составами.
+        Возвращает расхождения [(id, счётчики, по составу), ...], с repair - исправляет их"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        SELECT m.id, m.participate_count, m.maybe_count, COALESCE(c.participate, 0), COALESCE(c.maybe, 0)
+        FROM messages m
+        LEFT JOIN (
+            SELECT message_id, SUM(status = 'participate') AS participate, SUM(status = 'maybe') AS maybe
+            FROM participants GROUP BY message_id
+        ) c ON c.message_id = m.id
+        WHERE m.participate_count != COALESCE(c.participate, 0) OR m.maybe_count != COALESCE(c.maybe, 0)
+        ''')
+        mismatches = [(db_id, (stored_p, stored_m), (real_p, real_m))
+                      for db_id, stored_p, stored_m, real_p, real_m in cursor.fetchall()]
+        if mismatches and repair:
+            with self.conn:
+                self._recount(self.conn.cursor(), [(db_id,) for db_id, _, _ in mismatches])
+        return mismatches
+
+    # Архив неактивных мероприятий
+
+    def record_send_result(self, db_id: int, delivered: bool) -> None:
+        """Учитывает отправку мероприятия в основной чат: удачная сбрасывает счётчик неудач"""
+        now = int(time.time())
+        with self.conn:
+            if delivered:
+                self.conn.execute('''
+                INSERT INTO event_health (message_id, last_activity) VALUES (?, ?)
+                ON CONFLICT(message_id) DO UPDATE SET send_failures = 0
+                WHERE send_failures > 0
+                ''', (db_id, now))
+            else:
+                self.conn.execute('''
+                INSERT INTO event_health (message_id, send_failures, last_failure, last_activity) VALUES (?, 1, ?, ?)
+                ON CONFLICT(message_id) DO UPDATE SET
+                    send_failures = send_failures + 1,
+                    last_failure = excluded.last_failure
+                ''', (db_id, now, now))
+
+    def find_dormant_events(self, max_failures: int, idle_before: int) -> list:
+        """Мероприятия для архива: [(id, причина), ...]. Причина - 'failures' после max_failures
+        неудачных отправок подряд или 'idle', если последняя встреча с участниками раньше idle_before"""
+        cursor = self.conn.cursor()
+        cursor.execute('''
+        SELECT h.message_id, CASE WHEN h.send_failures >= ? THEN 'failures' ELSE 'idle' END
+        FROM event_health h
+        JOIN messages m ON m.id = h.message_id
+        WHERE h.send_failures >= ? OR h.last_activity < ?
+        ORDER BY h.message_id
+        ''', (max_failures, max_failures, idle_before))
+        return cursor.fetchall()
+
+    def archive_events(self, dormant: list) -> list:
+        """Переносит мероприятия с составом и копиями в архивные таблицы одной транзакцией.
+        dormant - [(id, причина), ...]. Возвращает id перенесённых"""
+        if not dormant:
+            return []
+        now = int(time.time())
+        ids = [(db_id,) for db_id, _ in dormant]
+        with self.conn:
+            cursor = self.conn.cursor()
+            cursor.executemany(f'''
+            INSERT OR REPLACE INTO archived_messages ({self.MESSAGE_COLUMNS}, archived_at, reason)
+            SELECT {self.MESSAGE_COLUMNS}, ?, ? FROM messages WHERE id = ?
+            ''', [(now, reason, db_id) for db_id, reason in dormant])
+            # Порядок голосования сохраняется через rowid
+            cursor.executemany('''
+            INSERT OR REPLACE INTO archived_participants (message_id, user_id, status)
+            SELECT message_id, user_id, status FROM participants WHERE message_id = ? ORDER BY rowid
+            ''', ids)
+            cursor.executemany('''
+            INSERT OR REPLACE INTO archived_message_posts (message_id, chat_id, message_thread_id, pin_id, pin_media)
+            SELECT message_id, chat_id, message_thread_id, pin_id, pin_media FROM message_posts WHERE message_id = ?
+            ''', ids)
+            
+            # Состав, копии, состояние и статистика удаляются каскадом
+            if self.fts_enabled:
+                cursor.executemany('DELETE FROM messages_fts WHERE rowid = ?', ids)
+            cursor.executemany('DELETE FROM messages WHERE id = ?', ids)
+        return [db_id for db_id, _ in dormant]
+
+    def restore_event(self, db_id: int) -> bool:
+        """Возвращает мероприятие из архива. Счётчик неудач и отсчёт простоя начинаются заново"""
+        with self.conn:
+            cursor = self.conn.cursor()
+            cursor.execute(f'''
+            INSERT INTO messages ({self.MESSAGE_COLUMNS})
+            SELECT {self.MESSAGE_COLUMNS} FROM archived_messages WHERE id = ?
+            ''', (db_id,))
+            if not cursor.rowcount:
+                return False
+            cursor.execute('''
+            INSERT OR IGNORE INTO participants (message_id, user_id, status)
+            SELECT message_id, user_id, status FROM archived_participants WHERE message_id = ? ORDER BY rowid
+            ''', (db_id,))
+            self._recount(cursor, [(db_id,)])
+            cursor.execute('''
+            INSERT OR IGNORE INTO message_posts (message_id, chat_id, message_thread_id, pin_id, pin_media)
+            SELECT message_id, chat_id, message_thread_id, pin_id, pin_media FROM archived_message_posts WHERE message_id = ?
+            ''', (db_id,))
+            cursor.execute('''
+            INSERT OR REPLACE INTO event_health (message_id, last_activity) VALUES (?, ?)
+            ''', (db_id, int(time.time())))
+            if self.fts_enabled:
+                cursor.execute('''
+                INSERT INTO messages_fts (rowid, text, links) SELECT id, text, links FROM messages WHERE id = ?
+                ''', (db_id,))
+            
+            cursor.execute('DELETE FROM archived_participants WHERE message_id = ?', (db_id,))
+            cursor.execute('DELETE FROM archived_message_posts WHERE message_id = ?', (db_id,))
+            cursor.execute('DELETE FROM archived_messages WHERE id = ?', (db_id,))
+            return True
+
+    def get_archived_chat(self, db_id: int) -> Union[int, None]:
+        """Чат архивного мероприятия или None, если его нет в архиве"""
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT chat_id FROM archived_messages WHERE id=?', (db_id,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def get_archived_events(self, chat_ids: list, limit: int = 50) -> list:
+        """Архивные мероприятия чатов, сначала недавно убранные: [(id, chat_id, text, archived_at, reason), ...]"""
+        if not chat_ids:
+            return []
+        cursor = self.conn.cursor()
+        placeholders = ','.join('?' * len(chat_ids))
+        cursor.execute(f'''
+        SELECT id, chat_id, text, archived_at, reason FROM archived_messages
+        WHERE chat_id IN ({placeholders})
+        ORDER BY archived_at DESC, id DESC
+        LIMIT ?
+        ''', [*chat_ids, limit])
+        return cursor.fetchall()
+
+    # Потоковый экспорт и импорт
+
+    EXPORT_QUERIES = {
+        'admins': 'SELECT chat_id, admin_id, default_thread_id FROM chat_admins',
+        'users': 'SELECT id, username, full_name FROM users',
+        'media': 'SELECT id, content_key, file_id, kind FROM media ORDER BY id',
+        'events': '''SELECT id, chat_id, message_thread_id, text, date, day_of_week,
+                     time, links, image, pin_id, media_id, pin_media FROM messages ORDER BY id''',
+        'participants': 'SELECT message_id, user_id, status FROM participants ORDER BY rowid',
+    }
+    IMPORT_TABLES = {'admins': 'chat_admins', 'users': 'users', 'media': 'media', 'events': 'messages',
+                     'participants': 'participants'}
+    IMPORT_KEYS = {'admins': ('chat_id', 'admin_id'), 'users': ('id',), 'media': ('id',), 'events': ('id',),
+                   'participants': ('message_id', 'user_id')}
+    CONFLICT_POLICIES = {'skip': 'INSERT OR IGNORE', 'replace': 'INSERT', 'fail': 'INSERT'}
+
+    def export_fields(self, kind: str) -> list:
+        cursor = self.conn.execute(self.EXPORT_QUERIES[kind] + ' LIMIT 0')
+        return [column[0] for column in cursor.description]
+
+    def iter_export(self, kind: str, batch_size: int = 1000):
+        """Построчно отдаёт записи таблицы словарями, держа в памяти не больше batch_size строк"""
+        cursor = self.conn.cursor()
+        cursor.execute(self.EXPORT_QUERIES[kind])
+        fields = [column[0] for column in cursor.description]
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(fields, row))
+
+    def import_batch(self, kind: str, records: list, policy: str = 'skip') -> None:
+        """Вставляет пачку записей одного типа одной транзакцией.
+        policy: skip - оставить существующие, replace - перезаписать, fail - прервать импорт"""
+        if not records:
+            return
+        fields = self.export_fields(kind)
+        unknown = set(records[0]) - set(fields)
+        if unknown:
+            raise ValueError(f"Неизвестные поля {kind}: {', '.join(sorted(unknown))}")
+        
+        columns = [field for field in fields if field in records[0]]
+        values = [[record.get(column) for column in columns] for record in records]
+        if kind == 'events':
+            # Триггер не экспортируется: он восстанавливается по дню и времени.
+            # Сериализованные триггеры одинаковых слотов кэшируются - их немного
+            columns.append('trigger')
+            triggers = {}
+            for record, row in zip(records, values):
+                slot = (record.get('day_of_week'), record.get('time'))
+                if slot not in triggers:
+                    triggers[slot] = None
+                    if all(slot):
+                        message = Message()
+                        message.set_trigger(*slot)
+                        triggers[slot] = pickle.dumps(message.trigger)
+                row.append(triggers[slot])
+        
+        upsert = ''
+        if policy == 'replace':
+            # Не INSERT OR REPLACE: замена удаляет строку, и каскад удалил бы состав мероприятия
+            keys = self.IMPORT_KEYS[kind]
+            updates = [f"{column} = excluded.{column}" for column in columns if column not in keys]
+            upsert = f"ON CONFLICT({', '.join(keys)}) DO " + (f"UPDATE SET {', '.join(updates)}" if updates else "NOTHING")
+        
+        with self.conn:
+            cursor = self.conn.cursor()
+            cursor.executemany(f'''
+            {self.CONFLICT_POLICIES[policy]} INTO {self.IMPORT_TABLES[kind]} ({', '.join(columns)})
+            VALUES ({', '.join('?' * len(columns))}) {upsert}
+            ''', values)
+            
+            if kind == 'events' and self.fts_enabled:
+                # Индексируем то, что реально оказалось в таблице после разрешения конфликтов
+                ids = [(record['id'],) for record in records]
+                cursor.executemany('DELETE FROM messages_fts WHERE rowid = ?', ids)
+                cursor.executemany('''
+                INSERT INTO messages_fts (rowid, text, links) SELECT id, text, links FROM messages WHERE id = ?
+                ''', ids)
+            
+            # Составы пишутся в обход record_vote: счётчики пересчитываются по затронутым мероприятиям
+            if kind in ('events', 'participants'):
+                key = 'id' if kind == 'events' else 'message_id'
+                self._recount(cursor, [(db_id,) for db_id in {record[key] for record in records}])
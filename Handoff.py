@@ -0,0 +1,102 @@
+import os
+import time
+import socket
+import logging
+from datetime import datetime
+import pytz
+
+logger = logging.getLogger(__name__)
+
+LOCK_STALE_AFTER = 30      # секунд без heartbeat - блокировка считается брошенной
+HEARTBEAT_INTERVAL = 2     # как часто работающий экземпляр продлевает блокировку
+ACQUIRE_POLL_INTERVAL = 0.5
+
+class InstanceHandoff:
+    """Передача работы между старым и новым экземпляром бота при перезапуске.
+
+    Новый экземпляр берёт блокировку в SQLite и просит старый завершиться.
+    Старый при heartbeat видит запрос, дорабатывает очередь обновлений и выходит,
+    сохранив последний обработанный update_id, время последнего тика планировщика
+    и мероприятия, сообщения которых ещё не обновлены."""
+
+    def __init__(self, db):
+        self.db = db
+        self.instance_id = f"{socket.gethostname()}:{os.getpid()}:{int(time.time())}"
+        self.last_update_id = 0
+        self.pending_refresh = set()
+        self.stopping = False
+
+    def acquire(self, timeout: float = 120) -> bool:
+        """Блокирующе ждёт блокировку. Вызывается до запуска polling"""
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.db.try_acquire_lock(self.instance_id, time.time(), LOCK_STALE_AFTER):
+                logger.info(f"[HANDOFF] Блокировка получена экземпляром {self.instance_id}")
+                # Состояние перечитываем: старый экземпляр мог сохранить его при выходе
+                self.last_update_id = int(self.db.get_state('last_update_id', 0))
+                self.pending_refresh = self.load_pending_refresh()
+                return True
+            if time.monotonic() > deadline:
+                logger.error("[HANDOFF] Не дождались передачи работы от старого экземпляра")
+                return False
+            time.sleep(ACQUIRE_POLL_INTERVAL)
+
+    def heartbeat(self) -> bool:
+        """Продлевает блокировку и сохраняет состояние. True - пора передать работу"""
+        waiting = self.db.heartbeat_lock(self.instance_id, time.time())
+        self.flush()
+        if waiting and not self.stopping:
+            if waiting == self.instance_id:
+                logger.error("[HANDOFF] Блокировка потеряна, останавливаемся")
+            else:
+                logger.info(f"[HANDOFF] Экземпляр {waiting} запросил передачу работы")
+            self.stopping = True
+            return True
+        return False
+
+    def is_duplicate(self, update_id: int) -> bool:
+        """Обновление уже обработано предыдущим экземпляром"""
+        return update_id <= self.last_update_id
+
+    def mark_processed(self, update_id: int) -> None:
+        if update_id > self.last_update_id:
+            self.last_update_id = update_id
+
+    def load_pending_refresh(self) -> set:
+        raw = self.db.get_state('pending_refresh', '')
+        return {int(db_id) for db_id in raw.split(',') if db_id}
+
+    def flush(self) -> None:
+        """Сохраняет offset, тик планировщика и незавершённую исходящую работу одной транзакцией.
+        Всё, что планировщик должен был отправить до тика, уже отправлено этим экземпляром"""
+        self.db.set_states({
+            'last_update_id': self.last_update_id,
+            'pending_refresh': ','.join(str(db_id) for db_id in sorted(self.pending_refresh)),
+            'scheduler_tick': datetime.now(pytz.utc).isoformat(),
+        })
+
+    def release(self) -> None:
+        self.flush()
+        self.db.release_lock(self.instance_id)
+        logger.info(f"[HANDOFF] Блокировка освобождена экземпляром {self.instance_id}")
+
+    def missed_since_last_tick(self, messages, now: datetime = None) -> list:
+        """Возвращает мероприятия, отправка которых пришлась на время перезапуска"""
+        raw_tick = self.db.get_state('scheduler_tick')
+        if not raw_tick:
+            return []
+        last_tick = datetime.fromisoformat(raw_tick)
+        now = now or datetime.now(pytz.utc)
+
+        missed = []
+        for message in messages:
+            if not message.trigger:
+                continue
+            try:
+                fire_time = message.trigger.get_next_fire_time(None, last_tick)
+            except Exception as e:
+                logger.error(f"[HANDOFF] Не удалось вычислить время отправки {message.db_id}: {e}")
+                continue
+            if fire_time and fire_time <= now:
+                missed.append(message)
+        return missed
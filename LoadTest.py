@@ -0,0 +1,289 @@
+import os
+import json
+import time
+import random
+import asyncio
+import logging
+import argparse
+import itertools
+import contextvars
+import tempfile
+from collections import Counter, defaultdict
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+from telegram.request import BaseRequest
+from DB import Database
+from Message import Message
+from Archive import RosterArchive
+from MtgBot import MtgBot, setup_application
+from Watchdog import watchdog
+
+FAKE_TOKEN = '123456:LOADTEST'
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'MtgBot', 'username': 'mtg_load_bot'}
+
+# Чьи это запросы к API и к базе: голос, действие админа или рассылка. Задачи,
+# созданные внутри обработчика, наследуют значение, поэтому отложенное
+# обновление текста после голосования тоже считается к голосу
+current_kind = contextvars.ContextVar('current_kind', default='other')
+
+def percentile(values: list, share: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+class FakeRequest(BaseRequest):
+    """Bot API в памяти процесса: ответы с задержкой и заданной долей 429"""
+
+    # Методы, которые возвращают сообщение
+    MESSAGE_METHODS = ('sendMessage', 'sendPhoto', 'editMessageText', 'editMessageCaption', 'editMessageReplyMarkup')
+
+    def __init__(self, latency: float = 0.05, jitter: float = 0.02, rate_limit: float = 0.0,
+                 retry_after: int = 1, seed: int = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.message_ids = itertools.count(1000)
+        self.calls = Counter()   # (тип работы, метод) -> вызовов
+        self.rate_limited = 0
+
+    @property
+    def read_timeout(self):
+        return None
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        self.calls[current_kind.get(), api_method] += 1
+        await asyncio.sleep(max(0.0, self.random.gauss(self.latency, self.jitter)))
+
+        if api_method != 'getMe' and self.random.random() < self.rate_limit:
+            self.rate_limited += 1
+            return 429, json.dumps({
+                'ok': False, 'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after},
+            }).encode()
+
+        params = request_data.parameters if request_data else {}
+        return 200, json.dumps({'ok': True, 'result': self.result(api_method, params)}).encode()
+
+    def result(self, api_method: str, params: dict):
+        if api_method == 'getMe':
+            return BOT_USER
+        if api_method in self.MESSAGE_METHODS:
+            chat_id = int(params.get('chat_id', 0))
+            message = {
+                'message_id': params.get('message_id') or next(self.message_ids),
+                'date': int(time.time()),
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+            }
+            if api_method == 'sendPhoto':
+                message['photo'] = [{'file_id': 'fake-photo', 'file_unique_id': 'fake-photo', 'width': 1, 'height': 1}]
+            return message
+        if api_method == 'getChat':
+            chat_id = int(params.get('chat_id', 0))
+            return {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup', 'title': f"Чат {chat_id}",
+                    'accent_color_id': 0, 'max_reaction_count': 11}
+        if api_method == 'getChatMember':
+            return {'status': 'creator', 'is_anonymous': False,
+                    'user': {'id': params.get('user_id'), 'is_bot': False, 'first_name': 'Админ'}}
+        return True
+
+class Traffic:
+    """Обновления Telegram: голоса участников и сценарии админов"""
+
+    def __init__(self, events: list, voters: int, seed: int = None):
+        self.events = events   # [(db_id, chat_id, admin_id)]
+        self.voters = voters
+        self.random = random.Random(seed)
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+
+    @staticmethod
+    def user(user_id: int) -> dict:
+        return {'id': user_id, 'is_bot': False, 'first_name': f"Игрок {user_id}", 'username': f"player{user_id}"}
+
+    def update(self, payload: dict, bot) -> Update:
+        return Update.de_json({'update_id': next(self.update_ids), **payload}, bot)
+
+    def callback(self, bot, user_id: int, data: str, chat_id: int, message_id: int) -> Update:
+        return self.update({'callback_query': {
+            'id': str(next(self.message_ids)), 'from': self.user(user_id), 'chat_instance': str(chat_id), 'data': data,
+            'message': {'message_id': message_id, 'date': int(time.time()),
+                        'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'}},
+        }}, bot)
+
+    def text(self, bot, user_id: int, text: str) -> Update:
+        message = {'message_id': next(self.message_ids), 'date': int(time.time()), 'text': text,
+                   'from': self.user(user_id), 'chat': {'id': user_id, 'type': 'private'}}
+        if text.startswith('/'):
+            command = text.split()[0]
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(command)}]
+        return self.update({'message': message}, bot)
+
+    def vote(self, bot) -> Update:
+        index = self.random.randrange(len(self.events))
+        db_id, chat_id, _ = self.events[index]
+        user_id = 10 ** 7 + index * self.voters + self.random.randrange(self.voters)
+        action = 'participate' if self.random.random() < 0.8 else 'participatemaybe'
+        # Фейковому API номер закреплённого сообщения не важен
+        return self.callback(bot, user_id, f"{action}_{db_id}", chat_id, db_id)
+
+    def admin_flow(self, bot) -> list:
+        """Правка текста мероприятия или поиск: каждый шаг - отдельное обновление"""
+        db_id, _, admin_id = self.random.choice(self.events)
+        panel = next(self.message_ids)
+        if self.random.random() < 0.5:
+            return [
+                self.text(bot, admin_id, '/start'),
+                self.callback(bot, admin_id, 'a_messages', admin_id, panel),
+                self.callback(bot, admin_id, f's_{db_id}', admin_id, panel),
+                self.callback(bot, admin_id, 'm_text', admin_id, panel),
+                self.text(bot, admin_id, f"Турнир по драфту, стол {self.random.randrange(100)}"),
+            ]
+        return [
+            self.text(bot, admin_id, '/start'),
+            self.callback(bot, admin_id, 'a_search', admin_id, panel),
+            self.text(bot, admin_id, 'турнир'),
+        ]
+
+    def plan(self, bot, votes: int, admin_ratio: float, bursts: int):
+        """Поток работ (тип, обновления). Рассылки равномерно разбросаны по голосованию"""
+        burst_every = votes // bursts if bursts else 0
+        for number in range(votes):
+            if burst_every and number % burst_every == 0:
+                yield 'burst', []
+            if self.random.random() < admin_ratio:
+                yield 'admin', self.admin_flow(bot)
+            yield 'vote', [self.vote(bot)]
+
+def seed_database(db: Database, chats: int) -> list:
+    """Один чат - один админ и одно мероприятие"""
+    events = []
+    for index in range(chats):
+        chat_id = -100_000_000_000 - index
+        admin_id = 10 ** 6 + index
+        db.set_chat_admin(chat_id, admin_id)
+        message = Message()
+        message.chat_id = chat_id
+        message.text = f"Турнир по драфту, стол {index}"
+        message.day_of_week = 'fri'
+        message.time = '19:00'
+        db.save_message(message)
+        events.append((message.db_id, chat_id, admin_id))
+    return events
+
+async def run(args) -> dict:
+    directory = tempfile.mkdtemp(prefix='mtg-load-')
+    db = Database(os.path.join(directory, 'load.db'))
+    events = seed_database(db, args.chats)
+    bot = MtgBot(db, RosterArchive(os.path.join(directory, 'archive.db')))
+    bot.handoff.acquire()
+
+    api = FakeRequest(args.latency, args.jitter, args.rate_limit, seed=args.seed)
+    application = (
+        ApplicationBuilder().token(FAKE_TOKEN).updater(None)
+        .request(api).get_updates_request(FakeRequest(seed=args.seed))
+        .build()
+    )
+    setup_application(application, bot, metrics_port=0)
+
+    statements = Counter()
+    db.conn.set_trace_callback(lambda sql: statements.update((current_kind.get(),)))
+
+    await application.initialize()
+    await application.post_init(application)
+
+    traffic = Traffic(events, args.voters, seed=args.seed)
+    work = traffic.plan(application.bot, args.votes, args.admin_ratio, args.bursts)
+    latencies = defaultdict(list)
+    updates = Counter()
+    burst_tasks = []
+
+    async def worker():
+        for kind, batch in work:
+            current_kind.set(kind)
+            if kind == 'burst':
+                # Как планировщик: рассылки идут фоном, голосование продолжается
+                burst_tasks.extend(asyncio.create_task(bot.send_scheduled_message(db_id)) for db_id, _, _ in events)
+                continue
+            for update in batch:
+                started = time.perf_counter()
+                await application.process_update(update)
+                latencies[kind].append(time.perf_counter() - started)
+                updates[kind] += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - started
+
+    # Дожидаемся рассылок и отложенных обновлений текста: их запросы тоже считаются
+    await asyncio.gather(*burst_tasks)
+    while bot.refresh_tasks:
+        await asyncio.gather(*list(bot.refresh_tasks.values()), return_exceptions=True)
+
+    await application.post_shutdown(application)
+    await application.shutdown()
+
+    votes = updates['vote'] or 1
+    return {
+        'updates': sum(updates.values()),
+        'seconds': elapsed,
+        'throughput': sum(updates.values()) / elapsed,
+        'latency': {kind: {'count': len(values), 'p50': percentile(values, 0.5), 'p99': percentile(values, 0.99)}
+                    for kind, values in latencies.items()},
+        'api_per_vote': sum(count for (kind, _), count in api.calls.items() if kind == 'vote') / votes,
+        'api_by_method': {f"{kind}.{method}": count for (kind, method), count in sorted(api.calls.items())},
+        'db_per_vote': statements['vote'] / votes,
+        'db_statements': dict(statements),
+        'rate_limited': api.rate_limited,
+        'stalls': watchdog.count,
+    }
+
+def print_report(result: dict, votes: int) -> None:
+    print(f"Обновлений: {result['updates']} за {result['seconds']:.1f} с ({result['throughput']:.0f} обновлений/с)")
+    for kind, latency in sorted(result['latency'].items()):
+        print(f"  {kind}: {latency['count']} обновлений, p50 {latency['p50'] * 1000:.1f} мс, "
+              f"p99 {latency['p99'] * 1000:.1f} мс")
+    print(f"Запросов к API на голос: {result['api_per_vote']:.2f}")
+    for name, count in result['api_by_method'].items():
+        if name.startswith('vote.'):
+            print(f"  {name[5:]}: {count / votes:.2f}")
+    print(f"Запросов к базе на голос: {result['db_per_vote']:.1f}")
+    print(f"Запросов к базе по типам работ: {result['db_statements']}")
+    print(f"Ответов 429: {result['rate_limited']}, зависаний цикла событий: {result['stalls']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с Bot API в памяти процесса")
+    parser.add_argument('--chats', type=int, default=50, help="чатов, в каждом одно мероприятие")
+    parser.add_argument('--voters', type=int, default=40, help="голосующих в каждом чате")
+    parser.add_argument('--votes', type=int, default=5000, help="нажатий на кнопки голосования")
+    parser.add_argument('--admin-ratio', type=float, default=0.02, help="доля сценариев админа на голос")
+    parser.add_argument('--bursts', type=int, default=2, help="рассылок всех мероприятий за тест")
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help="обновлений в обработке одновременно (у Application по умолчанию 1)")
+    parser.add_argument('--latency', type=float, default=0.02, help="средняя задержка Bot API, с")
+    parser.add_argument('--jitter', type=float, default=0.005)
+    parser.add_argument('--rate-limit', type=float, default=0.001, help="доля ответов 429")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help="сохранить результат в файл")
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(args.log_level)
+    result = asyncio.run(run(args))
+    print_report(result, result['latency'].get('vote', {}).get('count') or 1)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
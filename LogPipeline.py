@@ -0,0 +1,147 @@
+import os
+import json
+import queue
+import atexit
+import random
+import logging
+import contextvars
+import multiprocessing
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+
+LOG_DIR = "logs"
+LOG_FILE = "mtgbot.log"
+LOG_BACKUPS = 30  # дней хранения ротированных файлов
+
+CONSOLE_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Логгер голосов. Имя фиксированное: при запуске python MtgBot.py модуль называется __main__
+VOTE_LOGGER = 'MtgBot.votes'
+
+# Доля сохраняемых записей INFO и ниже для горячих логгеров. Переопределяется
+# переменной MTG_LOG_SAMPLE вида "MtgBot.votes=0.05,httpx=0.01"
+DEFAULT_SAMPLING = {
+    VOTE_LOGGER: 0.05,      # строка на каждый голос
+    'httpx': 0.05,          # строка на каждый запрос к Bot API
+}
+
+# Идентификаторы текущего обновления или задачи: попадают в каждую запись лога
+CONTEXT_FIELDS = ('update_id', 'chat_id', 'user_id', 'db_id')
+log_context = contextvars.ContextVar('log_context', default={})
+
+def bind(**fields) -> None:
+    """Добавляет идентификаторы к контексту текущей задачи"""
+    log_context.set({**log_context.get(), **fields})
+
+def bind_update(update) -> None:
+    """Новый контекст на каждое обновление Telegram. db_id берётся из callback_data вида prefix_<id>"""
+    fields = {'update_id': update.update_id}
+    if update.effective_chat:
+        fields['chat_id'] = update.effective_chat.id
+    if update.effective_user:
+        fields['user_id'] = update.effective_user.id
+    data = update.callback_query.data if update.callback_query else None
+    if data:
+        tail = data.rsplit('_', 1)[-1]
+        if tail.isdigit():
+            fields['db_id'] = int(tail)
+    log_context.set(fields)
+
+class ContextFilter(logging.Filter):
+    """Переносит идентификаторы из контекста задачи в запись. Работает в потоке, где пишется лог"""
+
+    def filter(self, record):
+        for field, value in log_context.get().items():
+            if not hasattr(record, field):
+                setattr(record, field, value)
+        return True
+
+class SamplingFilter(logging.Filter):
+    """Пропускает долю rate записей INFO и ниже. Предупреждения и ошибки проходят всегда"""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        return record.levelno > logging.INFO or random.random() < self.rate
+
+class LazyQueueHandler(QueueHandler):
+    """QueueHandler, который не форматирует сообщение в потоке цикла событий.
+
+    Стандартный prepare форматирует запись до постановки в очередь. Здесь
+    аргументы неизменяемых типов передаются как есть, и строка собирается в
+    потоке QueueListener. Изменяемые аргументы и трассировки исключений
+    форматируются сразу: к моменту записи объект мог измениться."""
+
+    IMMUTABLE = (str, int, float, bool, type(None))
+
+    def prepare(self, record):
+        if record.args and not all(isinstance(arg, self.IMMUTABLE) for arg in
+                                   (record.args.values() if isinstance(record.args, dict) else record.args)):
+            record.msg = record.getMessage()
+            record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - одна строка JSON с идентификаторами чата, мероприятия и пользователя"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def parse_sampling(raw: str) -> dict:
+    rates = dict(DEFAULT_SAMPLING)
+    for item in filter(None, (part.strip() for part in raw.split(','))):
+        name, _, rate = item.partition('=')
+        rates[name.strip()] = float(rate)
+    return rates
+
+def setup_logging(level: str = None, log_dir: str = LOG_DIR) -> QueueListener:
+    """Логи пишутся в очередь, файл и консоль обслуживает отдельный поток.
+    Файл ротируется в полночь, в нём JSON, в консоли - обычный текст"""
+    os.makedirs(log_dir, exist_ok=True)
+    # Шарды (Sharding.py) пишут каждый в свой файл: ротировать один файл из нескольких процессов нельзя
+    process = multiprocessing.current_process().name
+    filename = LOG_FILE if process == 'MainProcess' else f"mtgbot-{process}.log"
+    file_handler = TimedRotatingFileHandler(
+        os.path.join(log_dir, filename), when='midnight', backupCount=LOG_BACKUPS, encoding='utf-8')
+    file_handler.setFormatter(JsonFormatter())
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(level or os.environ.get('MTG_LOG_LEVEL', 'INFO'))
+
+    for name, rate in parse_sampling(os.environ.get('MTG_LOG_SAMPLE', '')).items():
+        if rate < 1:
+            logging.getLogger(name).addFilter(SamplingFilter(rate))
+
+    listener = QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    # Дописываем очередь при выходе из процесса
+    atexit.register(listener.stop)
+    return listener
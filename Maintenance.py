@@ -0,0 +1,162 @@
+import os
+import time
+import sqlite3
+import asyncio
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+BACKUP_DIR = os.environ.get('MTG_BACKUP_DIR', 'backups')
+BACKUP_KEEP = 7              # сколько последних копий хранить
+BACKUP_STEP_PAGES = 256      # страниц за шаг копирования, начальное значение
+BACKUP_STEP_PAUSE = 0.01     # пауза между шагами: писатели успевают закоммитить
+BACKUP_STEP_GROWTH = 4       # во сколько раз растёт шаг после каждого перезапуска копирования
+
+VACUUM_STEP_PAGES = 256      # страниц, возвращаемых системе за шаг incremental_vacuum
+VACUUM_STEP_PAUSE = 0.05
+
+ANALYSIS_LIMIT = 1000        # строк индекса, которые читает ANALYZE внутри PRAGMA optimize
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+class BackupRestarted(Exception):
+    """Копирование откатилось в начало из-за записи в базу"""
+
+class DatabaseMaintenance:
+    """Обслуживание базы без остановки бота.
+
+    Все операции идут маленькими шагами с паузами, чтобы голосование не ждало:
+    incremental_vacuum освобождает страницы из списка свободных порциями,
+    PRAGMA optimize обновляет статистику планировщика с ограничением
+    analysis_limit, резервная копия снимается через backup API из отдельного
+    потока и отдельного соединения. Для incremental_vacuum база должна быть в
+    режиме auto_vacuum=INCREMENTAL (шаг 6 в create_migration.py)."""
+
+    def __init__(self, db, backup_dir: str = BACKUP_DIR, keep: int = BACKUP_KEEP):
+        self.db = db
+        self.backup_dir = backup_dir
+        self.keep = keep
+        self.running = False
+        self.last_backup = None   # (время окончания, секунд, байт)
+
+    # Состояние
+
+    def _pragma(self, name: str):
+        return self._pragma_of(self.db.conn, name)
+
+    def stats(self) -> dict:
+        page_size = self._pragma('page_size')
+        pages = self._pragma('page_count')
+        free_pages = self._pragma('freelist_count')
+        return {
+            'size_bytes': page_size * pages,
+            'pages': pages,
+            'free_pages': free_pages,
+            'fragmentation': free_pages / pages if pages else 0.0,
+            'auto_vacuum': self._pragma('auto_vacuum'),
+        }
+
+    # Операции
+
+    async def incremental_vacuum(self, step_pages: int = VACUUM_STEP_PAGES, pause: float = VACUUM_STEP_PAUSE) -> int:
+        """Возвращает свободные страницы файлу порциями. Возвращает число освобождённых страниц"""
+        if self._pragma('auto_vacuum') != AUTO_VACUUM_INCREMENTAL:
+            logger.warning("[MAINTENANCE] auto_vacuum не INCREMENTAL, запустите create_migration.py")
+            return 0
+        # Только страницы, свободные на старте: голосование всё время освобождает новые
+        remaining = self._pragma('freelist_count')
+        freed = 0
+        while remaining > 0:
+            step = min(step_pages, remaining)
+            # execute освобождает одну страницу за вызов, executescript выполняет прагму до конца
+            self.db.conn.executescript(f'PRAGMA incremental_vacuum({step})')
+            remaining -= step
+            freed += step
+            await asyncio.sleep(pause)
+        return freed
+
+    def optimize(self) -> None:
+        """Статистика для планировщика запросов. Без analysis_limit ANALYZE читал бы индексы целиком"""
+        self.db.conn.execute(f'PRAGMA analysis_limit={ANALYSIS_LIMIT}')
+        self.db.conn.execute('PRAGMA optimize')
+
+    async def backup(self) -> str:
+        """Согласованная копия базы в backup_dir. Цикл событий не блокируется"""
+        os.makedirs(self.backup_dir, exist_ok=True)
+        name = os.path.splitext(os.path.basename(self.db.db_name))[0]
+        path = os.path.join(self.backup_dir, f"{name}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.db")
+        started = time.monotonic()
+        await asyncio.to_thread(self._copy, path)
+        self.last_backup = (time.time(), time.monotonic() - started, os.path.getsize(path))
+        self._prune(name)
+        return path
+
+    def _copy(self, path: str) -> None:
+        """Копирование шагами. Запись в базу другим соединением между шагами откатывает
+        копирование в начало, поэтому после каждого отката шаг растёт. В тихое время копия
+        снимается мелкими шагами, под нагрузкой - за несколько крупных. Шаг держит блокировку
+        чтения, и запись голоса ждёт не дольше одного шага"""
+        partial = path + '.part'
+        source = sqlite3.connect(self.db.db_name)
+        target = sqlite3.connect(partial)
+        pages = BACKUP_STEP_PAGES
+        try:
+            while True:
+                last_remaining = None
+
+                def progress(status, remaining, total):
+                    nonlocal last_remaining
+                    if last_remaining is not None and remaining > last_remaining:
+                        raise BackupRestarted
+                    last_remaining = remaining
+
+                try:
+                    source.backup(target, pages=pages, progress=progress, sleep=BACKUP_STEP_PAUSE)
+                    break
+                except BackupRestarted:
+                    total = self._pragma_of(source, 'page_count')
+                    # Шаг больше размера базы - копия снимается одним шагом
+                    pages = -1 if pages * BACKUP_STEP_GROWTH >= total else pages * BACKUP_STEP_GROWTH
+                    logger.info("[MAINTENANCE] База изменилась во время копирования, шаг %s страниц", pages)
+        finally:
+            target.close()
+            source.close()
+        os.replace(partial, path)
+
+    @staticmethod
+    def _pragma_of(conn, name: str):
+        return conn.execute(f'PRAGMA {name}').fetchone()[0]
+
+    def _prune(self, name: str) -> None:
+        backups = sorted(
+            entry for entry in os.listdir(self.backup_dir)
+            if entry.startswith(name + '-') and entry.endswith('.db')
+        )
+        for entry in backups[:-self.keep]:
+            os.remove(os.path.join(self.backup_dir, entry))
+
+    async def run(self) -> None:
+        """Полный цикл обслуживания: сверка счётчиков, освобождение места, статистика, резервная копия"""
+        if self.running:
+            return
+        self.running = True
+        try:
+            before = self.stats()
+            started = time.monotonic()
+            # Счётчики участников должны совпадать с составами: расхождение - ошибка в коде записи
+            mismatches = self.db.check_counters(repair=True)
+            if mismatches:
+                logger.warning("[MAINTENANCE] Счётчики участников исправлены у %s мероприятий: %s",
+                               len(mismatches), mismatches[:10])
+            freed = await self.incremental_vacuum()
+            self.optimize()
+            path = await self.backup()
+            after = self.stats()
+            logger.info(
+                "[MAINTENANCE] Освобождено %s страниц, размер %.1f -> %.1f МиБ, свободно %.1f%%, копия %s за %.1f с",
+                freed, before['size_bytes'] / 2 ** 20, after['size_bytes'] / 2 ** 20,
+                after['fragmentation'] * 100, path, time.monotonic() - started,
+            )
+        finally:
+            self.running = False
@@ -2,6 +2,16 @@ from apscheduler.triggers.cron import CronTrigger
 import pytz
 from datetime import datetime, timedelta
 
+# Картинка мероприятий без своей картинки. Telegram скачивает её по ссылке один раз,
+# дальше бот отправляет полученный file_id (см. таблицу media)
+DEFAULT_IMAGE_URL = "https://i.pinimg.com/736x/a6/86/75/a686751d639e642196346106fb868623.jpg"
+
+# Ограничения Telegram на длину текста сообщения и подписи к фото
+TEXT_LIMIT = 4096
+CAPTION_LIMIT = 1024
+
+OVERFLOW_HINT = "Список не помещается в сообщение, откройте его кнопкой «📜 Список»"
+
 class Message:
     def __init__(self):
         self.db_id = None
@@ -10,13 +20,16 @@ class Message:
         self.text = "Вечернее соревнование"
         self.participants = []
         self.maybe_participants = []
+        self.counts = None  # (участвуют, возможно) из базы, когда состав не загружен
         self.date = None
         self.day_of_week = None
         self.day_of_notice = None
         self.time = "12:00"
         self.links = ""
-        self.image = "[\u200b](https://i.pinimg.com/736x/a6/86/75/a686751d639e642196346106fb868623.jpg)"
+        self.image = None  # устаревшая ссылка на картинку в тексте, до миграции media
+        self.media_id = None  # картинка из таблицы media, None - картинка по умолчанию
         self.pin_id = None
+        self.pin_media = False  # закреплённое сообщение - фото с подписью
         self.trigger = None
     
     def add_participant(self, user_info):
@@ -45,6 +58,12 @@ class Message:
             # Удаляем из основных, если есть
             self.participants = [u for u in self.participants if u['id'] != user['id']]
 
+    def vote_counts(self) -> tuple:
+        """Число участвующих и «возможно»: счётчики из базы или длины загруженного состава"""
+        if self.counts is not None:
+            return self.counts
+        return len(self.participants), len(self.maybe_participants)
+
     def set_trigger(self, day_of_week, time_str):
         """Создает и сохраняет CronTrigger"""
         hour, minute = map(int, time_str.split(':'))
@@ -56,43 +75,37 @@ class Message:
         )
         self.time = time_str
     
-    def generate_message_text(self):
-        """Генерирует текст финального сообщения с Markdown форматированием"""
-        # Функция для экранирования специальных символов MarkdownV2
-        def escape_markdown(text):
-            if not text:
-                return ""
-            escape_chars = r'_*[]()~`>#+-=|{}.!'
-            return ''.join(f'\\{char}' if char in escape_chars else char for char in text)
-        
-        # Экранируем все текстовые поля
-        escaped_text = escape_markdown(self.text)
-        escaped_image = escape_markdown(self.image)
-        escaped_links = escape_markdown(self.links)
-        
-        # Экранируем имена пользователей
-        participants_text = '\n\t'.join(
-            f"[{escape_markdown(p['full_name'])}](t\\.me/{escape_markdown(p['username'])})" if p.get('username') 
-            else escape_markdown(p['full_name']) 
-            for p in self.participants
-        ) if self.participants else "Пока никто"
+    @staticmethod
+    def escape_markdown(text):
+        """Экранирует специальные символы MarkdownV2"""
+        if not text:
+            return ""
+        escape_chars = r'_*[]()~`>#+-=|{}.!'
+        return ''.join(f'\\{char}' if char in escape_chars else char for char in text)
 
-        maybe_text = '\n\t'.join(
-            f"[{escape_markdown(p['full_name'])}](t\\.me/{escape_markdown(p['username'])})" if p.get('username') 
-            else escape_markdown(p['full_name']) 
-            for p in self.maybe_participants
-        ) if self.maybe_participants else "Пока никто"
-        
-        hours, minute = map(int, self.time.split(":"))
-        time = f"{hours:02d}:{minute:02d}"
-        
-        # Формируем основное сообщение
-        message = (
-            f"{escaped_text}\n"
-            f"\n\n{self.image}"
-            f"*Участвую \\({len(self.participants)}\\):*\n\t{participants_text}\n\n"
-            f"*Возможно \\({len(self.maybe_participants)}\\):*\n\t{maybe_text}"
-        )
+    @classmethod
+    def format_user(cls, user):
+        """Имя участника: ссылка на профиль, если есть username"""
+        if user.get('username'):
+            return f"[{cls.escape_markdown(user['full_name'])}](t\\.me/{cls.escape_markdown(user['username'])})"
+        return cls.escape_markdown(user['full_name'])
+
+    def _join_users(self, users, budget: int):
+        """Список имён через перенос строки или None, если он не помещается в budget символов.
+        Перебор останавливается на первом переполнении, поэтому стоимость не зависит от размера состава"""
+        if not users:
+            return "Пока никто"
+        parts, size = [], 0
+        for user in users:
+            part = self.format_user(user)
+            size += len(part) + 2
+            if size > budget:
+                return None
+            parts.append(part)
+        return '\n\t'.join(parts)
+
+    def _compose(self, roster_text: str):
+        message = f"{self.escape_markdown(self.text)}\n\n\n{self.image or ''}{roster_text}"
         
         # Безопасно добавляем подпись
         # Используем try-except для совместимости со старыми сообщениями
@@ -109,6 +122,34 @@ class Message:
         
         return message
 
+    def render(self, limit: int = TEXT_LIMIT):
+        """Текст сообщения не длиннее limit и признак переполнения.
+        Если имена не помещаются, в тексте остаются только счётчики, а состав
+        открывается кнопкой «📜 Список» постранично"""
+        participate_count, maybe_count = self.vote_counts()
+        participants_header = f"*Участвую \\({participate_count}\\):*"
+        maybe_header = f"*Возможно \\({maybe_count}\\):*"
+        
+        budget = limit - len(self._compose(f"{participants_header}\n\t\n\n{maybe_header}\n\t"))
+        participants_text = self._join_users(self.participants, budget)
+        if participants_text is not None:
+            maybe_text = self._join_users(self.maybe_participants, budget - len(participants_text))
+            if maybe_text is not None:
+                return self._compose(
+                    f"{participants_header}\n\t{participants_text}\n\n{maybe_header}\n\t{maybe_text}"
+                ), False
+        
+        return self._compose(f"{participants_header}\n{maybe_header}\n\n_{OVERFLOW_HINT}_"), True
+
+    def generate_message_text(self, limit: int = TEXT_LIMIT):
+        """Генерирует текст финального сообщения с Markdown форматированием"""
+        return self.render(limit)[0]
+
+    def fits(self, limit: int) -> bool:
+        """Помещается ли сообщение в limit хотя бы в виде счётчиков.
+        Длина считается вместе с разметкой - это оценка сверху"""
+        return len(self.render(limit)[0]) <= limit
+
     def add_signature(self, text):
         """Добавляет подпись к тексту сообщения"""
         # Можно настроить подпись для разных чатов или условий
@@ -0,0 +1,247 @@
+import os
+import time
+import asyncio
+import logging
+import functools
+from bisect import bisect_left
+from telegram.request import HTTPXRequest
+
+logger = logging.getLogger(__name__)
+
+# Порт локального HTTP-эндпоинта с метриками, 0 - не запускать
+METRICS_PORT = int(os.environ.get('MTG_METRICS_PORT', '9108'))
+METRICS_HOST = '127.0.0.1'
+
+# Границы корзин гистограмм в секундах: от обращения к SQLite до медленного Bot API
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{name}="{str(value)}"' for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+
+    def inc(self, *labels, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами. observe - поиск корзины и два сложения"""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.series = {}  # labels -> [счётчики корзин..., +Inf, сумма]
+
+    def observe(self, value: float, *labels) -> None:
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [0] * (len(self.buckets) + 2)
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                le = _labels(self.labelnames + ('le',), labels + (bound,))
+                lines.append(f"{self.name}_bucket{le} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {series[-1]}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class Gauge:
+    """Значение вычисляется при чтении метрик, на горячем пути ничего не делается"""
+
+    def __init__(self, name: str, documentation: str, read):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+    def render(self) -> list:
+        try:
+            value = self.read()
+        except Exception as e:
+            logger.warning(f"[METRICS] Не удалось прочитать {self.name}: {e}")
+            return []
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} gauge", f"{self.name} {value}"]
+
+class GaugeSet:
+    """Несколько датчиков из одного чтения: источник опрашивается один раз за сбор метрик.
+    gauges: имя -> (описание, ключ в словаре, который возвращает read)"""
+
+    def __init__(self, read, gauges: dict):
+        self.read = read
+        self.gauges = gauges
+
+    def render(self) -> list:
+        try:
+            values = self.read()
+        except Exception as e:
+            logger.warning(f"[METRICS] Не удалось прочитать {', '.join(self.gauges)}: {e}")
+            return []
+        lines = []
+        for name, (documentation, key) in self.gauges.items():
+            lines += [f"# HELP {name} {documentation}", f"# TYPE {name} gauge", f"{name} {values[key]}"]
+        return lines
+
+class Metrics:
+    """Реестр метрик процесса и локальный HTTP-эндпоинт в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self.families = []
+        self.routes = {'/metrics': self.render}
+        self.server = None
+
+        self.handler_seconds = self.add(Histogram(
+            'mtgbot_handler_seconds', 'Время обработки обновления Telegram', ('handler',)))
+        self.handler_errors = self.add(Counter(
+            'mtgbot_handler_errors_total', 'Исключения в обработчиках', ('handler',)))
+        self.db_seconds = self.add(Histogram(
+            'mtgbot_db_seconds', 'Время вызова метода Database', ('method',)))
+        self.api_seconds = self.add(Histogram(
+            'mtgbot_api_seconds', 'Время запроса к Bot API по методу и исходу (ok, 429, error, network)',
+            ('method', 'outcome')))
+        self.scheduler_lag = self.add(Histogram(
+            'mtgbot_scheduler_lag_seconds', 'Задержка запуска задачи планировщика относительно расписания',
+            buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)))
+
+    def add(self, family):
+        self.families.append(family)
+        return family
+
+    def gauge(self, name: str, documentation: str, read) -> None:
+        self.add(Gauge(name, documentation, read))
+
+    def gauge_set(self, read, gauges: dict) -> None:
+        self.add(GaugeSet(read, gauges))
+
+    def render(self) -> str:
+        return '\n'.join(line for family in self.families for line in family.render()) + '\n'
+
+    # Инструментирование
+
+    def timed_handler(self, callback):
+        """Оборачивает async-обработчик PTB: время и исключения по имени обработчика"""
+        name = getattr(callback, '__name__', repr(callback))
+
+        @functools.wraps(callback)
+        async def wrapper(update, context):
+            started = time.perf_counter()
+            try:
+                return await callback(update, context)
+            except Exception:
+                self.handler_errors.inc(name)
+                raise
+            finally:
+                self.handler_seconds.observe(time.perf_counter() - started, name)
+        return wrapper
+
+    def instrument_handlers(self, application) -> None:
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                handler.callback = self.timed_handler(handler.callback)
+
+    def instrument_db(self, db, method_names) -> None:
+        """Подменяет методы экземпляра базы обёртками с замером времени.
+        Работает и для ShardedDatabase: атрибуты экземпляра важнее __getattr__"""
+        for name in method_names:
+            method = getattr(db, name, None)
+            if callable(method):
+                setattr(db, name, self._timed_method(method, name))
+
+    def _timed_method(self, method, name: str):
+        observe = self.db_seconds.observe
+
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                observe(time.perf_counter() - started, name)
+        return wrapper
+
+    def job_submitted(self, event) -> None:
+        """Слушатель APScheduler: задержка между плановым временем и передачей задачи на выполнение"""
+        now = time.time()
+        for run_time in event.scheduled_run_times:
+            self.scheduler_lag.observe(max(0.0, now - run_time.timestamp()))
+
+    # HTTP
+
+    async def start_server(self, port: int = METRICS_PORT, host: str = METRICS_HOST) -> None:
+        if not port:
+            return
+        try:
+            self.server = await asyncio.start_server(self._serve, host, port)
+            logger.info(f"[METRICS] Метрики доступны на http://{host}:{port}/metrics")
+        except OSError as e:
+            logger.error(f"[METRICS] Не удалось открыть порт {port}: {e}")
+
+    async def stop_server(self) -> None:
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _serve(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Заголовки запроса не нужны, но их надо дочитать
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = request_line.decode('latin-1').split()
+            path = parts[1].split('?')[0] if len(parts) > 1 else '/'
+            route = self.routes.get(path)
+            if parts and parts[0] == 'GET' and route:
+                status, body = '200 OK', route()
+            else:
+                status, body = '404 Not Found', 'not found\n'
+            payload = body.encode('utf-8')
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(payload)}\r\nConnection: close\r\n\r\n".encode('latin-1') + payload
+            )
+            await writer.drain()
+        except Exception as e:
+            logger.warning(f"[METRICS] Ошибка обработки запроса: {e}")
+        finally:
+            writer.close()
+
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest, который считает вызовы Bot API по методу и исходу"""
+
+    def __init__(self, metrics: Metrics, **kwargs):
+        super().__init__(**kwargs)
+        self.metrics = metrics
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        started = time.perf_counter()
+        outcome = 'network'
+        try:
+            code, payload = await super().do_request(url, method, request_data, **kwargs)
+            outcome = 'ok' if code == 200 else '429' if code == 429 else 'error'
+            return code, payload
+        finally:
+            self.metrics.api_seconds.observe(time.perf_counter() - started, api_method, outcome)
+
+# Метрики процесса: один реестр на процесс (у каждого шарда свой)
+metrics = Metrics()
@@ -1,16 +1,29 @@
+import io
 import os
 import logging
 import asyncio
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, constants
-from telegram.ext import ApplicationBuilder, ChatMemberHandler, CallbackContext, CallbackQueryHandler, filters, MessageHandler, CommandHandler
+import threading
+from collections import deque
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, LinkPreviewOptions, constants
+from telegram.error import BadRequest, Forbidden, RetryAfter
+from telegram.ext import ApplicationBuilder, ApplicationHandlerStop, ChatMemberHandler, CallbackContext, CallbackQueryHandler, filters, MessageHandler, CommandHandler, TypeHandler
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.events import EVENT_JOB_SUBMITTED
 from apscheduler.triggers.cron import CronTrigger
 from datetime import datetime, timedelta
 import pytz
 import locale
-from DB import Database
-from Message import Message
-from enum import Enum, auto
+from DB import Database, VOTE_NONE, VOTE_PARTICIPATE, VOTE_MAYBE, WEEK_DAYS
+from Message import Message, DEFAULT_IMAGE_URL, TEXT_LIMIT, CAPTION_LIMIT
+from Archive import RosterArchive
+from Auth import AdminAuth
+from Handoff import InstanceHandoff, HEARTBEAT_INTERVAL
+from Sessions import SessionStore, MessageState
+from Metrics import metrics, MeteredRequest, METRICS_PORT
+from Watchdog import watchdog
+from Profiler import profiler, memory
+from LogPipeline import VOTE_LOGGER, setup_logging, bind, bind_update
+from Maintenance import DatabaseMaintenance
 
 locale.setlocale(locale.LC_ALL, 'ru_RU.UTF-8')
 
@@ -22,27 +35,66 @@ def get_bot_token():
         logging.error("Файл token.txt не найден!")
         return None
 
-log_filename = "logs/" + datetime.now().strftime("%d-%m-%Y") + ".log"
-os.makedirs("logs", exist_ok=True)
-
-file_handler = logging.FileHandler(log_filename, encoding='utf-8')
-stream_handler = logging.StreamHandler()
-
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO,
-    handlers=[file_handler, stream_handler]
-)
+# Логи пишутся через очередь: файл с ротацией обслуживает отдельный поток (см. LogPipeline.py)
+setup_logging()
 
 logger = logging.getLogger(__name__)
+# Строка на каждый голос: этот логгер сэмплируется
+vote_logger = logging.getLogger(VOTE_LOGGER)
 
 async def error_handler(update: Update, context: CallbackContext):
     logger.error(msg="Ошибка в обработчике Telegram:", exc_info=context.error)
 
-class MessageState(Enum):
-    DEFAULT = auto()
-    TEXT = auto()
-    TIME = auto()
+def retry_after_seconds(error: RetryAfter) -> float:
+    """Пауза, которую просит Telegram, в секундах"""
+    retry_after = error.retry_after
+    if isinstance(retry_after, timedelta):
+        retry_after = retry_after.total_seconds()
+    return retry_after
+
+# Сколько дней журнал голосов хранится без сворачивания в снимки
+JOURNAL_RETENTION_DAYS = 28
+
+# Мероприятие уходит в архив после DORMANT_MAX_FAILURES неудачных отправок подряд
+# или если DORMANT_IDLE_WEEKS недель на него никто не записывался
+DORMANT_MAX_FAILURES = 3
+DORMANT_IDLE_WEEKS = 8
+
+# Обслуживание базы ждёт затишья в голосовании не дольше MAINTENANCE_MAX_WAIT секунд
+MAINTENANCE_POLL = 60
+MAINTENANCE_MAX_WAIT = 30 * 60
+
+# Сколько найденных мероприятий показывать на одной странице поиска
+SEARCH_PAGE_SIZE = 10
+
+# Пауза между вызовами Bot API в массовых операциях и частота отчёта о прогрессе
+BULK_API_INTERVAL = 0.1
+BULK_PROGRESS_EVERY = 20
+
+# Сколько запросов к Bot API одновременно делает рассылка мероприятия по чатам
+BROADCAST_CONCURRENCY = 5
+
+# Полный текст после голосования обновляется, когда голоса затихают на REFRESH_QUIET секунд,
+# но не позже REFRESH_MAX_DELAY секунд после первого необновлённого голоса
+REFRESH_QUIET = 3
+REFRESH_MAX_DELAY = 15
+
+# Сколько участников показывать на одной странице полного списка
+ROSTER_PAGE_SIZE = 30
+
+# Сколько мероприятий показывать на одной странице посещаемости
+STATS_PAGE_SIZE = 15
+
+# История встреч мероприятия из архива составов: за сколько дней и сколько последних встреч показывать
+HISTORY_DAYS = 183
+HISTORY_ROWS = 26
+
+# Ссылки на профили участников в тексте не должны разворачиваться в превью
+NO_PREVIEW = LinkPreviewOptions(is_disabled=True)
+
+# Операторы бота: только им доступны /stalls, /profile и /memory. Стеки и память процесса
+# не должны видеть админы чатов. Переменная MTG_OWNER_ID - id через запятую
+OPERATOR_IDS = frozenset(int(user_id) for user_id in os.environ.get('MTG_OWNER_ID', '').split(',') if user_id.strip())
 
 class MtgBot:
     def escape_markdown_v2(self, text: str) -> str:
@@ -55,17 +107,26 @@ class MtgBot:
         hours, minutes = map(int, str_to_f.split(':'))
         return f"{hours:02d}:{minutes:02d}"
     
-    def __init__(self):
-        self.db = Database()
+    def __init__(self, db: Database = None, archive: RosterArchive = None):
+        self.db = db or Database()
+        self.archive = archive or RosterArchive()
         self.scheduler = None
-        self.message_state = MessageState.DEFAULT
+        self.sessions = SessionStore(self.db)
+        self.handoff = InstanceHandoff(self.db)
+        self.auth = AdminAuth(self.db)
+        self.maintenance = DatabaseMaintenance(self.db)
+        # Отложенное обновление текста: db_id -> задача и (первый, последний) голос без обновления
+        self.refresh_tasks = {}
+        self.refresh_window = {}
+        # Есть ли в закреплённом сообщении кнопка «📜 Список» по последнему полному обновлению
+        self.post_overflow = {}
+        self.api_semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
 
     async def start_command(self, update: Update, context: CallbackContext):
         context.user_data['started'] = True
         user_id = update.effective_user.id
-        chat_id = self.db.get_admin_chat(user_id)
         
-        if chat_id:
+        if self.auth.is_admin(user_id):
             await self.send_admin_panel(update, context, user_id)  # Исправленный вызов
         else:
             await update.message.reply_text(
@@ -76,8 +137,10 @@ class MtgBot:
     async def send_admin_panel(self, update: Update, context: CallbackContext, user_id: int):
         """Показывает админ-панель"""
         keyboard = [
-            [InlineKeyboardButton("📋 Мои мероприятия", callback_data="a_messages")],
-            [InlineKeyboardButton("➕ Создать мероприятие", callback_data="a_create")],
+            [InlineKeyboardButton("📋 Мои мероприятия", callback_data="a_messages"),
+             InlineKeyboardButton("📊 Посещаемость", callback_data="a_stats")],
+            [InlineKeyboardButton("➕ Создать мероприятие", callback_data="a_create"),
+             InlineKeyboardButton("🔍 Поиск", callback_data="a_search")],
         ]
         
         text = "🎮 **Админ-панель**\n\nВыберите действие:"
@@ -98,9 +161,12 @@ class MtgBot:
     async def init_scheduler(self, application):
         self.scheduler = AsyncIOScheduler()
         self.bot = application.bot
+        self.application = application
+        self.scheduler.add_listener(metrics.job_submitted, EVENT_JOB_SUBMITTED)
         self.scheduler.start()
 
-        for message in self.db.init_load_all():
+        messages = self.db.init_load_all()
+        for message in messages:
             if message.trigger:
                 self.scheduler.add_job(
                     self.send_scheduled_message,
@@ -109,6 +175,120 @@ class MtgBot:
                     id=f"message_{message.db_id}"
                 )
 
+        # Отправки, пропущенные пока бот перезапускался
+        for message in self.handoff.missed_since_last_tick(messages):
+            logger.info(f"[HANDOFF] Догоняем пропущенную отправку мероприятия {message.db_id}")
+            self.scheduler.add_job(self.send_scheduled_message, args=[message.db_id])
+
+        # Сообщения, которые предыдущий экземпляр не успел обновить
+        for db_id in list(self.handoff.pending_refresh):
+            try:
+                await self.update_message(application, self.db.load_message(db_id))
+            except Exception as e:
+                logger.warning(f"[HANDOFF] Не удалось обновить сообщение {db_id}: {e}")
+            finally:
+                # Одной попытки после перезапуска достаточно
+                self.handoff.pending_refresh.discard(db_id)
+
+        self.scheduler.add_job(
+            self.compact_vote_journal,
+            trigger=CronTrigger(hour=4, minute=30, timezone=pytz.timezone("Europe/Moscow")),
+            id="compact_vote_journal"
+        )
+
+        self.scheduler.add_job(
+            self.archive_dormant_events,
+            trigger=CronTrigger(hour=4, minute=45, timezone=pytz.timezone("Europe/Moscow")),
+            id="archive_dormant_events"
+        )
+
+        # После сворачивания журнала и архивации: освободившиеся страницы сразу возвращаются файлу
+        self.scheduler.add_job(
+            self.maintain_database,
+            trigger=CronTrigger(hour=5, minute=0, timezone=pytz.timezone("Europe/Moscow")),
+            id="maintain_database"
+        )
+
+        self.scheduler.add_job(
+            self.handoff_heartbeat,
+            trigger='interval',
+            seconds=HEARTBEAT_INTERVAL,
+            id="handoff_heartbeat"
+        )
+
+    async def compact_vote_journal(self):
+        """Держит журнал голосов ограниченным: старые записи сворачиваются в снимки"""
+        cutoff = datetime.now(pytz.utc) - timedelta(days=JOURNAL_RETENTION_DAYS)
+        try:
+            self.db.compact_journal(int(cutoff.timestamp()))
+        except Exception as e:
+            logger.error(f"Не удалось свернуть журнал голосов: {e}")
+
+    async def archive_dormant_events(self):
+        """Убирает из горячих таблиц и планировщика мероприятия, которые не отправляются или заброшены"""
+        idle_before = datetime.now(pytz.utc) - timedelta(weeks=DORMANT_IDLE_WEEKS)
+        try:
+            dormant = self.db.find_dormant_events(DORMANT_MAX_FAILURES, int(idle_before.timestamp()))
+            archived = self.db.archive_events(dormant)
+        except Exception as e:
+            logger.error(f"Не удалось перенести мероприятия в архив: {e}")
+            return
+        
+        for db_id in archived:
+            self.forget_event(db_id)
+        if archived:
+            logger.info("[ARCHIVE] В архив перенесено мероприятий: %s (%s)", len(archived),
+                        ', '.join(f"{db_id}: {reason}" for db_id, reason in dormant))
+
+    def forget_event(self, db_id: int):
+        """Убирает мероприятие из планировщика, отложенных обновлений и кэшей в памяти"""
+        self.unschedule(db_id)
+        task = self.refresh_tasks.pop(db_id, None)
+        if task:
+            task.cancel()
+        self.refresh_window.pop(db_id, None)
+        self.auth.invalidate_event(db_id)
+        self.post_overflow.pop(db_id, None)
+        self.handoff.pending_refresh.discard(db_id)
+
+    async def maintain_database(self):
+        """Ночное обслуживание базы. Пока идёт голосование (есть отложенные обновления), ждём"""
+        waited = 0
+        while self.refresh_tasks and waited < MAINTENANCE_MAX_WAIT:
+            await asyncio.sleep(MAINTENANCE_POLL)
+            waited += MAINTENANCE_POLL
+        try:
+            await self.maintenance.run()
+        except Exception as e:
+            logger.error(f"Не удалось выполнить обслуживание базы: {e}")
+
+    async def handoff_heartbeat(self):
+        self.sessions.flush()
+        if self.handoff.heartbeat():
+            # Новый экземпляр ждёт: дорабатываем очередь обновлений и выходим
+            self.application.stop_running()
+
+    async def shutdown(self, application):
+        # Отложенные обновления не ждём: они остались в pending_refresh и будут выполнены после перезапуска
+        for task in self.refresh_tasks.values():
+            task.cancel()
+        if self.scheduler and self.scheduler.running:
+            self.scheduler.shutdown(wait=False)
+        self.archive.close()
+        self.sessions.flush()
+        self.handoff.release()
+
+    async def skip_processed_update(self, update: Update, context: CallbackContext):
+        """Пропускает обновления, уже обработанные предыдущим экземпляром"""
+        # Все записи лога при обработке обновления несут его чат, пользователя и мероприятие
+        bind_update(update)
+        if self.handoff.is_duplicate(update.update_id):
+            logger.info("[HANDOFF] Обновление %s уже обработано, пропускаем", update.update_id)
+            raise ApplicationHandlerStop
+
+    async def mark_update_processed(self, update: Update, context: CallbackContext):
+        self.handoff.mark_processed(update.update_id)
+
     async def reschedule(self, day_of_week: str, hour: int, minute: int = 0, db_id: int = None):
         if db_id is None:
             logger.error("reschedule вызван без db_id")
@@ -137,7 +317,14 @@ class MtgBot:
         )
         logger.info(f"Расписание обновлено: {day_of_week} в {hour}:{minute:02d} (GMT+3)")
 
+    def unschedule(self, db_id: int):
+        """Убирает задачу отправки мероприятия из планировщика"""
+        job = self.scheduler.get_job(f"message_{db_id}")
+        if job:
+            job.remove()
+
     async def send_scheduled_message(self, db_id):
+        bind(db_id=db_id)
         max_retries = 1
         for attempt in range(max_retries):
             try:
@@ -146,6 +333,8 @@ class MtgBot:
             except Exception as e:
                 if attempt == max_retries - 1:
                     logger.error(f"Сообщение {db_id} не найдено после {max_retries} попыток: {e}")
+                    # Мероприятия нет в базе - задача без него не нужна
+                    self.unschedule(db_id)
                     return
                 await asyncio.sleep(1)
         
@@ -153,68 +342,165 @@ class MtgBot:
             return
 
         if message.participants or message.maybe_participants:
+            # Состав прошедшей встречи уходит в архив фоновой записью
+            self.archive.submit(message)
             message.participants = []
             message.maybe_participants = []
-            try:
-                self.db.save_message(message)
-            except Exception as e:
-                logger.error(f"Не удалось очистить голоса для message {db_id}: {e}")
+        
+        # Встреча закрывается даже с пустым составом: это прерывает серии посещений
+        try:
+            self.db.reset_roster(db_id)
+        except Exception as e:
+            logger.error(f"Не удалось очистить голоса для message {db_id}: {e}")
 
-        for attempt in range(max_retries):
-            try:
-                if message.pin_id:
-                    try:
-                        # Открепляем старое сообщение - БЕЗ message_thread_id
-                        await self.bot.unpin_chat_message(
-                            chat_id=message.chat_id,
-                            message_id=message.pin_id
-                        )
-                    except Exception as e:
-                        logger.warning(f"Не удалось открепить старое сообщение: {e}")
-
-                # Подготавливаем параметры для отправки
-                send_params = {
-                    'text': message.generate_message_text(),
-                    'chat_id': message.chat_id,
-                    'reply_markup': self.get_keyboard(message),
-                    'parse_mode': constants.ParseMode.MARKDOWN_V2,
-                }
-                
-                # Добавляем message_thread_id если указан
-                if message.message_thread_id:
-                    send_params['message_thread_id'] = message.message_thread_id
-                
-                msg = await self.bot.send_message(**send_params)
-                
-                message.pin_id = msg.message_id
-                self.db.save_message(message)
+        # Фото с подписью, если текст мероприятия помещается в подпись
+        media = self.get_event_media(message)
+        message.pin_media = bool(media) and message.fits(CAPTION_LIMIT)
+        text, reply_markup = self.render_post(message)
+        
+        # Основная копия и копии в других чатах отправляются одновременно
+        posts = [(message.chat_id, message.message_thread_id, message.pin_id)]
+        posts += [(chat_id, thread_id, pin_id) for chat_id, thread_id, pin_id, _ in self.db.get_message_posts(db_id)]
+        results = await asyncio.gather(*(
+            self.publish_post(message, chat_id, thread_id, old_pin_id, text, reply_markup, media)
+            for chat_id, thread_id, old_pin_id in posts
+        ))
+        
+        if results[0]:
+            message.pin_id, message.pin_media = results[0]
+            self.db.save_message(message)
+        # Неудачи подряд копятся, пока archive_dormant_events не уберёт мероприятие в архив
+        self.db.record_send_result(db_id, bool(results[0]))
+        copies = [(chat_id, *result) for (chat_id, _, _), result in zip(posts[1:], results[1:]) if result]
+        if copies:
+            self.db.save_post_pins(db_id, copies)
 
-                # Закрепляем сообщение
+    async def publish_post(self, message, chat_id, thread_id, old_pin_id, text, reply_markup, media):
+        """Отправляет и закрепляет одну копию мероприятия. Возвращает (pin_id, pin_media) или None"""
+        async with self.api_semaphore:
+            if old_pin_id:
+                try:
+                    # Открепляем старое сообщение - БЕЗ message_thread_id
+                    await self.bot.unpin_chat_message(chat_id=chat_id, message_id=old_pin_id)
+                except Exception as e:
+                    logger.warning(f"Не удалось открепить старое сообщение: {e}")
+            
+            # Подготавливаем параметры для отправки
+            send_params = {
+                'chat_id': chat_id,
+                'reply_markup': reply_markup,
+                'parse_mode': constants.ParseMode.MARKDOWN_V2,
+            }
+            
+            # Добавляем message_thread_id если указан
+            if thread_id:
+                send_params['message_thread_id'] = thread_id
+            
+            max_retries = 2
+            for attempt in range(max_retries):
+                try:
+                    if message.pin_media:
+                        media_id, file_id = media
+                        msg = await self.bot.send_photo(photo=file_id, caption=text, **send_params)
+                        # Вместо ссылки запоминаем file_id: следующие отправки не скачивают картинку заново
+                        sent_file_id = msg.photo[-1].file_id if msg.photo else None
+                        if sent_file_id and sent_file_id != file_id:
+                            self.db.update_media_file_id(media_id, sent_file_id)
+                    else:
+                        msg = await self.bot.send_message(text=text, link_preview_options=NO_PREVIEW, **send_params)
+                    break
+                except RetryAfter as e:
+                    if attempt == max_retries - 1:
+                        logger.error(f"Не удалось отправить мероприятие {message.db_id} в чат {chat_id}: {e}")
+                        return None
+                    await asyncio.sleep(retry_after_seconds(e))
+                except Exception as e:
+                    logger.error(f"Не удалось отправить мероприятие {message.db_id} в чат {chat_id}: {e}")
+                    return None
+            
+            try:
                 # Сообщение автоматически закрепится в том топике, куда было отправлено
                 await self.bot.pin_chat_message(
-                    chat_id=message.chat_id,
-                    message_id=message.pin_id,
+                    chat_id=chat_id,
+                    message_id=msg.message_id,
                     disable_notification=True  # Необязательно, чтобы не беспокоить участников
                 )
-                
-                logger.info(f"Запланированное сообщение отправлено в чат {message.chat_id}, топик: {message.message_thread_id or 'нет'}")
-                break
-                
             except Exception as e:
-                if attempt == max_retries - 1:
-                    logger.error(f"Не удалось отправить запланированное сообщение после {max_retries} попыток: {e}")
-                else:
-                    logger.warning(f"Ошибка при отправке, попытка {attempt + 1}: {e}")
-                    await asyncio.sleep(2)
+                logger.warning(f"Не удалось закрепить сообщение в чате {chat_id}: {e}")
+            
+            logger.info("Запланированное сообщение отправлено в чат %s, топик: %s", chat_id, thread_id or 'нет')
+            return msg.message_id, bool(msg.photo)
+
+    def get_event_media(self, message):
+        """(media_id, file_id) картинки мероприятия или None для мероприятий со ссылкой в тексте"""
+        if message.image:
+            return None
+        media_id = message.media_id or self.db.get_or_create_media('url:' + DEFAULT_IMAGE_URL, DEFAULT_IMAGE_URL)
+        media = self.db.get_media(media_id)
+        return (media_id, media[0]) if media else None
 
-    def get_keyboard(self, message):
+    def get_keyboard(self, message, overflow: bool = False):
+        participate_count, maybe_count = message.vote_counts()
         keyboard = [
             [
-                InlineKeyboardButton(f"{len(message.participants)} 👍", callback_data=f'participate_{message.db_id}'),
-                InlineKeyboardButton(f"{len(message.maybe_participants)} ❓", callback_data=f'participatemaybe_{message.db_id}'),
+                InlineKeyboardButton(f"{participate_count} 👍", callback_data=f'participate_{message.db_id}'),
+                InlineKeyboardButton(f"{maybe_count} ❓", callback_data=f'participatemaybe_{message.db_id}'),
             ]
         ]
+        if overflow:
+            keyboard.append([InlineKeyboardButton("📜 Список", callback_data=f'roster_{message.db_id}_0')])
         return InlineKeyboardMarkup(keyboard)
+
+    def render_post(self, message, pin_media: bool = None):
+        """Текст и клавиатура закреплённого сообщения в пределах лимита его типа"""
+        if pin_media is None:
+            pin_media = message.pin_media
+        text, overflow = message.render(CAPTION_LIMIT if pin_media else TEXT_LIMIT)
+        self.post_overflow[message.db_id] = overflow
+        return text, self.get_keyboard(message, overflow)
+
+    async def roster_page(self, update: Update, context: CallbackContext):
+        """Полный список участников постранично. Из группы список уходит в личку,
+        чтобы не засорять чат, листание - правкой того же личного сообщения"""
+        query = update.callback_query
+        try:
+            _, db_id, page = query.data.split('_')
+            db_id, page = int(db_id), int(page)
+            # Для заголовка хватает полей мероприятия: участники читаются только нужной страницей
+            message = self.db.load_message(db_id, with_roster=False)
+        except Exception as e:
+            logger.error(f"[ROSTER] Не удалось открыть список {query.data}: {e}")
+            await query.answer("Мероприятие не найдено")
+            return
+        
+        rows, total = self.db.get_roster_page(db_id, page * ROSTER_PAGE_SIZE, ROSTER_PAGE_SIZE)
+        pages = max(1, -(-total // ROSTER_PAGE_SIZE))
+        lines = [
+            f"{'👍' if status == 'participate' else '❓'} "
+            f"{Message.format_user({'username': username, 'full_name': full_name or str(user_id)})}"
+            for user_id, username, full_name, status in rows
+        ]
+        title = Message.escape_markdown(message.text.split('\n')[0][:100])
+        text = f"*{title}*\nСтраница {page + 1} из {pages}\n\n" + ('\n'.join(lines) or "Пока никто")
+        
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("⬅️", callback_data=f"roster_{db_id}_{page - 1}"))
+        if page + 1 < pages:
+            navigation.append(InlineKeyboardButton("➡️", callback_data=f"roster_{db_id}_{page + 1}"))
+        reply_markup = InlineKeyboardMarkup([navigation]) if navigation else None
+        
+        params = {'text': text, 'reply_markup': reply_markup,
+                  'parse_mode': constants.ParseMode.MARKDOWN_V2, 'link_preview_options': NO_PREVIEW}
+        if query.message and query.message.chat.type == constants.ChatType.PRIVATE:
+            await query.edit_message_text(**params)
+            await query.answer()
+            return
+        try:
+            await context.bot.send_message(chat_id=query.from_user.id, **params)
+            await query.answer("Список отправлен вам в личные сообщения")
+        except Forbidden:
+            await query.answer("Напишите боту /start, чтобы получить список", show_alert=True)
     
     async def update_lists(self, update: Update, context: CallbackContext):
         query = update.callback_query
@@ -228,7 +514,8 @@ class MtgBot:
             return
         
         try:
-            message = self.db.load_message(db_id)
+            # Состав не читается: для клавиатуры хватает счётчиков
+            message = self.db.load_message(db_id, with_roster=False)
             if not message:
                 await query.edit_message_text("Это сообщение больше не активно")
                 return
@@ -238,70 +525,163 @@ class MtgBot:
             return
         
         user = query.from_user
+        self.db.upsert_user(user)
         
+        vote = VOTE_NONE
         if action == 'participate':
-            if any(u['id'] == user.id for u in message.participants):
-                message.participants = [u for u in message.participants if u['id'] != user.id]
-            else:
-                message.add_participant(user)
+            vote = VOTE_PARTICIPATE
         elif action == 'participatemaybe':
-            if any(u['id'] == user.id for u in message.maybe_participants):
-                message.maybe_participants = [u for u in message.maybe_participants if u['id'] != user.id]
-            else:
-                message.add_maybe_participant(user)
+            vote = VOTE_MAYBE
         
         try:
-            self.db.save_message(message)
-            await self.update_message(context, message)
-            logger.info(f"Пользователь {user.id} проголосовал в сообщении {db_id}")
+            # В базу пишется только изменение голоса, а не весь состав.
+            # Повторное нажатие той же кнопки снимает голос
+            message.counts = self.db.record_vote(db_id, user.id, vote, toggle=True) or message.counts
+            # Счётчики на кнопках - сразу, полный текст - когда голосование затихнет
+            await self.update_markup(context, message, query.message.chat_id, query.message.message_id)
+            self.schedule_refresh(db_id)
+            vote_logger.info("Пользователь %s проголосовал в сообщении %s", user.id, db_id)
         except Exception as e:
             logger.error(f"Ошибка сохранения голоса: {e}")
             await query.edit_message_text("✅ Голос учтен!")
 
+    async def update_markup(self, context: CallbackContext, message: Message, chat_id: int, pin_id: int):
+        """Дешёвое обновление: меняет только клавиатуру со счётчиками, текст не пересылается.
+        Сразу обновляется копия, в которой нажали кнопку, остальные - вместе с текстом"""
+        if message.db_id not in self.post_overflow:
+            # Нужна ли кнопка «📜 Список», известно только после отрисовки полного текста: один раз читаем состав
+            self.render_post(self.db.load_message(message.db_id))
+        try:
+            await context.bot.edit_message_reply_markup(
+                chat_id=chat_id,
+                message_id=pin_id,
+                reply_markup=self.get_keyboard(message, self.post_overflow[message.db_id]),
+            )
+        except BadRequest as e:
+            # Счётчики не изменились (например, голос сняли и вернули) - текст всё равно обновится позже
+            logger.debug("Клавиатура сообщения %s не обновлена: %s", message.db_id, e)
+        except Exception as e:
+            logger.warning(f"Ошибка обновления счётчиков сообщения {message.db_id}: {e}")
+
+    def schedule_refresh(self, db_id: int):
+        """Откладывает обновление полного текста до затишья в голосовании"""
+        # Помечаем сразу: при перезапуске новый экземпляр обновит сообщение сам
+        self.handoff.pending_refresh.add(db_id)
+        now = asyncio.get_running_loop().time()
+        first, _ = self.refresh_window.get(db_id, (now, now))
+        self.refresh_window[db_id] = (first, now)
+        if db_id not in self.refresh_tasks:
+            self.refresh_tasks[db_id] = asyncio.create_task(self.refresh_later(db_id))
+
+    async def refresh_later(self, db_id: int):
+        loop = asyncio.get_running_loop()
+        while True:
+            first, last = self.refresh_window[db_id]
+            due = min(last + REFRESH_QUIET, first + REFRESH_MAX_DELAY)
+            if loop.time() >= due:
+                break
+            await asyncio.sleep(due - loop.time())
+        
+        # Голоса, пришедшие во время обновления, запланируют следующее
+        del self.refresh_window[db_id]
+        del self.refresh_tasks[db_id]
+        try:
+            # Состав перечитывается: за время ожидания он мог измениться
+            await self.update_message(self.application, self.db.load_message(db_id))
+        except Exception as e:
+            logger.error(f"Не удалось обновить текст сообщения {db_id}: {e}")
+
     async def update_message(self, context: CallbackContext, message: Message):
+        """Обновляет текст всех копий мероприятия одним проходом"""
+        # Помечаем до отправки: при перезапуске новый экземпляр обновит сообщение сам
+        self.handoff.pending_refresh.add(message.db_id)
+        posts = [(message.chat_id, message.pin_id, message.pin_media)]
+        posts += [
+            (chat_id, pin_id, pin_media)
+            for chat_id, _, pin_id, pin_media in self.db.get_message_posts(message.db_id) if pin_id
+        ]
+        # Текст рендерится один раз на тип сообщения (фото или текст), а не на каждую копию
+        rendered = {}
+        for _, _, pin_media in posts:
+            if pin_media not in rendered:
+                rendered[pin_media] = self.render_post(message, pin_media)
+        
+        results = await asyncio.gather(*(
+            self.edit_post(context.bot, chat_id, pin_id, pin_media, *rendered[pin_media])
+            for chat_id, pin_id, pin_media in posts
+        ))
+        if all(results):
+            self.handoff.pending_refresh.discard(message.db_id)
+
+    async def edit_post(self, bot, chat_id: int, pin_id: int, pin_media: bool, text: str, reply_markup) -> bool:
+        """Переписывает текст одной копии. True - копия обновлена"""
         max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                await context.bot.edit_message_text(
-                    chat_id=message.chat_id,
-                    message_id=message.pin_id,
-                    text=message.generate_message_text(),
-                    reply_markup=self.get_keyboard(message),
-                    parse_mode=constants.ParseMode.MARKDOWN_V2,
-                )
-                break
-            except Exception as e:
-                if attempt == max_retries - 1:
-                    logger.error(f"Ошибка при обновлении сообщения после {max_retries} попыток: {e}")
-                else:
-                    logger.warning(f"Ошибка обновления, попытка {attempt + 1}: {e}")
-                    await asyncio.sleep(1)
+        async with self.api_semaphore:
+            for attempt in range(max_retries):
+                try:
+                    if pin_media:
+                        await bot.edit_message_caption(
+                            chat_id=chat_id,
+                            message_id=pin_id,
+                            caption=text,
+                            reply_markup=reply_markup,
+                            parse_mode=constants.ParseMode.MARKDOWN_V2,
+                        )
+                    else:
+                        await bot.edit_message_text(
+                            chat_id=chat_id,
+                            message_id=pin_id,
+                            text=text,
+                            reply_markup=reply_markup,
+                            parse_mode=constants.ParseMode.MARKDOWN_V2,
+                            link_preview_options=NO_PREVIEW,
+                        )
+                    return True
+                except RetryAfter as e:
+                    logger.warning(f"Telegram просит подождать перед обновлением чата {chat_id}: {e}")
+                    await asyncio.sleep(retry_after_seconds(e))
+                except Exception as e:
+                    if attempt == max_retries - 1:
+                        logger.error(f"Ошибка при обновлении сообщения после {max_retries} попыток: {e}")
+                    else:
+                        logger.warning(f"Ошибка обновления, попытка {attempt + 1}: {e}")
+                        await asyncio.sleep(1)
+        return False
 
     async def admin_panel(self, update: Update, context: CallbackContext):
-        logger.info(f"[ADMIN_PANEL] Called by user_id: {update.effective_user.id}, data: {update.callback_query.data if update.callback_query else 'None'}")        
+        logger.debug("[ADMIN_PANEL] Called by user_id: %s, data: %s", update.effective_user.id,
+                     update.callback_query.data if update.callback_query else None)
         try:
-            self.message_state = MessageState.DEFAULT
-            context.chat_data['admin_id'] = update.effective_user.id
+            session = self.sessions.reset(update.effective_user.id)
             
             if not update.callback_query:
                 logger.error("[ADMIN_PANEL] No callback_query in update")
                 return
                 
             data = update.callback_query.data
-            logger.info(f"[ADMIN_PANEL] Raw data: '{data}'")
             
             # Создаем простой и понятный обработчик
             if data == "a_messages":
-                logger.info("[ADMIN_PANEL] Calling message_list")
+                logger.debug("[ADMIN_PANEL] Calling message_list")
                 await self.message_list(update, context)
             elif data == "a_create":
-                logger.info("[ADMIN_PANEL] Calling create_message")
+                logger.debug("[ADMIN_PANEL] Calling create_message")
                 await self.create_message(update, context)
+            elif data == "a_stats":
+                logger.debug("[ADMIN_PANEL] Calling attendance_stats")
+                await self.attendance_stats(update, context)
+            elif data == "a_search":
+                logger.debug("[ADMIN_PANEL] Waiting for search query")
+                session.state = MessageState.SEARCH
+                await update.callback_query.edit_message_text(
+                    text="Введите текст для поиска по мероприятиям:",
+                    reply_markup=self.create_back_button("a_return")
+                )
             elif data == "a_change_topic":
-                logger.info("[ADMIN_PANEL] Calling change_topic_command")
+                logger.debug("[ADMIN_PANEL] Calling change_topic_command")
                 await self.change_topic_command(update, context)
             elif data == "a_return":
-                logger.info("[ADMIN_PANEL] Calling send_admin_panel")
+                logger.debug("[ADMIN_PANEL] Calling send_admin_panel")
                 await self.send_admin_panel(update, context, update.effective_user.id)
             else:
                 logger.warning(f"[ADMIN_PANEL] Unknown command: {data}")
@@ -321,7 +701,7 @@ class MtgBot:
 
     async def message_list(self, update: Update, context: CallbackContext, admin_id: int = None):
         """Показывает все мероприятия из всех чатов администратора"""
-        logger.info(f"[MESSAGE_LIST] Called for admin_id: {admin_id}")
+        logger.debug("[MESSAGE_LIST] Called for admin_id: %s", admin_id)
         
         if admin_id is None:
             if update.callback_query:
@@ -429,14 +809,148 @@ class MtgBot:
                     reply_markup=self.create_back_button("a_return")
                 )
 
+    async def attendance_stats_page(self, update: Update, context: CallbackContext):
+        await update.callback_query.answer()
+        _, page = update.callback_query.data.split('_')
+        await self.attendance_stats(update, context, page=int(page))
+
+    async def attendance_stats(self, update: Update, context: CallbackContext, page: int = 0):
+        """Показывает посещаемость мероприятий и самых активных участников чатов админа постранично:
+        сначала мероприятия по STATS_PAGE_SIZE на странице, затем по странице на каждый чат"""
+        admin_id = update.effective_user.id
+        messages = self.db.load_messages(admin_id)
+        
+        if not messages:
+            await update.callback_query.edit_message_text(
+                text="📭 Статистики пока нет: у вас нет мероприятий.",
+                reply_markup=self.create_back_button("a_return")
+            )
+            return
+        
+        chats = self.db.get_admin_chats(admin_id)
+        event_pages = -(-len(messages) // STATS_PAGE_SIZE)
+        pages = event_pages + len(chats)
+        page = min(max(page, 0), pages - 1)
+        
+        if page < event_pages:
+            text = "📊 *Посещаемость*\n\n"
+            for msg in messages[page * STATS_PAGE_SIZE:(page + 1) * STATS_PAGE_SIZE]:
+                event_name = msg['text'].split('\n')[0] if msg['text'] else "Без названия"
+                if len(event_name) > 30:
+                    event_name = event_name[:27] + "..."
+                
+                stats = self.db.get_event_stats(msg['id'])
+                if not stats or not stats[0]:
+                    text += f"• {self.escape_markdown_v2(event_name)}: встреч ещё не было\n"
+                    continue
+                
+                occurrences, attended_total, maybe_total, _ = stats
+                average = f"{attended_total / occurrences:.1f}"
+                text += (
+                    f"• {self.escape_markdown_v2(event_name)}: {occurrences} встреч, "
+                    f"в среднем {self.escape_markdown_v2(average)} участников\n"
+                )
+        else:
+            chat_id = chats[page - event_pages]
+            try:
+                chat = await context.bot.get_chat(chat_id)
+                chat_title = chat.title or f"Чат {chat_id}"
+            except Exception as e:
+                logger.error(f"Error getting chat info: {e}")
+                chat_title = f"Чат {chat_id}"
+            
+            text = f"📊 *{self.escape_markdown_v2(chat_title)}*\n\n"
+            top = self.db.get_top_attendees(chat_id)
+            if not top:
+                text += "Встреч ещё не было\n"
+            for place, (user_id, username, full_name, attended, streak, best_streak) in enumerate(top, 1):
+                name = full_name or username or str(user_id)
+                text += (
+                    f"{place}\\. {self.escape_markdown_v2(name)} \\- {attended} "
+                    f"\\(серия {streak}, лучшая {best_streak}\\)\n"
+                )
+        text += f"\nСтраница {page + 1} из {pages}"
+        
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("⬅️", callback_data=f"stats_{page - 1}"))
+        if page + 1 < pages:
+            navigation.append(InlineKeyboardButton("➡️", callback_data=f"stats_{page + 1}"))
+        keyboard = ([navigation] if navigation else []) + [[InlineKeyboardButton("🔙 Назад", callback_data="a_return")]]
+        
+        await update.callback_query.edit_message_text(
+            text=text,
+            parse_mode=constants.ParseMode.MARKDOWN_V2,
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+
+    async def search_command(self, update: Update, context: CallbackContext):
+        """Команда /search <текст> - поиск по мероприятиям админа"""
+        if update.effective_chat.type != "private":
+            await update.message.reply_text("Эта команда работает только в личных сообщениях")
+            return
+        
+        session = self.sessions.get(update.effective_user.id)
+        if not context.args:
+            session.state = MessageState.SEARCH
+            await update.message.reply_text("Введите текст для поиска по мероприятиям:")
+            return
+        
+        session.search_query = ' '.join(context.args)
+        await self.show_search_results(update, context, page=0)
+
+    async def search_page_callback(self, update: Update, context: CallbackContext):
+        await update.callback_query.answer()
+        _, page = update.callback_query.data.split('_')
+        await self.show_search_results(update, context, page=int(page))
+
+    async def show_search_results(self, update: Update, context: CallbackContext, page: int):
+        """Показывает страницу результатов поиска с кнопками перехода к мероприятиям"""
+        # Выбор мероприятия из результатов идёт через обычный message_render
+        session = self.sessions.get(update.effective_user.id)
+        session.state = MessageState.DEFAULT
+        query = session.search_query or ''
+        
+        # Берём на одну запись больше, чтобы понять, есть ли следующая страница
+        rows = self.db.search_messages(
+            update.effective_user.id, query, SEARCH_PAGE_SIZE + 1, page * SEARCH_PAGE_SIZE
+        )
+        has_next = len(rows) > SEARCH_PAGE_SIZE
+        rows = rows[:SEARCH_PAGE_SIZE]
+        
+        if rows:
+            text = f"🔍 Найдено по запросу «{query}», страница {page + 1}:"
+        else:
+            text = f"🔍 По запросу «{query}» ничего не найдено."
+        
+        keyboard = []
+        for db_id, chat_id, event_text, day_of_week, time in rows:
+            event_name = event_text.split('\n')[0] if event_text else "Без названия"
+            if len(event_name) > 30:
+                event_name = event_name[:27] + "..."
+            keyboard.append([InlineKeyboardButton(f"✏️ {event_name} ({day_of_week or '-'} {time})", callback_data=f"s_{db_id}")])
+        
+        navigation = []
+        if page > 0:
+            navigation.append(InlineKeyboardButton("⬅️", callback_data=f"q_{page - 1}"))
+        if has_next:
+            navigation.append(InlineKeyboardButton("➡️", callback_data=f"q_{page + 1}"))
+        if navigation:
+            keyboard.append(navigation)
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data="a_return")])
+        
+        if update.callback_query:
+            await update.callback_query.edit_message_text(text=text, reply_markup=InlineKeyboardMarkup(keyboard))
+        else:
+            await update.message.reply_text(text=text, reply_markup=InlineKeyboardMarkup(keyboard))
+
     def create_back_button(self, callback_data: str = "a_return"):
         """Создает кнопку возврата"""
         keyboard = [[InlineKeyboardButton("🔙 Назад", callback_data=callback_data)]]
         return InlineKeyboardMarkup(keyboard)
 
     async def message_render(self, update: Update, context: CallbackContext):
-        context.chat_data['week'] = {'mon': 'Пн','tue': 'Вт','wed': 'Ср','thu': 'Чт','fri': 'Пт','sat': 'Сб','sun': 'Вс'}
-        
+        session = self.sessions.get(update.effective_user.id)
         message_id = None
         if update.callback_query and update.callback_query.data:
             try:
@@ -445,14 +959,20 @@ class MtgBot:
                 pass
         
         if not message_id:
-            message_id = context.chat_data.get('db_id')
+            message_id = session.db_id
         
         if not message_id:
             logger.error("[MESSAGE_RENDER] Cannot retrieve message_id")
             await update.callback_query.answer("Ошибка: не найден ID сообщения")
             return
         
-        context.chat_data['db_id'] = message_id
+        if not self.auth.owns_event(update.effective_user.id, int(message_id)):
+            logger.warning(f"[MESSAGE_RENDER] User {update.effective_user.id} has no access to message {message_id}")
+            if update.callback_query:
+                await update.callback_query.answer("Нет доступа к этому мероприятию", show_alert=True)
+            return
+        
+        session.db_id = int(message_id)
         
         try:
             message = self.db.load_message(int(message_id))
@@ -464,29 +984,33 @@ class MtgBot:
         keyboard = [
             [InlineKeyboardButton("Текст", callback_data=f"m_text"), InlineKeyboardButton("Удалить", callback_data=f"m_delete")],
             [InlineKeyboardButton("Список", callback_data="a_messages"),InlineKeyboardButton("Перенести", callback_data=f"m_reschedule")],
-            [InlineKeyboardButton("Меню", callback_data="a_return")]
+            [InlineKeyboardButton("Картинка", callback_data="m_image"), InlineKeyboardButton("Другие чаты", callback_data="m_copies")],
+            [InlineKeyboardButton("История", callback_data="m_history"), InlineKeyboardButton("Меню", callback_data="a_return")]
         ]
         
         message_text = message.generate_message_text()
         
         try:
-            if self.message_state == MessageState.DEFAULT:
+            if update.callback_query:
                 await update.callback_query.edit_message_text(
                     text=message_text,
                     reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode=constants.ParseMode.MARKDOWN_V2)
+                    parse_mode=constants.ParseMode.MARKDOWN_V2,
+                    link_preview_options=NO_PREVIEW)
             else:
                 await context.bot.edit_message_text(
                     chat_id=update.effective_chat.id,
-                    message_id=context.chat_data['edit_id'].message_id,
+                    message_id=session.edit_id,
                     text=message_text,
                     reply_markup=InlineKeyboardMarkup(keyboard),
-                    parse_mode=constants.ParseMode.MARKDOWN_V2)
+                    parse_mode=constants.ParseMode.MARKDOWN_V2,
+                    link_preview_options=NO_PREVIEW)
         except Exception as e:
             logger.error(f"[MESSAGE_RENDER] Error displaying message: {e}")
 
     async def message_menu(self, update: Update, context: CallbackContext):
-        self.message_state = MessageState.DEFAULT
+        session = self.sessions.get(update.effective_user.id)
+        session.state = MessageState.DEFAULT
         data = update.callback_query.data
         
         # Проверяем, что данные начинаются с 'm_'
@@ -501,13 +1025,23 @@ class MtgBot:
             if command == "delete":
                 await self.delete_message(update, context)
             elif command == "text":
-                self.message_state = MessageState.TEXT
-                context.chat_data['edit_id'] = await update.callback_query.edit_message_text("Введите текст: ", reply_markup=keyboard)
+                session.state = MessageState.TEXT
+                edited = await update.callback_query.edit_message_text("Введите текст: ", reply_markup=keyboard)
+                session.edit_id = edited.message_id
             elif command == "reschedule":
-                self.message_state = MessageState.TIME
+                session.state = MessageState.TIME
                 await self.admin_reschedule(update, context)
+            elif command == "copies":
+                await self.show_copy_chats(update, context)
+            elif command == "history":
+                await self.show_history(update, context)
+            elif command == "image":
+                session.state = MessageState.IMAGE
+                edited = await update.callback_query.edit_message_text(
+                    "Отправьте фото для мероприятия: ", reply_markup=keyboard)
+                session.edit_id = edited.message_id
                 
-            logger.info(f"[MESSAGE_MENU] Parsing {command}")
+            logger.debug("[MESSAGE_MENU] Parsing %s", command)
         except Exception as e:
             logger.error(f"[MESSAGE_MENU] Cannot parse command: {e}")
 
@@ -544,9 +1078,6 @@ class MtgBot:
                 chat_id = admin_chat_info
                 thread_id = None
 
-            context.chat_data['selected_chat_id'] = chat_id
-            context.chat_data['selected_thread_id'] = thread_id
-            
             message = Message()
             message.chat_id = chat_id
             message.message_thread_id = thread_id
@@ -554,8 +1085,9 @@ class MtgBot:
             message.maybe_participants = []
 
             message = self.db.save_message(message)
-            context.chat_data['db_id'] = message.db_id
-            self.message_state = MessageState.TIME
+            session = self.sessions.get(admin_id)
+            session.db_id = message.db_id
+            session.state = MessageState.TIME
             await self.admin_reschedule(update, context)
         else:
             # Если несколько чатов - показываем выбор с информацией о топиках
@@ -604,6 +1136,89 @@ class MtgBot:
             parse_mode=constants.ParseMode.MARKDOWN_V2
         )
     
+    def read_history(self, db_id: int, since: int) -> list:
+        """Последние встречи мероприятия из архива: [(время, участвуют, возможно), ...]"""
+        return list(deque(self.archive.scan(db_id, since, with_roster=False), maxlen=HISTORY_ROWS))
+
+    async def show_history(self, update: Update, context: CallbackContext):
+        """Встречи мероприятия за полгода. Читается диапазон архива по ключу (мероприятие, время),
+        составы не распаковываются"""
+        session = self.sessions.get(update.effective_user.id)
+        since = int((datetime.now() - timedelta(days=HISTORY_DAYS)).timestamp())
+        try:
+            rows = await asyncio.to_thread(self.read_history, session.db_id, since)
+        except Exception as e:
+            logger.error(f"[HISTORY] Не удалось прочитать архив мероприятия {session.db_id}: {e}")
+            await update.callback_query.answer("Архив недоступен")
+            return
+        
+        moscow_tz = pytz.timezone("Europe/Moscow")
+        lines = [
+            f"{datetime.fromtimestamp(occurred_at, moscow_tz):%d.%m.%Y}: 👍 {participate}, ❓ {maybe}"
+            for occurred_at, participate, maybe in reversed(rows)
+        ]
+        text = "📅 Встречи за полгода\n\n" + ('\n'.join(lines) or "Встреч ещё не было")
+        await update.callback_query.edit_message_text(
+            text=text,
+            reply_markup=self.create_back_button(f"s_{session.db_id}")
+        )
+
+    async def show_copy_chats(self, update: Update, context: CallbackContext):
+        """Чаты админа, в которые мероприятие рассылается вместе с основным. Нажатие переключает чат"""
+        db_id = self.sessions.get(update.effective_user.id).db_id
+        message = self.db.load_message(db_id)
+        copies = {chat_id for chat_id, _, _, _ in self.db.get_message_posts(db_id)}
+        
+        keyboard = []
+        for chat_id, _ in self.db.get_admin_chats_with_threads(update.effective_user.id):
+            if chat_id == message.chat_id:
+                continue
+            try:
+                chat = await context.bot.get_chat(chat_id)
+                chat_title = chat.title or f"Чат {chat_id}"
+            except Exception as e:
+                logger.error(f"Ошибка получения информации о чате {chat_id}: {e}")
+                chat_title = f"Чат {chat_id}"
+            mark = "✅" if chat_id in copies else "▫️"
+            keyboard.append([InlineKeyboardButton(f"{mark} {chat_title}", callback_data=f"copy_{chat_id}")])
+        
+        keyboard.append([InlineKeyboardButton("🔙 Назад", callback_data=f"s_{db_id}")])
+        text = "Отметьте чаты, куда ещё публиковать мероприятие. Голоса из всех чатов попадают в один список"
+        if len(keyboard) == 1:
+            text = "Других чатов нет: добавьте бота в чат и выполните там /set_admin"
+        await update.callback_query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+    async def toggle_copy_chat(self, update: Update, context: CallbackContext):
+        query = update.callback_query
+        db_id = self.sessions.get(update.effective_user.id).db_id
+        chat_id = int(query.data.split('_', 1)[1])
+        
+        threads = dict(self.db.get_admin_chats_with_threads(update.effective_user.id))
+        if chat_id not in threads or not self.auth.owns_event(update.effective_user.id, db_id):
+            await query.answer("Вы не администратор этого чата", show_alert=True)
+            return
+        await query.answer()
+        
+        if self.db.add_message_post(db_id, chat_id, threads[chat_id]):
+            # Мероприятие уже опубликовано на этой неделе - публикуем и новую копию, не дожидаясь расписания
+            message = self.db.load_message(db_id)
+            if message.pin_id:
+                text, reply_markup = self.render_post(message)
+                result = await self.publish_post(
+                    message, chat_id, threads[chat_id], None, text, reply_markup, self.get_event_media(message)
+                )
+                if result:
+                    self.db.save_post_pins(db_id, [(chat_id, *result)])
+        else:
+            pin_id = self.db.remove_message_post(db_id, chat_id)
+            if pin_id:
+                try:
+                    await context.bot.unpin_chat_message(chat_id=chat_id, message_id=pin_id)
+                except Exception as e:
+                    logger.warning(f"Не удалось открепить копию мероприятия в чате {chat_id}: {e}")
+        
+        await self.show_copy_chats(update, context)
+
     async def handle_create_chat_selection(self, update: Update, context: CallbackContext):
         query = update.callback_query
         await query.answer()
@@ -612,9 +1227,9 @@ class MtgBot:
         chat_id = int(chat_id_str)
         thread_id = None if thread_id_str == 'none' else int(thread_id_str)
         
-        # Сохраняем выбранный чат и топик
-        context.chat_data['selected_chat_id'] = chat_id
-        context.chat_data['selected_thread_id'] = thread_id
+        if not self.auth.is_chat_admin(update.effective_user.id, chat_id):
+            await query.edit_message_text("Вы не являетесь администратором этого чата")
+            return
         
         # Создаем сообщение для выбранного чата
         message = Message()
@@ -624,15 +1239,16 @@ class MtgBot:
         message.maybe_participants = []
 
         message = self.db.save_message(message)
-        context.chat_data['db_id'] = message.db_id
-        self.message_state = MessageState.TIME
+        session = self.sessions.get(update.effective_user.id)
+        session.db_id = message.db_id
+        session.state = MessageState.TIME
         await self.admin_reschedule(update, context)
 
     async def delete_message(self, update: Update, context: CallbackContext):
         replayer = update.message or update.callback_query.message
-        db_id = context.chat_data['db_id']
+        db_id = self.sessions.get(update.effective_user.id).db_id
         
-        if not self.db.get_admin_chat(update.effective_user.id):
+        if not db_id or not self.auth.owns_event(update.effective_user.id, db_id):
             await replayer.reply_text("Эта команда доступна только админам")
             return
             
@@ -641,13 +1257,17 @@ class MtgBot:
             await replayer.reply_text("В этом чате нет активного сообщения")
             return
         
+        copies = self.db.get_message_posts(db_id)
         self.db.delete_message(db_id)
+        self.auth.invalidate_event(db_id)
         
-        try:
-            if message.pin_id:
-                await context.bot.unpin_chat_message(chat_id=message.chat_id, message_id=message.pin_id)
-        except Exception as e:
-            logger.error(f"[DELETER] Cannot unpin message: {e}")
+        pins = [(message.chat_id, message.pin_id)] + [(chat_id, pin_id) for chat_id, _, pin_id, _ in copies]
+        for chat_id, pin_id in pins:
+            try:
+                if pin_id:
+                    await context.bot.unpin_chat_message(chat_id=chat_id, message_id=pin_id)
+            except Exception as e:
+                logger.error(f"[DELETER] Cannot unpin message: {e}")
             
         await self.message_list(update, context)
 
@@ -657,8 +1277,11 @@ class MtgBot:
             await replayer.reply_text("Эта команда работает только в личных сообщениях")
             return
             
-        message_id = context.chat_data['db_id']
-        context.chat_data['message'] = self.db.load_message(message_id)
+        # В сессии хранится только черновик дня и времени, а не объект мероприятия
+        session = self.sessions.get(update.effective_user.id)
+        message = self.db.load_message(session.db_id)
+        session.draft_day = None
+        session.draft_time = self.format_time(message.time)
         
         days = [
             ["Пн", "mon"], ["Вт", "tue"], ["Ср", "wed"], ["Чт", "thu"],
@@ -667,10 +1290,11 @@ class MtgBot:
         keyboard = [[InlineKeyboardButton(day[0], callback_data=f"day_{day[1]}")] for day in days]
         keyboard.append([InlineKeyboardButton("Меню", callback_data="a_return")])
         
-        context.chat_data['edit_id'] = await replayer.edit_text(
+        edited = await replayer.edit_text(
             "Выберите день недели:",
             reply_markup=InlineKeyboardMarkup(keyboard)
         )
+        session.edit_id = edited.message_id
 
     async def day_callback(self, update: Update, context: CallbackContext):
         query = update.callback_query
@@ -682,18 +1306,14 @@ class MtgBot:
         if selected_day == "to":
             selected_day = week[datetime.now(pytz.timezone('Europe/Moscow')).weekday()]
     
-        context.chat_data['message'].day_of_week = selected_day
-        notice_day_index = week.index(selected_day)
-        context.chat_data['message'].day_of_notice = week[notice_day_index]
-    
-        h, m = context.chat_data['message'].time.split(":")
-        context.chat_data['message'].time = f"{int(h):02d}:{int(m):02d}"
+        session = self.sessions.get(update.effective_user.id)
+        session.draft_day = selected_day
     
         await query.edit_message_text(
             text=f"Пожалуйста напишите час отправки\\!\n_в формате ЧЧ:ММ_",
             parse_mode=constants.ParseMode.MARKDOWN_V2,
             reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton(f"Оставить нынешнее ({context.chat_data['message'].time})", callback_data="keep_time")]
+                [InlineKeyboardButton(f"Оставить нынешнее ({session.draft_time})", callback_data="keep_time")]
             ])
         )
 
@@ -703,18 +1323,25 @@ class MtgBot:
             # Игнорируем сообщения в групповых чатах
             return
         
+        session = self.sessions.get(update.effective_user.id)
+        
         # Если мы в процессе изменения топика, передаем управление handle_topic_input
-        if 'change_topic_chat' in context.chat_data:
+        if session.topic_chat is not None:
             await self.handle_topic_input(update, context)
             return
         
-        try:
-            message_id = context.chat_data['db_id']
-        except KeyError as e:
-            logger.error(f"[ADMIN_INPUT] Cannot retrieve message_id: {e}")
+        if session.state == MessageState.SEARCH:
+            session.search_query = update.message.text
+            await self.show_search_results(update, context, page=0)
+            return
+        
+        message_id = session.db_id
+        if not message_id:
+            logger.error("[ADMIN_INPUT] Cannot retrieve message_id")
+            await self.send_admin_panel(update, context, update.effective_user.id)
             return
         
-        if self.message_state == MessageState.TIME:
+        if session.state == MessageState.TIME:
             try:
                 time_str = update.message.text
                 hours, minutes = map(int, time_str.split(':'))
@@ -723,10 +1350,10 @@ class MtgBot:
             except:
                 await update.message.reply_text("Неверный формат времени! Используйте ЧЧ:ММ")
                 return
-            context.chat_data['message'].time = f"{hours:02d}:{minutes:02d}"
+            session.draft_time = f"{hours:02d}:{minutes:02d}"
             await self.finish_reschedule(update=update, context=context)
         
-        elif self.message_state == MessageState.TEXT:
+        elif session.state == MessageState.TEXT:
             message = self.db.load_message(message_id)
             message.text = update.message.text
             await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=update.message.message_id)
@@ -736,12 +1363,26 @@ class MtgBot:
         else:
             await self.send_admin_panel(update, context, update.effective_user.id)
 
+    async def admin_photo(self, update: Update, context: CallbackContext):
+        """Принимает картинку мероприятия. Сохраняется только file_id, сам файл остаётся у Telegram"""
+        session = self.sessions.get(update.effective_user.id)
+        if session.state != MessageState.IMAGE or not session.db_id:
+            return
+        
+        photo = update.message.photo[-1]
+        media_id = self.db.attach_media(session.db_id, photo.file_unique_id, photo.file_id)
+        logger.info(f"[ADMIN_PHOTO] Картинка {media_id} привязана к мероприятию {session.db_id}")
+        
+        await context.bot.delete_message(chat_id=update.effective_chat.id, message_id=update.message.message_id)
+        await self.message_render(update, context)
+
     async def keep_time_callback(self, update: Update, context: CallbackContext):
         await update.callback_query.answer()
         await self.finish_reschedule(update=update, context=context)
 
     async def finish_reschedule(self, update: Update, context: CallbackContext):
-        self.message_state = MessageState.DEFAULT
+        session = self.sessions.get(update.effective_user.id)
+        session.state = MessageState.DEFAULT
         message_obj = update.callback_query.message if update.callback_query else update.message
         
         try:
@@ -752,11 +1393,13 @@ class MtgBot:
         except:
             pass
 
-        current_message = context.chat_data['message']
-        if not current_message:
+        if not session.db_id or not session.draft_day or not session.draft_time:
             return
+        current_message = self.db.load_message(session.db_id)
+        current_message.day_of_week = current_message.day_of_notice = session.draft_day
+        hour, minute = map(int, session.draft_time.split(':'))
+        session.draft_day = session.draft_time = None
 
-        hour, minute = map(int, current_message.time.split(':'))
         current_message.set_trigger(current_message.day_of_notice, f"{hour:02d}:{minute:02d}")
         
         self.db.save_message(current_message)
@@ -777,8 +1420,7 @@ class MtgBot:
             return
         
         try:
-            chat_member = await context.bot.get_chat_member(chat.id, user.id)
-            if chat_member.status not in ['administrator', 'creator']:
+            if not await self.auth.is_telegram_admin(context.bot, chat.id, user.id):
                 await update.message.reply_text("Только администраторы чата могут использовать эту команду!")
                 return
         except Exception as e:
@@ -792,6 +1434,7 @@ class MtgBot:
             
             # Сохраняем админа с топиком по умолчанию
             self.db.set_chat_admin(chat.id, user.id, message_thread_id)
+            self.auth.invalidate_admin(user.id)
             
             thread_info = ""
             if message_thread_id:
@@ -824,15 +1467,23 @@ class MtgBot:
             )
 
     async def handle_migration(self, update: Update, context: CallbackContext):
-        old_chat_id = update.message.migrate_from_chat_id
-        new_chat_id = update.message.chat.id
+        # Telegram присылает два служебных сообщения: в старую группу (migrate_to_chat_id)
+        # и в новую супергруппу (migrate_from_chat_id). Какое придёт первым, то и переносит данные
+        message = update.message
+        if message.migrate_to_chat_id:
+            old_chat_id, new_chat_id = message.chat.id, message.migrate_to_chat_id
+        else:
+            old_chat_id, new_chat_id = message.migrate_from_chat_id, message.chat.id
         
         logger.info(f"Группа мигрировала. Старый ID: {old_chat_id}, новый ID: {new_chat_id}")
         
+        # Задачи планировщика хранят только id мероприятия и подхватят новый чат при отправке
         if self.db.update_chat_id(old_chat_id, new_chat_id):
             logger.info("Chat_id успешно обновлён в базе данных")
         else:
             logger.error("Ошибка при обновлении chat_id в БД")
+        self.auth.invalidate_chat(old_chat_id)
+        self.auth.invalidate_chat(new_chat_id)
 
     async def handle_chat_member_update(self, update: Update, context: CallbackContext):
         chat_member = update.my_chat_member
@@ -840,8 +1491,21 @@ class MtgBot:
 
         if new_status in ('left', 'kicked'):
             chat_id = update.effective_chat.id
-            self.db.remove_chats_data(chat_id)
-            logger.info(f"Бот удалён из чата {chat_id}")
+            removed = self.db.remove_chats_data(chat_id)
+            for db_id in removed:
+                self.forget_event(db_id)
+            self.auth.invalidate_chat(chat_id)
+            logger.info(f"Бот удалён из чата {chat_id}, удалено мероприятий: {len(removed)}")
+
+    async def handle_member_status(self, update: Update, context: CallbackContext):
+        """Изменились права участника чата: обновляем кэш и отзываем права в боте у снятых админов"""
+        chat_id = update.chat_member.chat.id
+        member = update.chat_member.new_chat_member
+        self.auth.member_updated(chat_id, member.user.id, member.status)
+        
+        if member.status not in ('administrator', 'creator') and self.db.remove_chat_admin(chat_id, member.user.id):
+            self.auth.invalidate_admin(member.user.id)
+            logger.info(f"Пользователь {member.user.id} больше не админ чата {chat_id}, права в боте отозваны")
 
     async def change_topic_command(self, update: Update, context: CallbackContext):
         """Команда для изменения топика по умолчанию для чата"""
@@ -896,9 +1560,8 @@ class MtgBot:
         chat_id = int(chat_id_str)
         admin_id = update.effective_user.id
         
-        # Сохраняем chat_id в контексте
-        context.chat_data['change_topic_chat'] = chat_id
-        context.chat_data['change_topic_admin'] = admin_id
+        # Сохраняем chat_id в сессии
+        self.sessions.get(admin_id).topic_chat = chat_id
         
         await query.edit_message_text(
             "Введите ID нового топика для этого чата.\n\n"
@@ -913,13 +1576,15 @@ class MtgBot:
         """Обработчик ввода ID топика"""
         user_input = update.message.text.strip().lower()
         admin_id = update.effective_user.id
+        session = self.sessions.get(admin_id)
         
         if user_input == 'отмена':
+            session.topic_chat = None
             await update.message.reply_text("Отменено.")
             await self.send_admin_panel(update, context, admin_id)
             return
         
-        chat_id = context.chat_data.get('change_topic_chat')
+        chat_id = session.topic_chat
         
         if not chat_id:
             await update.message.reply_text("Ошибка: чат не выбран.")
@@ -940,6 +1605,7 @@ class MtgBot:
             
             # Обновляем в базе данных
             self.db.update_chat_thread(chat_id, admin_id, thread_id)
+            session.topic_chat = None
             
             await update.message.reply_text(message_text)
             await self.send_admin_panel(update, context, admin_id)
@@ -950,49 +1616,353 @@ class MtgBot:
             logger.error(f"Ошибка при обновлении топика: {e}")
             await update.message.reply_text(f"Ошибка: {str(e)}")
 
-if __name__ == '__main__':
-    bot = MtgBot()
-    token = get_bot_token()
-    if not token:
-        exit("Ошибка: не удалось загрузить токен бота")
+    # Массовые операции
 
-    # Пробуем с прокси, если не работает - без прокси
-    https_proxy = os.environ.get('HTTPS_PROXY')
-    
-    try:
-        if https_proxy:
-            application = ApplicationBuilder().token(token).proxy(https_proxy).build()
-            print("Using proxy for connection")
+    async def check_bulk_access(self, update: Update, chat_id: int) -> bool:
+        if update.effective_chat.type != "private":
+            await update.message.reply_text("Эта команда работает только в личных сообщениях")
+            return False
+        if not self.auth.is_chat_admin(update.effective_user.id, chat_id):
+            await update.message.reply_text("Вы не являетесь администратором этого чата")
+            return False
+        return True
+
+    async def apply_bulk_schedule(self, changed: list):
+        """Один проход по планировщику для всех изменённых мероприятий"""
+        for db_id, day_of_week, time_str, _ in changed:
+            hour, minute = map(int, time_str.split(':'))
+            await self.reschedule(day_of_week, hour, minute, db_id)
+
+    async def bulk_unpin(self, context: CallbackContext, status, pins: list, summary: str):
+        """Открепляет сообщения с паузами между вызовами и отчётом о прогрессе.
+        Выполняется фоновой задачей: паузы не должны задерживать обработку обновлений"""
+        for done, (chat_id, pin_id) in enumerate(pins, 1):
+            for attempt in range(2):
+                try:
+                    await context.bot.unpin_chat_message(chat_id=chat_id, message_id=pin_id)
+                    break
+                except RetryAfter as e:
+                    # Telegram просит подождать - ждём и пробуем ещё раз
+                    await asyncio.sleep(retry_after_seconds(e))
+                except Exception as e:
+                    logger.warning(f"[BULK] Не удалось открепить сообщение {pin_id}: {e}")
+                    break
+            
+            if done % BULK_PROGRESS_EVERY == 0:
+                try:
+                    await status.edit_text(f"⏳ Откреплено {done} из {len(pins)}...")
+                except Exception:
+                    pass
+            await asyncio.sleep(BULK_API_INTERVAL)
+        await status.edit_text(summary)
+
+    async def bulk_shift_command(self, update: Update, context: CallbackContext):
+        """/bulk_shift <chat_id> <часы> - сдвигает все мероприятия чата"""
+        try:
+            chat_id, hours = int(context.args[0]), int(context.args[1])
+        except (IndexError, ValueError):
+            await update.message.reply_text("Использование: /bulk_shift <ID чата> <сдвиг в часах, например -2>")
+            return
+        if not await self.check_bulk_access(update, chat_id):
+            return
+        
+        status = await update.message.reply_text("⏳ Сдвигаем мероприятия...")
+        changed = self.db.shift_chat_events(chat_id, hours)
+        await self.apply_bulk_schedule(changed)
+        await status.edit_text(f"✅ Сдвинуто мероприятий: {len(changed)}")
+
+    async def bulk_move_command(self, update: Update, context: CallbackContext):
+        """/bulk_move <день> <id,id,...> - переносит мероприятия на другой день недели"""
+        try:
+            day_of_week = context.args[0].lower()
+            db_ids = [int(db_id) for db_id in context.args[1].split(',')]
+            if day_of_week not in WEEK_DAYS:
+                raise ValueError
+        except (IndexError, ValueError):
+            await update.message.reply_text("Использование: /bulk_move <mon|tue|...|sun> <id1,id2,...>")
+            return
+        
+        if update.effective_chat.type != "private":
+            await update.message.reply_text("Эта команда работает только в личных сообщениях")
+            return
+        
+        # Переносим только мероприятия из чатов админа
+        foreign = [db_id for db_id in db_ids if not self.auth.owns_event(update.effective_user.id, db_id)]
+        if foreign:
+            await update.message.reply_text(f"Нет доступа к мероприятиям: {', '.join(map(str, foreign))}")
+            return
+        
+        status = await update.message.reply_text("⏳ Переносим мероприятия...")
+        changed = self.db.move_events_to_day(db_ids, day_of_week)
+        await self.apply_bulk_schedule(changed)
+        await status.edit_text(f"✅ Перенесено мероприятий: {len(changed)}")
+
+    async def bulk_delete_command(self, update: Update, context: CallbackContext):
+        """/bulk_delete <chat_id> <thread_id|0> - удаляет все мероприятия топика"""
+        try:
+            chat_id, thread_id = int(context.args[0]), int(context.args[1])
+        except (IndexError, ValueError):
+            await update.message.reply_text("Использование: /bulk_delete <ID чата> <ID топика или 0 для общего чата>")
+            return
+        if not await self.check_bulk_access(update, chat_id):
+            return
+        
+        status = await update.message.reply_text("⏳ Удаляем мероприятия...")
+        deleted = self.db.delete_thread_events(chat_id, thread_id or None)
+        db_ids = {db_id for db_id, _, _ in deleted}
+        for db_id in db_ids:
+            self.forget_event(db_id)
+        
+        # Открепляем и основные сообщения, и копии в других чатах
+        pins = [(pin_chat_id, pin_id) for _, pin_chat_id, pin_id in deleted if pin_id]
+        context.application.create_task(
+            self.bulk_unpin(context, status, pins, f"✅ Удалено мероприятий: {len(db_ids)}"))
+
+    async def restore_command(self, update: Update, context: CallbackContext):
+        """/restore [id] - архивные мероприятия чатов админа, с id - возвращает мероприятие из архива"""
+        chats = self.auth.chats_of(update.effective_user.id)
+        if not chats:
+            return
+        
+        if not context.args:
+            archived = self.db.get_archived_events(sorted(chats))
+            if not archived:
+                await update.message.reply_text("В архиве нет мероприятий ваших чатов")
+                return
+            reasons = {'failures': "не отправляется", 'idle': "нет записей"}
+            lines = ["Мероприятия в архиве:"]
+            for db_id, chat_id, text, archived_at, reason in archived:
+                title = text.split('\n', 1)[0][:40]
+                lines.append(f"{db_id}. {title} - {reasons.get(reason, reason)}, "
+                             f"{datetime.fromtimestamp(archived_at).strftime('%d.%m.%Y')}")
+            lines.append("\nВернуть: /restore <id>")
+            await update.message.reply_text('\n'.join(lines)[:TEXT_LIMIT])
+            return
+        
+        try:
+            db_id = int(context.args[0])
+        except ValueError:
+            await update.message.reply_text("Использование: /restore [ID мероприятия]")
+            return
+        if self.db.get_archived_chat(db_id) not in chats or not self.db.restore_event(db_id):
+            await update.message.reply_text("Мероприятие не найдено в архиве ваших чатов")
+            return
+        
+        message = self.db.load_message(db_id)
+        if message.day_of_week and message.time:
+            hour, minute = map(int, message.time.split(':'))
+            await self.reschedule(message.day_of_week, hour, minute, db_id)
+        logger.info("[ARCHIVE] Мероприятие %s возвращено из архива", db_id)
+        await update.message.reply_text(f"✅ Мероприятие {db_id} возвращено из архива")
+
+    async def stalls_command(self, update: Update, context: CallbackContext):
+        """/stalls [номер] - самые долгие зависания цикла событий, с номером - стек зависания"""
+        if not self.is_operator(update.effective_user.id):
+            return
+        stalls = watchdog.stalls()
+        if not stalls:
+            await update.message.reply_text(f"Зависаний дольше {watchdog.threshold * 1000:.0f} мс не было")
+            return
+        
+        if context.args:
+            number = int(context.args[0]) if context.args[0].isdigit() else 0
+            # Отрицательный индекс списка вернул бы чужое зависание
+            if not 1 <= number <= len(stalls):
+                await update.message.reply_text(f"Укажите номер от 1 до {len(stalls)}")
+                return
+            stall = stalls[number - 1]
+            # Вершина стека важнее начала: обрезаем сверху
+            text = f"{stall.summary()}\n\n" + ''.join(stall.stack)
+            await update.message.reply_text(text[-TEXT_LIMIT:])
+            return
+        
+        lines = [f"Зависаний: {watchdog.count}, самые долгие:"]
+        lines += [f"{number}. {stall.summary()}" for number, stall in enumerate(stalls, 1)]
+        lines.append("\nСтек зависания: /stalls <номер>")
+        await update.message.reply_text('\n'.join(lines)[:TEXT_LIMIT])
+
+    @staticmethod
+    def is_operator(user_id: int) -> bool:
+        return user_id in OPERATOR_IDS
+
+    async def profile_command(self, update: Update, context: CallbackContext):
+        """/profile [секунд] - семплирующий профиль цикла событий в формате collapsed stacks"""
+        if not self.is_operator(update.effective_user.id):
+            return
+        try:
+            seconds = float(context.args[0]) if context.args else 30
+        except ValueError:
+            await update.message.reply_text("Использование: /profile [секунд]")
+            return
+        if profiler.running:
+            await update.message.reply_text("Профиль уже снимается")
+            return
+        
+        await update.message.reply_text(f"⏳ Снимаем профиль {seconds:.0f} с...")
+        # Обновления обрабатываются по одному: обработчик, ждущий профиль, остановил бы бота.
+        # Снимаем в фоновой задаче, файл отправляем по готовности
+        context.application.create_task(self.send_profile(update.message, seconds))
+
+    async def send_profile(self, reply_to, seconds: float):
+        # Поток профилировщика читает стек потока цикла событий, сам цикл продолжает работать
+        try:
+            stacks = await asyncio.to_thread(profiler.sample, threading.get_ident(), seconds)
+        except RuntimeError as e:
+            await reply_to.reply_text(str(e))
+            return
+        top = '\n'.join(f"{share:6.1%} {label}" for label, share in profiler.top_functions(stacks))
+        await reply_to.reply_document(
+            document=io.BytesIO(profiler.collapsed(stacks).encode('utf-8')),
+            filename=f"profile-{datetime.now().strftime('%Y%m%d-%H%M%S')}.folded",
+            caption=f"Снимков: {sum(stacks.values())}\n{top}"[:CAPTION_LIMIT]
+        )
+
+    async def memory_command(self, update: Update, context: CallbackContext):
+        """/memory start|stop - трассировка памяти; без аргументов - рост памяти с прошлого снимка"""
+        if not self.is_operator(update.effective_user.id):
+            return
+        action = context.args[0] if context.args else None
+        if action == 'start':
+            await asyncio.to_thread(memory.start)
+            await update.message.reply_text("Трассировка памяти включена. Сравнение со снимком: /memory")
+        elif action == 'stop':
+            memory.stop()
+            await update.message.reply_text("Трассировка памяти выключена")
+        elif not memory.tracing:
+            await update.message.reply_text("Трассировка памяти выключена. Включить: /memory start")
         else:
-            application = ApplicationBuilder().token(token).build()
-            print("Using direct connection")
-    except Exception as e:
-        print(f"Error with proxy, trying without: {e}")
-        application = ApplicationBuilder().token(token).build()
-        print("Using direct connection (fallback)")
+            # Снимок всех выделений памяти блокировал бы цикл событий
+            report = await asyncio.to_thread(memory.report)
+            await update.message.reply_text(report[:TEXT_LIMIT])
 
-    application.post_init = bot.init_scheduler
+def setup_application(application, bot: MtgBot, metrics_port: int = METRICS_PORT):
+    """Подключает обработчики, метрики и хуки жизненного цикла бота к Application"""
+    async def post_init(application):
+        await bot.init_scheduler(application)
+        await metrics.start_server(metrics_port)
+        watchdog.start()
+
+    async def post_shutdown(application):
+        watchdog.stop()
+        await metrics.stop_server()
+        await bot.shutdown(application)
+
+    application.post_init = post_init
+    application.post_shutdown = post_shutdown
     application.add_error_handler(error_handler)
 
+    application.add_handler(TypeHandler(Update, bot.skip_processed_update), group=-1)
+    application.add_handler(TypeHandler(Update, bot.mark_update_processed), group=1)
+
     application.add_handlers([
         CommandHandler("start", bot.start_command),
         CommandHandler("set_admin", bot.set_admin_command),
         CommandHandler("change_topic", bot.change_topic_command),
+        CommandHandler("search", bot.search_command),
+        CommandHandler("bulk_shift", bot.bulk_shift_command),
+        CommandHandler("bulk_move", bot.bulk_move_command),
+        CommandHandler("bulk_delete", bot.bulk_delete_command),
+        CommandHandler("restore", bot.restore_command),
+        CommandHandler("stalls", bot.stalls_command),
+        CommandHandler("profile", bot.profile_command),
+        CommandHandler("memory", bot.memory_command),
         CallbackQueryHandler(bot.admin_panel, pattern='^a_'),
         CallbackQueryHandler(bot.message_render, pattern='^s_'),
         CallbackQueryHandler(bot.message_menu, pattern='^m_'),
+        CallbackQueryHandler(bot.search_page_callback, pattern='^q_'),
+        CallbackQueryHandler(bot.attendance_stats_page, pattern='^stats_'),
         CallbackQueryHandler(bot.day_callback, pattern='^day_'),
         CallbackQueryHandler(bot.keep_time_callback, pattern='^keep_time'),
         CallbackQueryHandler(bot.handle_create_chat_selection, pattern='^create_chat_'),
         CallbackQueryHandler(bot.handle_topic_change, pattern='^change_topic_'),
+        CallbackQueryHandler(bot.toggle_copy_chat, pattern='^copy_'),
         MessageHandler(filters.TEXT & ~filters.COMMAND & filters.ChatType.PRIVATE, bot.admin_input),
+        MessageHandler(filters.PHOTO & filters.ChatType.PRIVATE, bot.admin_photo),
         MessageHandler(filters.StatusUpdate.MIGRATE, bot.handle_migration)
     ])
-    
+
     application.add_handlers([
         ChatMemberHandler(bot.handle_chat_member_update),
-        CallbackQueryHandler(bot.update_lists, pattern="^participate")
+        ChatMemberHandler(bot.handle_member_status, ChatMemberHandler.CHAT_MEMBER),
+        CallbackQueryHandler(bot.update_lists, pattern="^participate"),
+        CallbackQueryHandler(bot.roster_page, pattern="^roster_")
     ])
 
+    setup_metrics(application, bot)
+    setup_watchdog(application, bot)
+
+def setup_watchdog(application, bot: MtgBot):
+    """Сторож цикла событий: гистограмма задержек, отчёт /stalls и имена обработчиков для стеков"""
+    watchdog.watch_handlers(application)
+    watchdog.watch_object(bot)
+    metrics.add(watchdog.lag)
+    metrics.routes['/stalls'] = watchdog.report
+
+def setup_metrics(application, bot: MtgBot):
+    """Замеры обработчиков и методов базы, датчики очередей и кэшей"""
+    metrics.instrument_handlers(application)
+    metrics.instrument_db(bot.db, [
+        name for name in dir(Database) if not name.startswith('_') and callable(getattr(Database, name))
+    ])
+
+    metrics.gauge('mtgbot_update_queue_size', 'Обновления, ожидающие обработки',
+                  lambda: application.update_queue.qsize())
+    metrics.gauge('mtgbot_scheduler_jobs', 'Задачи в планировщике',
+                  lambda: len(bot.scheduler.get_jobs()) if bot.scheduler else 0)
+    metrics.gauge('mtgbot_pending_refresh', 'Мероприятия с необновлённым текстом',
+                  lambda: len(bot.handoff.pending_refresh))
+    metrics.gauge('mtgbot_refresh_tasks', 'Отложенные обновления текста', lambda: len(bot.refresh_tasks))
+    metrics.gauge('mtgbot_archive_queue', 'Составы, ожидающие записи в архив', lambda: bot.archive.pending)
+    metrics.gauge('mtgbot_sessions', 'Сессии админов в памяти', lambda: len(bot.sessions.sessions))
+    # PRAGMA размера и свободных страниц - один раз за сбор метрик
+    metrics.gauge_set(bot.maintenance.stats, {
+        'mtgbot_db_size_bytes': ('Размер файла базы', 'size_bytes'),
+        'mtgbot_db_free_pages': ('Свободные страницы базы', 'free_pages'),
+        'mtgbot_db_fragmentation': ('Доля свободных страниц базы', 'fragmentation'),
+    })
+    metrics.gauge('mtgbot_db_backup_timestamp', 'Время последней резервной копии',
+                  lambda: bot.maintenance.last_backup[0] if bot.maintenance.last_backup else 0)
+    metrics.gauge('mtgbot_db_backup_seconds', 'Длительность последней резервной копии',
+                  lambda: bot.maintenance.last_backup[1] if bot.maintenance.last_backup else 0)
+    metrics.gauge('mtgbot_auth_cache_entries', 'Записи кэша прав администраторов',
+                  lambda: len(bot.auth.admin_chats) + len(bot.auth.event_chats) + len(bot.auth.members))
+
+if __name__ == '__main__':
+    bot = MtgBot()
+    token = get_bot_token()
+    if not token:
+        exit("Ошибка: не удалось загрузить токен бота")
+
+    # Ждём, пока предыдущий экземпляр передаст работу
+    if not bot.handoff.acquire():
+        exit("Ошибка: база данных занята другим экземпляром бота")
+
+    # Пробуем с прокси, если не работает - без прокси.
+    # Запросы к Bot API идут через MeteredRequest: размеры пулов - как у ApplicationBuilder по умолчанию
+    https_proxy = os.environ.get('HTTPS_PROXY')
+    
+    def build_application(proxy=None):
+        return (
+            ApplicationBuilder().token(token)
+            .request(MeteredRequest(metrics, connection_pool_size=256, proxy=proxy))
+            .get_updates_request(MeteredRequest(metrics, proxy=proxy))
+            .build()
+        )
+    
+    try:
+        if https_proxy:
+            application = build_application(https_proxy)
+            print("Using proxy for connection")
+        else:
+            application = build_application()
+            print("Using direct connection")
+    except Exception as e:
+        print(f"Error with proxy, trying without: {e}")
+        application = build_application()
+        print("Using direct connection (fallback)")
+
+    setup_application(application, bot)
+
     print("Бот запускается...")
-    application.run_polling()
\ No newline at end of file
+    # chat_member по умолчанию не присылается, а нужен для сброса кэша прав
+    application.run_polling(allowed_updates=Update.ALL_TYPES)
\ No newline at end of file
@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+import logging
+import threading
+import tracemalloc
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+PROFILE_INTERVAL = 0.005   # секунд между снимками стека
+PROFILE_MAX_SECONDS = 300
+MEMORY_FRAMES = 10         # глубина трассировки выделений памяти
+MEMORY_TOP = 15            # строк в сравнении снимков
+
+def _frame_label(code) -> str:
+    # ';' разделяет кадры в формате collapsed stacks, в именах его быть не должно
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})".replace(';', ',')
+
+class SamplingProfiler:
+    """Семплирующий профилировщик по запросу.
+
+    Пока профиль не снимается, ничего не работает: ни потоков, ни хуков
+    интерпретатора. Во время профиля отдельный поток раз в PROFILE_INTERVAL
+    читает стек потока цикла событий через sys._current_frames. Результат -
+    стеки в формате collapsed (flamegraph.pl, speedscope, inferno).
+
+    Поток профилировщика получает GIL не чаще sys.getswitchinterval(), поэтому
+    участки короче 5 мс видны хуже, чем долгие блокировки, ради которых он нужен."""
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.lock = threading.Lock()
+
+    @property
+    def running(self) -> bool:
+        return self.lock.locked()
+
+    def sample(self, thread_id: int, seconds: float) -> Counter:
+        """Снимает стеки потока thread_id в течение seconds секунд. Блокирует - вызывать из пула потоков"""
+        if not self.lock.acquire(blocking=False):
+            raise RuntimeError("Профиль уже снимается")
+        stacks = Counter()
+        labels = {}
+        try:
+            deadline = time.monotonic() + min(seconds, PROFILE_MAX_SECONDS)
+            while time.monotonic() < deadline:
+                frame = sys._current_frames().get(thread_id)
+                if frame is None:
+                    break
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    label = labels.get(code)
+                    if label is None:
+                        label = labels[code] = _frame_label(code)
+                    stack.append(label)
+                    frame = frame.f_back
+                stacks[';'.join(reversed(stack))] += 1
+                del frame
+                time.sleep(self.interval)
+        finally:
+            self.lock.release()
+        return stacks
+
+    @staticmethod
+    def collapsed(stacks: Counter) -> str:
+        return ''.join(f"{stack} {count}\n" for stack, count in stacks.most_common())
+
+    @staticmethod
+    def top_functions(stacks: Counter, limit: int = 10) -> list:
+        """Функции на вершине стека: где поток действительно проводит время"""
+        leaves = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        total = sum(leaves.values()) or 1
+        return [(label, count / total) for label, count in leaves.most_common(limit)]
+
+class MemoryTracker:
+    """Снимки tracemalloc по запросу. Трассировка включается только командой и выключается ею же"""
+
+    def __init__(self, frames: int = MEMORY_FRAMES):
+        self.frames = frames
+        self.previous = None
+
+    @property
+    def tracing(self) -> bool:
+        return tracemalloc.is_tracing()
+
+    def start(self) -> None:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.previous = self._snapshot()
+        logger.info("[PROFILE] Трассировка памяти включена")
+
+    def stop(self) -> None:
+        tracemalloc.stop()
+        self.previous = None
+        logger.info("[PROFILE] Трассировка памяти выключена")
+
+    def _snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+
+    def diff(self, limit: int = MEMORY_TOP) -> list:
+        """Строки кода с наибольшим ростом памяти с прошлого снимка. Новый снимок становится базой"""
+        snapshot = self._snapshot()
+        stats = snapshot.compare_to(self.previous, 'lineno')
+        self.previous = snapshot
+        return [stat for stat in stats if stat.size_diff][:limit]
+
+    def report(self, limit: int = MEMORY_TOP) -> str:
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f"Отслеживается {current / 1024 / 1024:.1f} МиБ, пик {peak / 1024 / 1024:.1f} МиБ",
+                 "Рост с прошлого снимка:"]
+        for stat in self.diff(limit):
+            frame = stat.traceback[0]
+            lines.append(f"{stat.size_diff / 1024:+.1f} КиБ ({stat.count_diff:+d} объектов) "
+                         f"{os.path.basename(frame.filename)}:{frame.lineno}")
+        return '\n'.join(lines)
+
+# Один профилировщик на процесс
+profiler = SamplingProfiler()
+memory = MemoryTracker()
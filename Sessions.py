@@ -0,0 +1,99 @@
+import time
+import logging
+from enum import Enum, auto
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+SESSION_TTL = 24 * 60 * 60   # секунд без действий, после которых незаконченный мастер забывается
+SESSION_MAX = 1000           # сессий в памяти, остальные читаются из базы при обращении
+
+class MessageState(Enum):
+    DEFAULT = auto()
+    TEXT = auto()
+    TIME = auto()
+    SEARCH = auto()
+    IMAGE = auto()
+
+class AdminSession:
+    """Состояние админ-панели одного админа: только id и короткие значения"""
+    __slots__ = ('admin_id', 'state', 'db_id', 'edit_id', 'draft_day', 'draft_time',
+                 'search_query', 'topic_chat', 'expires')
+
+    # Поля в порядке столбцов таблицы admin_sessions
+    FIELDS = ('admin_id', 'state', 'db_id', 'edit_id', 'draft_day', 'draft_time',
+              'search_query', 'topic_chat', 'expires')
+
+    def __init__(self, admin_id: int):
+        self.admin_id = admin_id
+        self.state = MessageState.DEFAULT
+        self.db_id = None          # мероприятие, открытое в панели
+        self.edit_id = None        # сообщение бота, которое правится после ввода текста
+        self.draft_day = None      # день и время, выбранные в мастере переноса
+        self.draft_time = None
+        self.search_query = None
+        self.topic_chat = None     # чат, для которого вводится новый топик
+        self.expires = 0.0
+
+    def to_row(self) -> tuple:
+        return tuple(self.state.name if field == 'state' else getattr(self, field) for field in self.FIELDS)
+
+    @classmethod
+    def from_row(cls, row):
+        session = cls(row[0])
+        for field, value in zip(cls.FIELDS[1:], row[1:]):
+            setattr(session, field, value)
+        session.state = MessageState[session.state] if session.state in MessageState.__members__ else MessageState.DEFAULT
+        return session
+
+class SessionStore:
+    """Сессии админов с ограниченным временем жизни и размером.
+
+    В памяти держится не больше max_sessions последних сессий (LRU), остальные
+    лежат в SQLite и читаются при обращении. Изменённые сессии сохраняются
+    пачкой при flush (на каждом heartbeat и при остановке), поэтому
+    незаконченный мастер переживает перезапуск бота."""
+
+    def __init__(self, db, ttl: float = SESSION_TTL, max_sessions: int = SESSION_MAX):
+        self.db = db
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict()
+        self.dirty = set()
+
+    def get(self, admin_id: int) -> AdminSession:
+        """Сессия админа. Обращение продлевает её и помечает для сохранения"""
+        now = time.time()
+        session = self.sessions.pop(admin_id, None)
+        if session is None:
+            row = self.db.load_session(admin_id)
+            session = AdminSession.from_row(row) if row else None
+        if session is None or session.expires <= now:
+            session = AdminSession(admin_id)
+
+        session.expires = now + self.ttl
+        self.sessions[admin_id] = session
+        self.dirty.add(admin_id)
+
+        while len(self.sessions) > self.max_sessions:
+            evicted_id, evicted = self.sessions.popitem(last=False)
+            if evicted_id in self.dirty:
+                self.dirty.discard(evicted_id)
+                self.db.save_sessions([evicted.to_row()])
+        return session
+
+    def reset(self, admin_id: int) -> AdminSession:
+        """Начинает сессию заново, например при возврате в главное меню"""
+        session = self.get(admin_id)
+        session.state = MessageState.DEFAULT
+        session.draft_day = session.draft_time = session.topic_chat = None
+        return session
+
+    def flush(self) -> None:
+        """Сохраняет изменённые сессии одной транзакцией и удаляет истёкшие"""
+        now = time.time()
+        for admin_id in [a for a, s in self.sessions.items() if s.expires <= now]:
+            del self.sessions[admin_id]
+        rows = [self.sessions[admin_id].to_row() for admin_id in self.dirty if admin_id in self.sessions]
+        self.dirty.clear()
+        self.db.save_sessions(rows, expired_before=now)
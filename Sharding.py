@@ -0,0 +1,415 @@
+import re
+import zlib
+import asyncio
+import logging
+import argparse
+import threading
+from collections import deque
+import multiprocessing
+from telegram import Bot, Update
+from telegram.ext import ApplicationBuilder
+from DB import Database, SHARD_ID_BITS
+from Auth import AdminAuth
+from Archive import RosterArchive
+from MtgBot import MtgBot, HISTORY_ROWS, get_bot_token, setup_application
+from Metrics import metrics, MeteredRequest, METRICS_PORT
+
+logger = logging.getLogger(__name__)
+
+# Голоса маршрутизируются по id мероприятия, всё остальное - по chat_id
+EVENT_CALLBACK = re.compile(r'^participate(?:maybe)?_(\d+)$')
+
+def shard_of_chat(chat_id: int, shards: int) -> int:
+    """Шард, которому принадлежит диапазон хэшей chat_id"""
+    return (zlib.crc32(str(chat_id).encode()) * shards) >> 32
+
+def shard_of_event(db_id: int) -> int:
+    """Шард, в базе которого создано мероприятие"""
+    return int(db_id) >> SHARD_ID_BITS
+
+def shard_db_name(index: int) -> str:
+    return f"mtg_bot.shard{index}.db"
+
+def shard_archive_name(index: int) -> str:
+    return f"mtg_archive.shard{index}.db"
+
+def route_update(data: dict, shards: int) -> int:
+    """Выбирает шард для сырого обновления Telegram"""
+    query = data.get('callback_query')
+    if query:
+        match = EVENT_CALLBACK.match(query.get('data') or '')
+        if match:
+            return shard_of_event(int(match.group(1)))
+        chat = (query.get('message') or {}).get('chat') or {'id': query['from']['id']}
+        return shard_of_chat(chat['id'], shards)
+
+    for key in ('message', 'edited_message', 'my_chat_member', 'chat_member'):
+        if key in data:
+            return shard_of_chat(data[key]['chat']['id'], shards)
+    return 0
+
+class ShardedDatabase:
+    """Набор баз шардов с интерфейсом Database.
+
+    Мероприятия живут в шарде, номер которого закодирован в их id, админы чата -
+    в шарде chat_id. Выборки по администратору объединяются по всем шардам.
+    В собственный шард процесса уходят только методы из HOME_SHARD: для
+    остальных нужна явная маршрутизация, иначе вызов выбросит AttributeError,
+    а не прочитает молча чужие данные из своего шарда."""
+
+    HOME_SHARD = frozenset({
+        # Обслуживание базы процесса
+        'conn', 'db_name', 'compact_journal', 'check_counters',
+        # Блокировка и состояние экземпляра
+        'get_state', 'set_states', 'try_acquire_lock', 'heartbeat_lock', 'release_lock',
+        # Сессии админов и пользователи: процесс видит только своих
+        'load_session', 'save_sessions', 'upsert_user',
+        # Картинки: id не несут номер шарда, кэш file_id у каждого шарда свой
+        'get_or_create_media', 'get_media', 'update_media_file_id',
+    })
+
+    def __init__(self, home: int, shards: int):
+        self.home = home
+        self.shards = [Database(shard_db_name(i), shard=i) for i in range(shards)]
+
+    def __getattr__(self, name):
+        if name in self.HOME_SHARD:
+            return getattr(self.shards[self.home], name)
+        raise AttributeError(f"{type(self).__name__} не знает, в какой шард направить {name!r}")
+
+    def for_chat(self, chat_id: int) -> Database:
+        return self.shards[shard_of_chat(chat_id, len(self.shards))]
+
+    def for_event(self, db_id: int) -> Database:
+        return self.shards[shard_of_event(db_id)]
+
+    # Мероприятия
+
+    def save_message(self, message):
+        if message.db_id:
+            return self.for_event(message.db_id).save_message(message)
+        return self.for_chat(message.chat_id).save_message(message)
+
+    def load_message(self, db_id, with_roster: bool = True):
+        return self.for_event(db_id).load_message(db_id, with_roster)
+
+    def delete_message(self, db_id):
+        return self.for_event(db_id).delete_message(db_id)
+
+    def record_vote(self, db_id: int, user_id: int, action: int, toggle: bool = False):
+        return self.for_event(db_id).record_vote(db_id, user_id, action, toggle)
+
+    def reset_roster(self, db_id: int) -> None:
+        return self.for_event(db_id).reset_roster(db_id)
+
+    def get_roster_page(self, db_id: int, offset: int, limit: int):
+        return self.for_event(db_id).get_roster_page(db_id, offset, limit)
+
+    def roster_at(self, db_id: int, until_ts: int):
+        return self.for_event(db_id).roster_at(db_id, until_ts)
+
+    def get_message_posts(self, db_id: int) -> list:
+        return self.for_event(db_id).get_message_posts(db_id)
+
+    def add_message_post(self, db_id: int, chat_id: int, thread_id: int = None) -> bool:
+        return self.for_event(db_id).add_message_post(db_id, chat_id, thread_id)
+
+    def remove_message_post(self, db_id: int, chat_id: int):
+        return self.for_event(db_id).remove_message_post(db_id, chat_id)
+
+    def save_post_pins(self, db_id: int, pins: list) -> None:
+        return self.for_event(db_id).save_post_pins(db_id, pins)
+
+    def attach_media(self, db_id: int, content_key: str, file_id: str, kind: str = 'photo') -> int:
+        return self.for_event(db_id).attach_media(db_id, content_key, file_id, kind)
+
+    def get_event_chat(self, db_id: int):
+        return self.for_event(db_id).get_event_chat(db_id)
+
+    def get_event_stats(self, db_id: int):
+        return self.for_event(db_id).get_event_stats(db_id)
+
+    def get_user_stats(self, chat_id: int, user_id: int):
+        rows = [row for row in (db.get_user_stats(chat_id, user_id) for db in self.shards) if row]
+        if not rows:
+            return None
+        return (
+            sum(row[0] for row in rows), sum(row[1] for row in rows),
+            max(row[2] for row in rows), max(row[3] for row in rows),
+            max((row[4] for row in rows if row[4]), default=None)
+        )
+
+    def get_top_attendees(self, chat_id: int, limit: int = 5) -> list:
+        # После миграции чата его статистика может лежать в нескольких шардах
+        merged = {}
+        for db in self.shards:
+            for user_id, username, full_name, attended, streak, best_streak in db.get_top_attendees(chat_id, limit):
+                _, _, _, prev_attended, prev_streak, prev_best = merged.get(user_id, (0, None, None, 0, 0, 0))
+                merged[user_id] = (user_id, username, full_name, prev_attended + attended,
+                                   max(prev_streak, streak), max(prev_best, best_streak))
+        return sorted(merged.values(), key=lambda row: row[3], reverse=True)[:limit]
+
+    def init_load_all(self):
+        # Планировщик процесса отвечает только за мероприятия своего шарда
+        return self.shards[self.home].init_load_all()
+
+    # Архив неактивных мероприятий: задачи планировщика есть только у своего шарда
+
+    def record_send_result(self, db_id: int, delivered: bool) -> None:
+        return self.for_event(db_id).record_send_result(db_id, delivered)
+
+    def find_dormant_events(self, max_failures: int, idle_before: int) -> list:
+        return self.shards[self.home].find_dormant_events(max_failures, idle_before)
+
+    def archive_events(self, dormant: list) -> list:
+        return self.shards[self.home].archive_events(dormant)
+
+    def restore_event(self, db_id: int) -> bool:
+        return self.for_event(db_id).restore_event(db_id)
+
+    def get_archived_chat(self, db_id: int):
+        return self.for_event(db_id).get_archived_chat(db_id)
+
+    def get_archived_events(self, chat_ids: list, limit: int = 50) -> list:
+        rows = [row for db in self.shards for row in db.get_archived_events(chat_ids, limit)]
+        return sorted(rows, key=lambda row: (row[3], row[0]), reverse=True)[:limit]
+
+    # Админы чатов
+
+    def set_chat_admin(self, chat_id: int, admin_id: int, default_thread_id: int = None) -> bool:
+        return self.for_chat(chat_id).set_chat_admin(chat_id, admin_id, default_thread_id)
+
+    def add_chat_admin(self, chat_id: int, admin_id: int) -> bool:
+        return self.for_chat(chat_id).add_chat_admin(chat_id, admin_id)
+
+    def remove_chat_admin(self, chat_id: int, admin_id: int) -> bool:
+        return any([db.remove_chat_admin(chat_id, admin_id) for db in self.shards])
+
+    def get_chat_admins(self, chat_id: int) -> list[int]:
+        return sorted({admin for db in self.shards for admin in db.get_chat_admins(chat_id)})
+
+    def update_chat_thread(self, chat_id: int, admin_id: int, thread_id: int = None) -> bool:
+        return any([db.update_chat_thread(chat_id, admin_id, thread_id) for db in self.shards])
+
+    # Выборки по администратору, объединённые по всем шардам
+
+    def load_messages(self, admin_id):
+        messages = [msg for db in self.shards for msg in db.load_messages(admin_id)]
+        return sorted(messages, key=lambda msg: msg['id'], reverse=True)
+
+    def user_has_chats(self, admin_id):
+        return any(db.user_has_chats(admin_id) for db in self.shards)
+
+    def get_admin_chat(self, admin_id: int):
+        for db in self.shards:
+            chat_id = db.get_admin_chat(admin_id)
+            if chat_id:
+                return chat_id
+        return None
+
+    def get_admin_chats(self, admin_id: int) -> list:
+        return sorted({chat_id for db in self.shards for chat_id in db.get_admin_chats(admin_id)})
+
+    def get_admin_chats_with_threads(self, admin_id: int) -> list:
+        return [row for db in self.shards for row in db.get_admin_chats_with_threads(admin_id)]
+
+    def search_messages(self, admin_id: int, query: str, limit: int = 10, offset: int = 0) -> list:
+        # Каждый шард отдаёт первые offset + limit совпадений, общий порядок - по id
+        rows = [row for db in self.shards for row in db.search_messages(admin_id, query, offset + limit)]
+        return sorted(rows, key=lambda row: row[0], reverse=True)[offset:offset + limit]
+
+    # Операции над чатом целиком: после миграции данные чата могут лежать в нескольких шардах
+
+    def shift_chat_events(self, chat_id: int, hours: int) -> list:
+        return [row for db in self.shards for row in db.shift_chat_events(chat_id, hours)]
+
+    def delete_thread_events(self, chat_id: int, thread_id: int = None) -> list:
+        return [row for db in self.shards for row in db.delete_thread_events(chat_id, thread_id)]
+
+    def move_events_to_day(self, db_ids: list, day_of_week: str) -> list:
+        by_shard = {}
+        for db_id in db_ids:
+            by_shard.setdefault(shard_of_event(db_id), []).append(db_id)
+        return [row for shard, ids in by_shard.items() for row in self.shards[shard].move_events_to_day(ids, day_of_week)]
+
+    def update_chat_id(self, prev_id, next_id) -> bool:
+        return all([db.update_chat_id(prev_id, next_id) for db in self.shards])
+
+    def remove_chats_data(self, chat_id: int) -> list:
+        return [db_id for db in self.shards for db_id in db.remove_chats_data(chat_id)]
+
+class ShardAuth(AdminAuth):
+    """AdminAuth процесса шарда: сброс кэша прав рассылается остальным шардам.
+    Иначе снятый админ сохранял бы доступ через другой шард до истечения AUTH_TTL"""
+
+    def __init__(self, db, index: int, inboxes: list):
+        super().__init__(db)
+        self.index = index
+        self.inboxes = inboxes
+
+    def _broadcast(self, name: str, *args):
+        for shard, inbox in enumerate(self.inboxes):
+            if shard != self.index:
+                inbox.put(('auth', (name, args)))
+
+    def apply(self, name: str, args: tuple) -> None:
+        """Сброс, пришедший от другого шарда: выполняется только в своём кэше"""
+        getattr(super(), name)(*args)
+
+    def member_updated(self, chat_id: int, user_id: int, status: str) -> None:
+        super().member_updated(chat_id, user_id, status)
+        self._broadcast('member_updated', chat_id, user_id, status)
+
+    def invalidate_admin(self, admin_id: int) -> None:
+        super().invalidate_admin(admin_id)
+        self._broadcast('invalidate_admin', admin_id)
+
+    def invalidate_chat(self, chat_id: int) -> None:
+        super().invalidate_chat(chat_id)
+        self._broadcast('invalidate_chat', chat_id)
+
+    def invalidate_event(self, db_id: int) -> None:
+        super().invalidate_event(db_id)
+        self._broadcast('invalidate_event', db_id)
+
+class ShardBot(MtgBot):
+    """MtgBot внутри процесса шарда: расписание чужих мероприятий передаёт их владельцу,
+    сброс кэша прав - всем шардам"""
+
+    def __init__(self, index: int, inboxes: list):
+        super().__init__(ShardedDatabase(index, len(inboxes)), RosterArchive(shard_archive_name(index)))
+        self.index = index
+        self.inboxes = inboxes
+        self.auth = ShardAuth(self.db, index, inboxes)
+
+    async def reschedule(self, day_of_week: str, hour: int, minute: int = 0, db_id: int = None):
+        if db_id is not None and shard_of_event(db_id) != self.index:
+            self.inboxes[shard_of_event(db_id)].put(('reschedule', db_id))
+            return
+        await super().reschedule(day_of_week, hour, minute, db_id)
+
+    def read_history(self, db_id: int, since: int) -> list:
+        # Составы пишет в архив шард-владелец мероприятия: читаем его файл
+        name = shard_archive_name(shard_of_event(db_id))
+        return list(deque(self.archive.scan(db_id, since, with_roster=False, db_name=name), maxlen=HISTORY_ROWS))
+
+    def unschedule(self, db_id: int):
+        if shard_of_event(db_id) != self.index:
+            self.inboxes[shard_of_event(db_id)].put(('unschedule', db_id))
+            return
+        super().unschedule(db_id)
+
+    async def schedule_from_db(self, db_id: int):
+        """Пересоздаёт задачу планировщика по триггеру из базы"""
+        message = self.db.load_message(db_id)
+        if message.trigger:
+            self.scheduler.add_job(
+                self.send_scheduled_message,
+                trigger=message.trigger,
+                args=[db_id],
+                id=f"message_{db_id}",
+                replace_existing=True
+            )
+
+def run_worker(index: int, inboxes: list, token: str, make_request=None):
+    """Процесс шарда: своя база, свой планировщик, обновления приходят из очереди.
+    make_request создаёт BaseRequest для Bot API вместо MeteredRequest (для тестов)"""
+    bot = ShardBot(index, inboxes)
+    if not bot.handoff.acquire():
+        logger.error(f"[SHARD {index}] База шарда занята другим процессом")
+        return
+
+    application = (
+        ApplicationBuilder().token(token).updater(None)
+        .request(make_request() if make_request else MeteredRequest(metrics, connection_pool_size=256))
+        .build()
+    )
+    # Каждый шард отдаёт свои метрики на отдельном порту
+    setup_application(application, bot, metrics_port=METRICS_PORT + 1 + index if METRICS_PORT else 0)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    def read_inbox():
+        while True:
+            kind, payload = inboxes[index].get()
+            if kind == 'stop':
+                loop.call_soon_threadsafe(loop.stop)
+                return
+            if kind == 'update':
+                update = Update.de_json(payload, application.bot)
+                asyncio.run_coroutine_threadsafe(application.update_queue.put(update), loop)
+            elif kind == 'reschedule':
+                asyncio.run_coroutine_threadsafe(bot.schedule_from_db(payload), loop)
+            elif kind == 'unschedule':
+                loop.call_soon_threadsafe(bot.unschedule, payload)
+            elif kind == 'auth':
+                loop.call_soon_threadsafe(bot.auth.apply, *payload)
+
+    try:
+        loop.run_until_complete(application.initialize())
+        loop.run_until_complete(application.post_init(application))
+        loop.run_until_complete(application.start())
+        threading.Thread(target=read_inbox, daemon=True).start()
+        logger.info(f"[SHARD {index}] Шард запущен")
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if application.running:
+            loop.run_until_complete(application.stop())
+        loop.run_until_complete(application.post_shutdown(application))
+        loop.run_until_complete(application.shutdown())
+        loop.close()
+
+async def run_front(inboxes: list, token: str, poll_timeout: int = 30, request=None):
+    """Фронт: получает обновления long polling и раздаёт их шардам.
+    request - BaseRequest для Bot API вместо стандартного (для тестов)"""
+    bot = Bot(token, request=request, get_updates_request=request)
+    offset = None
+    async with bot:
+        while True:
+            try:
+                updates = await bot.get_updates(
+                    offset=offset, timeout=poll_timeout, allowed_updates=Update.ALL_TYPES
+                )
+            except Exception as e:
+                logger.warning(f"[FRONT] Ошибка получения обновлений: {e}")
+                await asyncio.sleep(1)
+                continue
+
+            for update in updates:
+                data = update.to_dict()
+                inboxes[route_update(data, len(inboxes))].put(('update', data))
+                offset = update.update_id + 1
+
+def main():
+    parser = argparse.ArgumentParser(description="Запуск бота в режиме шардирования")
+    parser.add_argument('--shards', type=int, default=2)
+    args = parser.parse_args()
+
+    token = get_bot_token()
+    if not token:
+        exit("Ошибка: не удалось загрузить токен бота")
+
+    ctx = multiprocessing.get_context('spawn')
+    inboxes = [ctx.Queue() for _ in range(args.shards)]
+    workers = [
+        ctx.Process(target=run_worker, args=(i, inboxes, token), name=f"shard-{i}")
+        for i in range(args.shards)
+    ]
+    for worker in workers:
+        worker.start()
+
+    try:
+        asyncio.run(run_front(inboxes, token))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for inbox in inboxes:
+            inbox.put(('stop', None))
+        for worker in workers:
+            worker.join()
+
+if __name__ == '__main__':
+    main()
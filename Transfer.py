@@ -0,0 +1,129 @@
+import os
+import csv
+import sys
+import json
+import time
+import argparse
+from itertools import groupby
+from DB import Database
+
+# Порядок важен: мероприятия ссылаются на картинки, участники - на пользователей и мероприятия
+KINDS = ['admins', 'users', 'media', 'events', 'participants']
+
+class Throughput:
+    """Считает обработанные записи и печатает скорость"""
+
+    def __init__(self, label: str, report_every: int = 100000):
+        self.label = label
+        self.report_every = report_every
+        self.count = 0
+        self.started = time.perf_counter()
+
+    def tick(self, records: int = 1):
+        before = self.count
+        self.count += records
+        if self.count // self.report_every != before // self.report_every:
+            self.report()
+
+    def report(self):
+        elapsed = time.perf_counter() - self.started
+        rate = self.count / elapsed if elapsed else 0
+        print(f"{self.label}: {self.count} записей за {elapsed:.1f} с ({rate:.0f} записей/с)")
+
+def iter_database(db: Database, batch_size: int):
+    """Все записи базы в виде (тип, запись) в порядке KINDS"""
+    for kind in KINDS:
+        for record in db.iter_export(kind, batch_size):
+            yield kind, record
+
+def export_jsonl(db: Database, path: str, batch_size: int = 1000) -> int:
+    stats = Throughput("Экспорт")
+    with open(path, 'w', encoding='utf-8') as f:
+        for kind, record in iter_database(db, batch_size):
+            f.write(json.dumps({'type': kind, **record}, ensure_ascii=False))
+            f.write('\n')
+            stats.tick()
+    stats.report()
+    return stats.count
+
+def export_csv(db: Database, directory: str, batch_size: int = 1000) -> int:
+    """Экспорт в каталог: по одному CSV на тип записей"""
+    os.makedirs(directory, exist_ok=True)
+    stats = Throughput("Экспорт")
+    for kind in KINDS:
+        with open(os.path.join(directory, f"{kind}.csv"), 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=db.export_fields(kind))
+            writer.writeheader()
+            for record in db.iter_export(kind, batch_size):
+                writer.writerow(record)
+                stats.tick()
+    stats.report()
+    return stats.count
+
+def read_jsonl(path: str):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                record = json.loads(line)
+                yield record.pop('type'), record
+
+def read_csv(directory: str):
+    # Числовые поля CSV приходят строками: пустые значения превращаем в NULL,
+    # остальное SQLite приведёт сам по типу столбца
+    for kind in KINDS:
+        path = os.path.join(directory, f"{kind}.csv")
+        if not os.path.exists(path):
+            continue
+        with open(path, encoding='utf-8', newline='') as f:
+            for record in csv.DictReader(f):
+                yield kind, {key: (value if value != '' else None) for key, value in record.items()}
+
+def chunked(records, chunk_size: int):
+    """Группирует поток (тип, запись) в пачки одного типа не длиннее chunk_size"""
+    for kind, group in groupby(records, key=lambda item: item[0]):
+        chunk = []
+        for _, record in group:
+            chunk.append(record)
+            if len(chunk) >= chunk_size:
+                yield kind, chunk
+                chunk = []
+        if chunk:
+            yield kind, chunk
+
+def import_records(db: Database, records, policy: str = 'skip', chunk_size: int = 5000) -> int:
+    """Импортирует поток записей пачками, каждая пачка - отдельная транзакция"""
+    stats = Throughput("Импорт")
+    for kind, chunk in chunked(records, chunk_size):
+        if kind not in KINDS:
+            raise ValueError(f"Неизвестный тип записи: {kind}")
+        db.import_batch(kind, chunk, policy)
+        stats.tick(len(chunk))
+    stats.report()
+    return stats.count
+
+def main():
+    parser = argparse.ArgumentParser(description="Потоковый экспорт и импорт мероприятий, админов и составов")
+    parser.add_argument('action', choices=['export', 'import'])
+    parser.add_argument('path', help="файл .jsonl или каталог для CSV")
+    parser.add_argument('--db', default='mtg_bot.db')
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl')
+    parser.add_argument('--policy', choices=list(Database.CONFLICT_POLICIES), default='skip',
+                        help="что делать с уже существующими записями при импорте")
+    parser.add_argument('--chunk', type=int, default=5000, help="записей в одной транзакции импорта")
+    args = parser.parse_args()
+
+    db = Database(args.db)
+    if args.action == 'export':
+        if args.format == 'jsonl':
+            export_jsonl(db, args.path)
+        else:
+            export_csv(db, args.path)
+    else:
+        records = read_jsonl(args.path) if args.format == 'jsonl' else read_csv(args.path)
+        try:
+            import_records(db, records, args.policy, args.chunk)
+        except Exception as e:
+            sys.exit(f"Импорт прерван: {e}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+import os
+import sys
+import time
+import heapq
+import asyncio
+import inspect
+import logging
+import threading
+import traceback
+from datetime import datetime
+from Metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+# Зависание - цикл событий не отвечает дольше STALL_THRESHOLD секунд
+STALL_THRESHOLD = float(os.environ.get('MTG_STALL_THRESHOLD', '0.25'))
+BEAT_INTERVAL = 0.05      # как часто цикл событий отмечается
+STALLS_KEPT = 20          # сколько самых долгих зависаний хранить
+STACK_LIMIT = 30          # кадров стека в записи
+
+class Stall:
+    __slots__ = ('started', 'duration', 'handler', 'stack')
+
+    def __init__(self, started: float, duration: float, handler: str, stack: list):
+        self.started = started
+        self.duration = duration
+        self.handler = handler
+        self.stack = stack
+
+    def summary(self) -> str:
+        started = datetime.fromtimestamp(self.started).strftime('%d.%m %H:%M:%S')
+        return f"{started} {self.duration * 1000:.0f} мс в {self.handler}"
+
+class StallWatchdog:
+    """Сторожевой поток для цикла событий.
+
+    Корутина в цикле отмечается каждые BEAT_INTERVAL секунд и пишет задержку
+    своего пробуждения в гистограмму. Отдельный поток следит за отметками:
+    если цикл молчит дольше порога, он снимает стек потока цикла через
+    sys._current_frames и находит в нём обработчик. Когда цикл оживает,
+    зависание с полной длительностью попадает в список самых долгих."""
+
+    def __init__(self, threshold: float = STALL_THRESHOLD, interval: float = BEAT_INTERVAL, kept: int = STALLS_KEPT):
+        self.threshold = threshold
+        self.interval = interval
+        self.kept = kept
+        self.lag = Histogram(
+            'mtgbot_loop_lag_seconds', 'Задержка пробуждения цикла событий',
+            buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+        self.handlers = {}     # код функции -> имя обработчика
+        self.worst = []        # куча (длительность, номер, Stall)
+        self.current = None    # зависание, которое сейчас идёт
+        self.count = 0
+        self.lock = threading.Lock()
+        self.beat = time.monotonic()
+        self.loop_thread = None
+        self.task = None
+        self.thread = None
+        self.stopped = threading.Event()
+
+    # Обработчики
+
+    def watch(self, callback, name: str = None) -> None:
+        """Запоминает код функции, чтобы узнавать её в стеке"""
+        function = inspect.unwrap(getattr(callback, '__func__', callback))
+        code = getattr(function, '__code__', None)
+        if code is not None:
+            self.handlers[code] = name or function.__qualname__
+
+    def watch_handlers(self, application) -> None:
+        for handlers in application.handlers.values():
+            for handler in handlers:
+                self.watch(handler.callback)
+
+    def watch_object(self, obj) -> None:
+        """Все корутины объекта: задачи планировщика вызывают их мимо обработчиков"""
+        for name in dir(type(obj)):
+            attr = getattr(type(obj), name, None)
+            if inspect.iscoroutinefunction(attr):
+                self.watch(attr)
+
+    # Запуск и остановка
+
+    def start(self) -> None:
+        """Вызывается из работающего цикла событий"""
+        if self.threshold <= 0 or self.task:
+            return
+        self.loop_thread = threading.get_ident()
+        self.beat = time.monotonic()
+        self.stopped.clear()
+        self.task = asyncio.get_running_loop().create_task(self._heartbeat())
+        self.thread = threading.Thread(target=self._watch, name="stall-watchdog", daemon=True)
+        self.thread.start()
+        logger.info(f"[WATCHDOG] Следим за циклом событий, порог {self.threshold * 1000:.0f} мс")
+
+    def stop(self) -> None:
+        self.stopped.set()
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.thread:
+            self.thread.join(timeout=1)
+            self.thread = None
+
+    async def _heartbeat(self):
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            lag = max(0.0, now - expected)
+            self.lag.observe(lag)
+            self.beat = now
+            if self.current is not None:
+                self._finish(lag)
+
+    def _watch(self):
+        while not self.stopped.wait(self.interval):
+            blocked = time.monotonic() - self.beat - self.interval
+            if blocked < self.threshold or self.current is not None:
+                continue
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is None:
+                continue
+            handler = self._attribute(frame)
+            stack = traceback.format_stack(frame, limit=STACK_LIMIT)
+            del frame
+            with self.lock:
+                # Цикл мог ожить, пока снимали стек: тогда отметка уже новая
+                if time.monotonic() - self.beat - self.interval >= self.threshold:
+                    self.current = Stall(time.time() - blocked, blocked, handler, stack)
+
+    def _attribute(self, frame) -> str:
+        """Самый внешний известный обработчик в стеке, иначе - функция на вершине стека"""
+        handler = None
+        top = frame
+        while frame is not None:
+            name = self.handlers.get(frame.f_code)
+            if name:
+                handler = name
+            frame = frame.f_back
+        return handler or f"{top.f_code.co_name} ({os.path.basename(top.f_code.co_filename)}:{top.f_lineno})"
+
+    def _finish(self, lag: float) -> None:
+        with self.lock:
+            stall, self.current = self.current, None
+            stall.duration = max(stall.duration, lag)
+            self.count += 1
+            entry = (stall.duration, self.count, stall)
+            if len(self.worst) < self.kept:
+                heapq.heappush(self.worst, entry)
+            else:
+                heapq.heappushpop(self.worst, entry)
+        logger.warning(f"[WATCHDOG] Цикл событий завис: {stall.summary()}")
+
+    # Чтение
+
+    def stalls(self) -> list:
+        """Сохранённые зависания, самые долгие первыми"""
+        with self.lock:
+            return [stall for _, _, stall in sorted(self.worst, reverse=True)]
+
+    def report(self) -> str:
+        """Полный отчёт со стеками для локального эндпоинта /stalls"""
+        stalls = self.stalls()
+        lines = [f"Зависаний дольше {self.threshold * 1000:.0f} мс: {self.count}, самые долгие:"]
+        for number, stall in enumerate(stalls, 1):
+            lines.append(f"\n#{number} {stall.summary()}")
+            lines.append(''.join(stall.stack).rstrip())
+        return '\n'.join(lines) + '\n'
+
+# Один сторож на процесс (у каждого шарда свой)
+watchdog = StallWatchdog()
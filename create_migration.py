@@ -22,7 +22,207 @@ def migrate_database(db_name='mtg_bot.db'):
     cursor.execute('UPDATE chat_admins SET default_thread_id = NULL WHERE default_thread_id IS NULL')
     cursor.execute('UPDATE messages SET message_thread_id = NULL WHERE message_thread_id IS NULL')
     
+    # 4. Выносим имена пользователей из participants в отдельную таблицу users
+    cursor.execute('PRAGMA table_info(participants)')
+    participant_columns = [row[1] for row in cursor.fetchall()]
+    if 'username' in participant_columns:
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY,
+            username TEXT,
+            full_name TEXT
+        )
+        ''')
+        # Берём самые свежие имена: строку с наибольшим rowid для каждого пользователя
+        cursor.execute('''
+        INSERT OR REPLACE INTO users (id, username, full_name)
+        SELECT user_id, username, full_name FROM participants
+        WHERE rowid IN (SELECT MAX(rowid) FROM participants GROUP BY user_id)
+        ''')
+        cursor.execute('ALTER TABLE participants RENAME TO participants_old')
+        cursor.execute('''
+        CREATE TABLE participants (
+            message_id INTEGER,
+            user_id INTEGER,
+            status TEXT,
+            FOREIGN KEY(message_id) REFERENCES messages(id),
+            FOREIGN KEY(user_id) REFERENCES users(id),
+            PRIMARY KEY(message_id, user_id)
+        )
+        ''')
+        cursor.execute('''
+        INSERT INTO participants (message_id, user_id, status)
+        SELECT message_id, user_id, status FROM participants_old ORDER BY rowid
+        ''')
+        cursor.execute('DROP TABLE participants_old')
+        print("Имена пользователей перенесены в таблицу users")
+    
+    # 5. Картинки мероприятий: ссылка из текста переезжает в таблицу media
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS media (
+        id INTEGER PRIMARY KEY,
+        content_key TEXT NOT NULL UNIQUE,
+        file_id TEXT NOT NULL,
+        kind TEXT NOT NULL DEFAULT 'photo'
+    )
+    ''')
+    for column, definition in [('media_id', 'INTEGER REFERENCES media(id)'),
+                               ('pin_media', 'INTEGER NOT NULL DEFAULT 0')]:
+        try:
+            cursor.execute(f'ALTER TABLE messages ADD COLUMN {column} {definition}')
+            print(f"Добавлено поле {column} в messages")
+        except sqlite3.OperationalError as e:
+            print(f"Поле {column} уже существует или ошибка: {e}")
+    
+    # В image хранилась MarkdownV2-ссылка вида [\u200b](https://...). Пока картинка не отправлена,
+    # вместо file_id хранится сама ссылка: Telegram принимает её в send_photo, а полученный
+    # file_id бот запишет после первой отправки
+    cursor.execute("SELECT id, image FROM messages WHERE image IS NOT NULL AND image != ''")
+    converted = 0
+    for db_id, image in cursor.fetchall():
+        image = image.decode() if isinstance(image, bytes) else image
+        url = image[image.rfind('(') + 1:image.rfind(')')] if '](' in image else image
+        if not url.startswith('http'):
+            continue
+        cursor.execute('''
+        INSERT OR IGNORE INTO media (content_key, file_id, kind) VALUES (?, ?, 'photo')
+        ''', ('url:' + url, url))
+        cursor.execute('''
+        UPDATE messages SET media_id = (SELECT id FROM media WHERE content_key = ?), image = NULL
+        WHERE id = ?
+        ''', ('url:' + url, db_id))
+        converted += 1
+    if converted:
+        print(f"Картинки {converted} мероприятий перенесены в таблицу media")
+    
+    conn.commit()
+    
+    # 6. Режим auto_vacuum=INCREMENTAL: место от удалённых строк возвращается небольшими
+    # шагами без остановки бота (Maintenance.py). Режим меняется только полным VACUUM
+    cursor.execute('PRAGMA auto_vacuum')
+    if cursor.fetchone()[0] != 2:
+        cursor.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cursor.execute('VACUUM')
+        print("База переведена в режим auto_vacuum=INCREMENTAL")
+    
+    # 7. Счётчики участников в messages: списки и клавиатуры строятся без чтения составов
+    added = False
+    for column in ('participate_count', 'maybe_count'):
+        try:
+            cursor.execute(f'ALTER TABLE messages ADD COLUMN {column} INTEGER NOT NULL DEFAULT 0')
+            print(f"Добавлено поле {column} в messages")
+            added = True
+        except sqlite3.OperationalError as e:
+            print(f"Поле {column} уже существует или ошибка: {e}")
+    if added:
+        cursor.execute('''
+        UPDATE messages SET
+            participate_count = (SELECT COUNT(*) FROM participants WHERE message_id = messages.id AND status = 'participate'),
+            maybe_count = (SELECT COUNT(*) FROM participants WHERE message_id = messages.id AND status = 'maybe')
+        ''')
+        print(f"Счётчики участников заполнены для {cursor.rowcount} мероприятий")
+    conn.commit()
+    
+    # 8. Составы, копии, состояние и статистика мероприятия удаляются вместе с ним (ON DELETE CASCADE).
+    # Внешний ключ не меняется через ALTER TABLE, поэтому таблица пересоздаётся.
+    # Строки удалённых раньше мероприятий не переносятся: с включёнными ключами они были бы ошибкой
+    # Ключ participants.user_id -> users убирается: пользователи при шардировании есть только на домашнем шарде
+    cascade_tables = {
+        'participants': ('message_id, user_id, status', '''
+        CREATE TABLE participants_new (
+            message_id INTEGER,
+            user_id INTEGER,
+            status TEXT,
+            FOREIGN KEY(message_id) REFERENCES messages(id) ON DELETE CASCADE,
+            PRIMARY KEY(message_id, user_id)
+        )
+        '''),
+        'message_posts': ('message_id, chat_id, message_thread_id, pin_id, pin_media', '''
+        CREATE TABLE message_posts_new (
+            message_id INTEGER NOT NULL,
+            chat_id INTEGER NOT NULL,
+            message_thread_id INTEGER,
+            pin_id INTEGER,
+            pin_media INTEGER NOT NULL DEFAULT 0,
+            FOREIGN KEY(message_id) REFERENCES messages(id) ON DELETE CASCADE,
+            PRIMARY KEY(message_id, chat_id)
+        )
+        '''),
+        'event_health': ('message_id, send_failures, last_failure, last_activity', '''
+        CREATE TABLE event_health_new (
+            message_id INTEGER PRIMARY KEY REFERENCES messages(id) ON DELETE CASCADE,
+            send_failures INTEGER NOT NULL DEFAULT 0,
+            last_failure INTEGER,
+            last_activity INTEGER NOT NULL
+        )
+        '''),
+        'event_stats': ('message_id, occurrences, attended_total, maybe_total, last_occurrence', '''
+        CREATE TABLE event_stats_new (
+            message_id INTEGER PRIMARY KEY REFERENCES messages(id) ON DELETE CASCADE,
+            occurrences INTEGER NOT NULL DEFAULT 0,
+            attended_total INTEGER NOT NULL DEFAULT 0,
+            maybe_total INTEGER NOT NULL DEFAULT 0,
+            last_occurrence INTEGER
+        )
+        '''),
+        'event_user_stats': ('message_id, user_id, attended, maybe, streak, best_streak, last_seen', '''
+        CREATE TABLE event_user_stats_new (
+            message_id INTEGER NOT NULL,
+            user_id INTEGER NOT NULL,
+            attended INTEGER NOT NULL DEFAULT 0,
+            maybe INTEGER NOT NULL DEFAULT 0,
+            streak INTEGER NOT NULL DEFAULT 0,
+            best_streak INTEGER NOT NULL DEFAULT 0,
+            last_seen INTEGER,
+            FOREIGN KEY(message_id) REFERENCES messages(id) ON DELETE CASCADE,
+            PRIMARY KEY(message_id, user_id)
+        )
+        '''),
+    }
+    for table, (columns, create) in cascade_tables.items():
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,))
+        if not cursor.fetchone():
+            continue
+        cursor.execute(f'PRAGMA foreign_key_list({table})')
+        foreign_keys = cursor.fetchall()
+        if any(row[2] == 'messages' and row[6] == 'CASCADE' for row in foreign_keys) \
+                and not any(row[2] == 'users' for row in foreign_keys):
+            continue
+        cursor.execute(create)
+        cursor.execute(f'''
+        INSERT INTO {table}_new ({columns})
+        SELECT {columns} FROM {table} WHERE message_id IN (SELECT id FROM messages) ORDER BY rowid
+        ''')
+        moved = cursor.rowcount
+        cursor.execute(f'SELECT COUNT(*) FROM {table}')
+        orphans = cursor.fetchone()[0] - moved
+        cursor.execute(f'DROP TABLE {table}')
+        cursor.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+        print(f"Таблица {table} пересоздана с ON DELETE CASCADE, удалено строк без мероприятия: {orphans}")
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_message_posts_chat ON message_posts(chat_id)')
     conn.commit()
+    
+    cursor.execute('PRAGMA foreign_key_check')
+    violations = cursor.fetchall()
+    if violations:
+        print(f"Нарушения внешних ключей: {len(violations)}, например {violations[:5]}")
+    
+    # 9. Текущая серия посещений пользователя в чате. Начальное значение - лучшая
+    # из текущих серий по мероприятиям чата
+    try:
+        cursor.execute('ALTER TABLE user_stats ADD COLUMN streak INTEGER NOT NULL DEFAULT 0')
+        cursor.execute('''
+        UPDATE user_stats SET streak = COALESCE((
+            SELECT MAX(e.streak) FROM event_user_stats e
+            JOIN messages m ON m.id = e.message_id
+            WHERE m.chat_id = user_stats.chat_id AND e.user_id = user_stats.user_id
+        ), 0)
+        ''')
+        print(f"Добавлено поле streak в user_stats, заполнено для {cursor.rowcount} записей")
+    except sqlite3.OperationalError as e:
+        print(f"Поле streak уже существует или ошибка: {e}")
+    conn.commit()
+    
     conn.close()
     print("Миграция завершена успешно!")
 
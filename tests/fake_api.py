@@ -0,0 +1,82 @@
+import os
+import json
+import time
+import asyncio
+from LoadTest import FakeRequest, FAKE_TOKEN
+
+UPDATES_FILE = 'updates.jsonl'
+POLL_WAIT = 0.5   # сколько getUpdates ждёт новых обновлений, с
+
+class FileBotAPI(FakeRequest):
+    """Bot API для тестов из нескольких процессов.
+
+    Обновления читаются из updates.jsonl в каталоге теста, каждый вызов метода
+    дописывается в журнал api-<name>.jsonl этого процесса. Подтверждённый offset
+    процессы не делят: новый процесс получает обновления с начала, как от
+    Telegram, до которого не дошло подтверждение предыдущего экземпляра."""
+
+    def __init__(self, directory: str, name: str, latency: float = 0.005):
+        super().__init__(latency=latency, jitter=0.0)
+        self.updates_path = os.path.join(directory, UPDATES_FILE)
+        self.journal_path = os.path.join(directory, f"api-{name}.jsonl")
+
+    async def do_request(self, url: str, method: str, request_data=None, **kwargs):
+        api_method = url.rsplit('/', 1)[-1]
+        params = request_data.parameters if request_data else {}
+        if api_method == 'getUpdates':
+            return 200, json.dumps({'ok': True, 'result': await self.get_updates(params)}).encode()
+        with open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'method': api_method, 'params': params}, ensure_ascii=False, default=str) + '\n')
+        return await super().do_request(url, method, request_data, **kwargs)
+
+    async def get_updates(self, params: dict) -> list:
+        offset = int(params.get('offset') or 0)
+        deadline = time.monotonic() + min(float(params.get('timeout') or 0), POLL_WAIT)
+        while True:
+            updates = [update for update in read_jsonl(self.updates_path) if update['update_id'] >= offset]
+            if updates or time.monotonic() >= deadline:
+                return updates
+            await asyncio.sleep(0.05)
+
+def read_jsonl(path: str) -> list:
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def add_updates(directory: str, updates: list) -> None:
+    with open(os.path.join(directory, UPDATES_FILE), 'a', encoding='utf-8') as f:
+        for update in updates:
+            f.write(json.dumps(update, ensure_ascii=False) + '\n')
+
+def api_calls(directory: str, name: str, method: str = None) -> list:
+    """Параметры вызовов Bot API, сделанных процессом name"""
+    calls = read_jsonl(os.path.join(directory, f"api-{name}.jsonl"))
+    return [call['params'] for call in calls if method is None or call['method'] == method]
+
+def user(user_id: int) -> dict:
+    return {'id': user_id, 'is_bot': False, 'first_name': f"Игрок {user_id}", 'username': f"player{user_id}"}
+
+def chat(chat_id: int) -> dict:
+    return {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'}
+
+def callback_update(update_id: int, user_id: int, data: str, chat_id: int, message_id: int = 1) -> dict:
+    """Нажатие кнопки. id запроса совпадает с update_id: по нему ответ находится в журнале"""
+    return {'update_id': update_id, 'callback_query': {
+        'id': str(update_id), 'from': user(user_id), 'chat_instance': str(chat_id), 'data': data,
+        'message': {'message_id': message_id, 'date': int(time.time()), 'chat': chat(chat_id)},
+    }}
+
+def text_update(update_id: int, user_id: int, text: str) -> dict:
+    """Сообщение админа в личном чате с ботом"""
+    return {'update_id': update_id, 'message': {
+        'message_id': update_id, 'date': int(time.time()), 'text': text,
+        'from': user(user_id), 'chat': chat(user_id),
+    }}
+
+def wait_for(condition, timeout: float, message: str, interval: float = 0.2) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError(f"Не дождались: {message}")
+        time.sleep(interval)
@@ -0,0 +1,24 @@
+from Archive import RosterArchive
+from DB import VOTE_PARTICIPATE, VOTE_MAYBE
+from Message import Message
+
+def occurrence(db_id: int, participants: list, maybe: list) -> Message:
+    message = Message()
+    message.db_id = db_id
+    message.chat_id = -1001
+    message.participants = [{'id': user_id} for user_id in participants]
+    message.maybe_participants = [{'id': user_id} for user_id in maybe]
+    return message
+
+def test_scan_reads_one_event_within_the_period(tmp_path):
+    archive = RosterArchive(str(tmp_path / 'archive.db'))
+    for week in range(5):
+        archive.submit(occurrence(1, [10, 11 + week], [20]), occurred_at=1000 + week * 100)
+        archive.submit(occurrence(2, [30], []), occurred_at=1000 + week * 100)
+    archive.close()
+    assert archive.pending == 0
+
+    assert list(archive.scan(1, 1100, 1300, with_roster=False)) == [(1100, 2, 1), (1200, 2, 1), (1300, 2, 1)]
+    assert list(archive.scan(1, 1400, 1400)) == [
+        (1400, 2, 1, [(10, VOTE_PARTICIPATE), (15, VOTE_PARTICIPATE), (20, VOTE_MAYBE)])
+    ]
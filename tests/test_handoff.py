@@ -0,0 +1,130 @@
+import os
+import time
+import sqlite3
+import multiprocessing
+from datetime import datetime, timedelta
+import pytz
+from apscheduler.triggers.cron import CronTrigger
+from telegram import Update
+from telegram.ext import ApplicationBuilder
+from DB import Database
+from Message import Message
+from Archive import RosterArchive
+from MtgBot import MtgBot, setup_application
+from fake_api import FAKE_TOKEN, FileBotAPI, add_updates, api_calls, callback_update, wait_for
+
+VOTE_CHAT = -1001
+DUE_CHAT = -1002
+ADMIN_ID = 500
+VOTES = 10   # голосов до передачи работы и столько же после
+
+# Время отправки мероприятия DUE_CHAT отсчитывается от начала теста: к этому моменту
+# старый экземпляр уже остановлен, а новый ещё не запустил планировщик
+DUE_AFTER = 25
+HANDOFF_BEFORE_DUE = 8
+RESTART_AFTER_DUE = 2
+
+def run_instance(directory: str, name: str, start_at: float = 0.0):
+    """Экземпляр бота как в MtgBot.__main__, но с Bot API из fake_api"""
+    bot = MtgBot(Database(os.path.join(directory, 'mtg.db')), RosterArchive(os.path.join(directory, 'archive.db')))
+    if not bot.handoff.acquire(timeout=60):
+        raise SystemExit(1)
+    # Медленный запуск: отправка мероприятия приходится на время, когда не работает ни один экземпляр
+    time.sleep(max(0.0, start_at - time.time()))
+    application = (
+        ApplicationBuilder().token(FAKE_TOKEN)
+        .request(FileBotAPI(directory, name))
+        .get_updates_request(FileBotAPI(directory, f"{name}-updates"))
+        .build()
+    )
+    setup_application(application, bot, metrics_port=0)
+    application.run_polling(allowed_updates=Update.ALL_TYPES, poll_interval=0.05)
+
+def seed(path: str, due: datetime) -> tuple:
+    db = Database(path)
+    db.set_chat_admin(VOTE_CHAT, ADMIN_ID)
+    db.set_chat_admin(DUE_CHAT, ADMIN_ID)
+
+    vote_event = Message()
+    vote_event.chat_id = VOTE_CHAT
+    vote_event.text = "Драфт"
+    # Не в этот день недели: сама по себе отправка за время теста не наступит
+    vote_event.day_of_week = (due + timedelta(days=3)).strftime('%a').lower()
+    vote_event.set_trigger(vote_event.day_of_week, '19:00')
+    db.save_message(vote_event)
+
+    due_event = Message()
+    due_event.chat_id = DUE_CHAT
+    due_event.text = "Турнир"
+    due_event.day_of_week = due.strftime('%a').lower()
+    due_event.time = due.strftime('%H:%M')
+    # С точностью до секунды, чтобы не ждать границы минуты
+    due_event.trigger = CronTrigger(day_of_week=due.weekday(), hour=due.hour, minute=due.minute,
+                                    second=due.second, timezone=due.tzinfo)
+    db.save_message(due_event)
+    db.conn.close()
+    return vote_event.db_id, due_event.db_id
+
+def votes(first_update_id: int, db_id: int) -> list:
+    return [callback_update(update_id, 10_000 + update_id, f"participate_{db_id}", VOTE_CHAT)
+            for update_id in range(first_update_id, first_update_id + VOTES)]
+
+def test_handoff_between_two_processes(tmp_path, monkeypatch):
+    directory = str(tmp_path)
+    monkeypatch.chdir(directory)
+    path = os.path.join(directory, 'mtg.db')
+    moscow = pytz.timezone("Europe/Moscow")
+    started = time.time()
+    due = datetime.now(moscow).replace(microsecond=0) + timedelta(seconds=DUE_AFTER)
+    vote_id, due_id = seed(path, due)
+    state = sqlite3.connect(path)
+
+    def journal_rows():
+        # user_id = 0 - сброс состава при отправке мероприятия, а не голос
+        return state.execute('SELECT COUNT(*) FROM vote_journal WHERE user_id != 0').fetchone()[0]
+
+    add_updates(directory, votes(1, vote_id))
+    ctx = multiprocessing.get_context('spawn')
+    old = ctx.Process(target=run_instance, args=(directory, 'old'))
+    old.start()
+    new = None
+    try:
+        wait_for(lambda: journal_rows() == VOTES, 30, "старый экземпляр обработал голоса")
+
+        # Новый экземпляр просит блокировку до отправки, а запускается после неё
+        time.sleep(max(0.0, started + DUE_AFTER - HANDOFF_BEFORE_DUE - time.time()))
+        new = ctx.Process(target=run_instance, args=(directory, 'new', started + DUE_AFTER + RESTART_AFTER_DUE))
+        new.start()
+
+        # Передача блокировки: старый экземпляр сам завершается по heartbeat
+        old.join(30)
+        assert old.exitcode == 0
+        assert time.time() < started + DUE_AFTER, "старый экземпляр должен остановиться до отправки"
+        owner = lambda: state.execute('SELECT owner FROM instance_lock WHERE id = 1').fetchone()[0] or ''
+        wait_for(lambda: f":{new.pid}:" in owner(), 10, "новый экземпляр получил блокировку")
+
+        # Обновления приходят новому экземпляру с начала: обработанные старым пропускаются
+        add_updates(directory, votes(VOTES + 1, vote_id))
+        wait_for(lambda: journal_rows() == 2 * VOTES, 60, "новый экземпляр обработал новые голоса")
+        time.sleep(1)
+        assert journal_rows() == 2 * VOTES
+        participants = state.execute('SELECT COUNT(*) FROM participants WHERE message_id = ?', (vote_id,)).fetchone()[0]
+        assert participants == 2 * VOTES
+
+        answered = lambda name: {int(call['callback_query_id']) for call in api_calls(directory, name, 'answerCallbackQuery')}
+        assert answered('old') == set(range(1, VOTES + 1))
+        assert answered('new') == set(range(VOTES + 1, 2 * VOTES + 1))
+
+        # Отправка, которая пришлась на перерыв, выполняется новым экземпляром один раз
+        sent = lambda name: [call for method in ('sendMessage', 'sendPhoto')
+                             for call in api_calls(directory, name, method) if int(call['chat_id']) == DUE_CHAT]
+        wait_for(lambda: sent('new'), 30, "пропущенная отправка")
+        time.sleep(1)
+        assert len(sent('new')) == 1
+        assert not sent('old')
+    finally:
+        for process in (old, new):
+            if process and process.is_alive():
+                process.terminate()
+                process.join(30)
+        state.close()
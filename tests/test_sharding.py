@@ -0,0 +1,140 @@
+import json
+import time
+import asyncio
+import queue
+import functools
+import itertools
+import multiprocessing
+from datetime import datetime, timedelta
+import pytz
+import pytest
+from Message import Message
+from Sharding import ShardAuth, ShardedDatabase, run_front, run_worker, shard_of_chat, shard_of_event
+from fake_api import FAKE_TOKEN, FileBotAPI, add_updates, api_calls, callback_update, text_update, wait_for
+
+SHARDS = 2
+WEEK = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+
+def chat_in_shard(shard: int, start: int = -1001) -> int:
+    return next(chat_id for chat_id in itertools.count(start, -1) if shard_of_chat(chat_id, SHARDS) == shard)
+
+def user_in_shard(shard: int, start: int = 500) -> int:
+    return next(user_id for user_id in itertools.count(start) if shard_of_chat(user_id, SHARDS) == shard)
+
+def start_front(directory: str, inboxes: list):
+    asyncio.run(run_front(inboxes, FAKE_TOKEN, poll_timeout=1, request=FileBotAPI(directory, 'front')))
+
+def seed(admin_id: int, chats: list) -> list:
+    db = ShardedDatabase(0, SHARDS)
+    # Мероприятия не отправляются сами за время теста: день недели - послезавтра
+    day = WEEK[(datetime.now(pytz.timezone("Europe/Moscow")).weekday() + 2) % 7]
+    events = []
+    for chat_id in chats:
+        db.set_chat_admin(chat_id, admin_id)
+        event = Message()
+        event.chat_id = chat_id
+        event.text = f"Драфт в {chat_id}"
+        event.day_of_week = day
+        event.set_trigger(day, '19:00')
+        events.append(db.save_message(event).db_id)
+    # Копия мероприятия первого чата во втором
+    db.add_message_post(events[0], chats[1])
+    for shard in db.shards:
+        shard.conn.close()
+    return events
+
+def sends_to(directory: str, name: str, chat_id: int) -> list:
+    return [call for method in ('sendMessage', 'sendPhoto')
+            for call in api_calls(directory, name, method) if int(call['chat_id']) == chat_id]
+
+def test_unrouted_method_is_not_sent_to_home_shard(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db = ShardedDatabase(1, SHARDS)
+    try:
+        assert db.get_state('last_update_id') is None
+        with pytest.raises(AttributeError):
+            db.iter_export
+    finally:
+        for shard in db.shards:
+            shard.conn.close()
+
+def test_auth_invalidation_reaches_other_shards(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    db = ShardedDatabase(0, SHARDS)
+    admin_id, chat_id = user_in_shard(0), chat_in_shard(1)
+    db.set_chat_admin(chat_id, admin_id)
+    inboxes = [queue.Queue() for _ in range(SHARDS)]
+    home, other = ShardAuth(db, 0, inboxes), ShardAuth(db, 1, inboxes)
+    try:
+        assert home.is_chat_admin(admin_id, chat_id) and other.is_chat_admin(admin_id, chat_id)
+        db.remove_chat_admin(chat_id, admin_id)
+        home.invalidate_chat(chat_id)
+        assert inboxes[0].empty()
+        kind, payload = inboxes[1].get_nowait()
+        assert kind == 'auth'
+        other.apply(*payload)
+        assert not other.is_chat_admin(admin_id, chat_id)
+        # Сброс от другого шарда дальше не рассылается
+        assert inboxes[0].empty() and inboxes[1].empty()
+    finally:
+        for shard in db.shards:
+            shard.conn.close()
+
+def test_front_and_workers(tmp_path, monkeypatch):
+    directory = str(tmp_path)
+    monkeypatch.chdir(directory)
+    monkeypatch.setenv('MTG_METRICS_PORT', '0')
+
+    admin_id = user_in_shard(0)
+    home_chat, other_chat = chat_in_shard(0), chat_in_shard(1)
+    home_event, other_event = seed(admin_id, [home_chat, other_chat])
+    assert (shard_of_event(home_event), shard_of_event(other_event)) == (0, 1)
+
+    ctx = multiprocessing.get_context('spawn')
+    inboxes = [ctx.Queue() for _ in range(SHARDS)]
+    workers = [
+        ctx.Process(target=run_worker, args=(i, inboxes, FAKE_TOKEN, functools.partial(FileBotAPI, directory, f"shard{i}")))
+        for i in range(SHARDS)
+    ]
+    front = ctx.Process(target=start_front, args=(directory, inboxes))
+    for process in [*workers, front]:
+        process.start()
+
+    update_ids = itertools.count(1)
+    try:
+        # Голос под копией мероприятия шарда 0 в чате шарда 1 обрабатывает шард 0
+        add_updates(directory, [callback_update(next(update_ids), 10_000 + i, f"participate_{home_event}", other_chat)
+                                for i in range(3)])
+        answered = lambda name: api_calls(directory, name, 'answerCallbackQuery')
+        wait_for(lambda: len(answered('shard0')) == 3, 60, "голоса дошли до шарда мероприятия")
+        assert not answered('shard1')
+
+        # Список мероприятий админа объединяет оба шарда
+        add_updates(directory, [callback_update(next(update_ids), admin_id, 'a_messages', admin_id)])
+        listed = lambda: [call for call in api_calls(directory, 'shard0', 'editMessageText') if 'reply_markup' in call]
+        wait_for(listed, 30, "список мероприятий админа")
+        markup = json.dumps(listed()[-1]['reply_markup'])
+        assert f"s_{home_event}" in markup and f"s_{other_event}" in markup
+
+        # Перенос мероприятия шарда 1 из сессии админа в шарде 0: задачу ставит шард 1
+        moscow = pytz.timezone("Europe/Moscow")
+        due = (datetime.now(moscow) + timedelta(seconds=75)).replace(second=0, microsecond=0)
+        add_updates(directory, [
+            callback_update(next(update_ids), admin_id, f"s_{other_event}", admin_id),
+            callback_update(next(update_ids), admin_id, 'm_reschedule', admin_id),
+            callback_update(next(update_ids), admin_id, f"day_{WEEK[due.weekday()]}", admin_id),
+            text_update(next(update_ids), admin_id, due.strftime('%H:%M')),
+        ])
+        wait_for(lambda: sends_to(directory, 'shard1', other_chat),
+                 (due - datetime.now(moscow)).total_seconds() + 30, "отправка перенесённого мероприятия")
+        time.sleep(1)
+        assert len(sends_to(directory, 'shard1', other_chat)) == 1
+        assert not sends_to(directory, 'shard0', other_chat)
+    finally:
+        for inbox in inboxes:
+            inbox.put(('stop', None))
+        front.terminate()
+        for process in [*workers, front]:
+            process.join(30)
+            if process.is_alive():
+                process.terminate()